@@ -0,0 +1,67 @@
+"""Compares object store size, disk usage and wall time of the clone strategies.
+
+The source repository is served through file:// so git negotiates and
+transfers a pack exactly like it would over the network.
+
+Usage: python clone_strategy_benchmark.py [--commits N] [--blob-size BYTES] [--depth N]"""
+import argparse
+import json
+import os
+import sys
+import tempfile
+import time
+from subprocess import run
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', 'main', 'python'))
+
+from git_clone import CLONE_STRATEGIES, clone_repository  # noqa: E402
+from synthetic_repo import build_synthetic_repo  # noqa: E402
+
+
+def directory_size(path: str) -> int:
+    total = 0
+    for root, _, files in os.walk(path):
+        for file_name in files:
+            total += os.lstat(os.path.join(root, file_name)).st_size
+    return total
+
+
+def objects_path(clone_path: str) -> str:
+    dot_git = os.path.join(clone_path, '.git')
+    return os.path.join(dot_git if os.path.isdir(dot_git) else clone_path, 'objects')
+
+
+def measure(source_url: str, target_path: str, strategy: str, depth) -> dict:
+    start = time.perf_counter()
+    clone_repository(source_url, target_path, strategy=strategy, depth=depth)
+    seconds = time.perf_counter() - start
+    return {
+        'strategy': strategy,
+        'depth': depth,
+        'seconds': seconds,
+        'objects_bytes': directory_size(objects_path(target_path)),
+        'disk_bytes': directory_size(target_path),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--commits', type=int, default=2000)
+    parser.add_argument('--blob-size', type=int, default=16 * 1024)
+    parser.add_argument('--depth', type=int, default=None)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory(prefix='raq_clone_bench_') as tmp:
+        source = build_synthetic_repo(os.path.join(tmp, 'source'), args.commits, blob_size=args.blob_size)
+        run(['git', 'config', 'uploadpack.allowFilter', 'true'], cwd=source, check=True)
+        run(['git', 'repack', '-adq'], cwd=source, check=True)
+        source_url = 'file://' + source
+
+        results = []
+        for strategy in CLONE_STRATEGIES:
+            results.append(measure(source_url, os.path.join(tmp, strategy), strategy, args.depth))
+        print(json.dumps(results, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,128 @@
+"""Compares the streaming commit walker with the per-SHA `git show` path.
+
+Usage: python commit_walk_benchmark.py [--commits N] [--legacy-limit N]"""
+import argparse
+import json
+import os
+import sys
+import tempfile
+import time
+from subprocess import PIPE, run
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', 'main', 'python'))
+
+from git_commit_walker import walk_commits  # noqa: E402
+from synthetic_repo import build_synthetic_repo  # noqa: E402
+
+LEGACY_DELIMITER = b'\x22\x23\x24\x25\x26\x27\x28\x29\x2a\x7b'
+
+
+# The per-SHA helpers main used before the streaming walker, kept as they were.
+def git_log_get_initial_sha():
+    log_process = run(['git', '--no-pager', 'log', '--pretty=%H', '--max-count=1'],
+                      stdout=PIPE, encoding='utf-8', universal_newlines=True)
+    log_out = log_process.stdout
+    if log_process.returncode == 128:
+        initial_sha = None
+    else:
+        if log_out[-1] == '\n':
+            initial_sha = log_out[:-1]
+        else:
+            initial_sha = None
+    return initial_sha
+
+
+def git_show_commit_msg(current_sha, delimiter):
+    combi_format = '--pretty=%B{}'.format(delimiter.decode())
+    show_commit_cmd = ['git', '--no-pager', 'show', '--shortstat', combi_format, current_sha]
+    show_commit_proc = run(show_commit_cmd, stdout=PIPE, )
+    show_commit_out_bytes = show_commit_proc.stdout
+    show_commit_out_bytes_target = show_commit_out_bytes[:show_commit_out_bytes.find(delimiter)]
+    show_commit_exit_code = show_commit_proc.returncode
+    show_out = show_commit_out_bytes_target.decode('unicode-escape')
+    return show_commit_exit_code, show_out
+
+
+def git_parent_shas_space_separated(current_sha, delimiter):
+    parents_format = '--pretty=format:%P{}'.format(delimiter.decode())
+    parents_cmd = ['git', '--no-pager', 'show', '--shortstat', parents_format, current_sha]
+    parents_proc = run(parents_cmd, stdout=PIPE, stderr=PIPE)
+    parents_exit_code = parents_proc.returncode
+    parents_out_bytes = parents_proc.stdout
+    parents_out_bytes_target = parents_out_bytes[:parents_out_bytes.find(delimiter)]
+    parents_out = parents_out_bytes_target.decode('unicode-escape')
+    return parents_exit_code, parents_out
+
+
+def legacy_walk(repo_path: str, limit: int) -> dict:
+    """The walk handle_repo_task did before, two processes per commit."""
+    origin = os.getcwd()
+    os.chdir(repo_path)
+    try:
+        commits = {}
+        done_shas = set()
+        agenda = [git_log_get_initial_sha()]
+        for current_sha in agenda:
+            if len(commits) >= limit:
+                break
+            if current_sha in done_shas or current_sha == '':
+                continue
+            commits[current_sha] = {}
+            exit_code, parents_out = git_parent_shas_space_separated(current_sha, LEGACY_DELIMITER)
+            if exit_code == 0 and parents_out != '':
+                agenda.extend(parents_out.split(' '))
+                commits[current_sha]['parents'] = parents_out.split(' ')
+            exit_code, message_out = git_show_commit_msg(current_sha, LEGACY_DELIMITER)
+            if exit_code == 0:
+                commits[current_sha]['message'] = message_out
+            done_shas.add(current_sha)
+        return commits
+    finally:
+        os.chdir(origin)
+
+
+def streaming_walk(repo_path: str) -> dict:
+    commits = {}
+    for sha, parents, message in walk_commits(repo_path):
+        commit_dict = {}
+        if parents:
+            commit_dict['parents'] = parents
+        commit_dict['message'] = message
+        commits[sha] = commit_dict
+    return commits
+
+
+def timed(function, *args):
+    start = time.perf_counter()
+    result = function(*args)
+    return result, time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--commits', type=int, default=20000)
+    parser.add_argument('--legacy-limit', type=int, default=1000,
+                        help='Commits walked by the slow per-SHA path')
+    parser.add_argument('--merge-density', type=float, default=0.05)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory(prefix='raq_walk_bench_') as tmp:
+        repo_path = build_synthetic_repo(os.path.join(tmp, 'repo'), args.commits, args.merge_density)
+
+        streamed, streamed_seconds = timed(streaming_walk, repo_path)
+        legacy, legacy_seconds = timed(legacy_walk, repo_path, args.legacy_limit)
+
+        mismatches = [sha for sha in legacy if streamed.get(sha) != legacy[sha]]
+        report = {
+            'commits': len(streamed),
+            'streaming_commits_per_second': len(streamed) / streamed_seconds,
+            'legacy_commits': len(legacy),
+            'legacy_commits_per_second': len(legacy) / legacy_seconds,
+            'mismatching_commits': len(mismatches),
+        }
+        report['speedup'] = report['streaming_commits_per_second'] / report['legacy_commits_per_second']
+        print(json.dumps(report, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,196 @@
+"""Runs repo tasks through the full handle_message path against local
+stand-ins of the GitHub API, SQS and the FTP server and reports the
+throughput of the worker.
+
+Every repository is a synthetic one cloned through file://, so the numbers
+are reproducible between runs and versions. The report is printed and
+saved as JSON; pass --baseline with an earlier report to see the change.
+
+Usage: python end_to_end_benchmark.py [--repos N] [--commits N] [--output PATH] [--baseline PATH]"""
+import argparse
+import datetime
+import ftplib
+import json
+import logging
+import os
+import platform
+import resource
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from subprocess import PIPE, run
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', 'main', 'python'))
+
+import main  # noqa: E402
+from crawler_logging import start_logging  # noqa: E402
+from crawler_metrics import REGISTRY  # noqa: E402
+from github_session import GithubSession  # noqa: E402
+from message_queue import MessageLeaseKeeper, NoMessagesAfterLongPollingAvailableException  # noqa: E402
+from stand_ins import GithubApiStub, InMemoryMessageQueue, MinimalFtpServer  # noqa: E402
+from synthetic_repo import build_synthetic_repo  # noqa: E402
+from upload_pipeline import FtpsUploader, UploadPipeline  # noqa: E402
+
+COMPARED_FIELDS = ('repos_per_minute', 'commits_per_second', 'peak_rss_bytes')
+
+
+def peak_rss_bytes() -> int:
+    """Peak resident set size of the worker process. git children are left
+    out, their peak is dominated by the parent's pages they fork with."""
+    # ru_maxrss is in kilobytes on Linux but in bytes on macOS.
+    scale = 1 if platform.system() == 'Darwin' else 1024
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * scale
+
+
+def source_revision() -> str:
+    described = run(['git', 'describe', '--always', '--dirty'], stdout=PIPE, universal_newlines=True,
+                    cwd=os.path.dirname(os.path.abspath(__file__)))
+    return described.stdout.strip() or 'unknown'
+
+
+def build_repositories(repos_path: str, args) -> list:
+    """Builds repos_path/<n> for every distinct synthetic repository. Tasks
+    reuse them round robin, so large runs do not need as many builds."""
+    paths = []
+    for number in range(min(args.distinct_repos, args.repos)):
+        paths.append(build_synthetic_repo(os.path.join(repos_path, str(number)), args.commits,
+                                          merge_density=args.merge_density, message_size=args.message_size,
+                                          seed=number))
+    return paths
+
+
+def run_tasks(msg_queue, github_session, working_path: str, upload_pipeline, concurrency: int) -> None:
+    """Pops and handles every queued message like run_crawler_with_config."""
+    results_path = os.path.join(working_path, 'results')
+    os.makedirs(results_path)
+    if main.CONFIG.get('pipeline') == 'true':
+        run_pipeline(msg_queue, github_session, working_path, results_path, upload_pipeline)
+        return
+    task_paths = [os.path.join(working_path, 'tasks', str(slot)) for slot in range(concurrency)]
+    for task_path in task_paths:
+        os.makedirs(task_path)
+
+    def work_slot(task_path):
+        while True:
+            try:
+                message = msg_queue.pop_next_message()
+            except NoMessagesAfterLongPollingAvailableException:
+                return
+            main.handle_message(github_session, msg_queue, message, task_path, results_path,
+                                upload_pipeline=upload_pipeline)
+
+    # Each slot works off the queue on its own, like the bounded executor of the worker.
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        for future in [executor.submit(work_slot, task_path) for task_path in task_paths]:
+            future.result()
+
+
+def run_pipeline(msg_queue, github_session, working_path: str, results_path: str, upload_pipeline) -> None:
+    """Submits every queued message to the staged pipeline of the worker."""
+    lease_keeper = MessageLeaseKeeper(msg_queue, main.MSG_VISIBILITY_TIMEOUT)
+    repo_pipeline = main.create_repo_pipeline(main.CONFIG, github_session, lease_keeper, working_path, results_path,
+                                              None, upload_pipeline, None, None, None)
+    while True:
+        try:
+            message = msg_queue.pop_next_message()
+        except NoMessagesAfterLongPollingAvailableException:
+            break
+        lease_keeper.hold(message)
+        repo_pipeline.submit({'message': message, 'start': time.perf_counter()})
+    repo_pipeline.close()
+    lease_keeper.close()
+
+
+def compare(report: dict, baseline: dict) -> dict:
+    """Relative change of every compared field against the baseline report."""
+    return {field: (report[field] - baseline[field]) / baseline[field]
+            for field in COMPARED_FIELDS if baseline.get(field)}
+
+
+def main_benchmark():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--repos', type=int, default=20, help='Repo tasks to run')
+    parser.add_argument('--distinct-repos', type=int, default=5, help='Synthetic repositories to build')
+    parser.add_argument('--commits', type=int, default=2000, help='Commits per synthetic repository')
+    parser.add_argument('--merge-density', type=float, default=0.05)
+    parser.add_argument('--message-size', type=int, default=64)
+    parser.add_argument('--concurrency', type=int, default=1)
+    parser.add_argument('--pipeline', action='store_true', help='Run repo tasks through the staged pipeline')
+    parser.add_argument('--clone-concurrency', type=int, default=4)
+    parser.add_argument('--walk-concurrency', type=int, default=2)
+    parser.add_argument('--clone-strategy', default='full')
+    parser.add_argument('--result-format', default='json')
+    parser.add_argument('--result-compression', default='none')
+    parser.add_argument('--output', default=None, help='Where to save the JSON report')
+    parser.add_argument('--baseline', default=None, help='Earlier JSON report to compare against')
+    args = parser.parse_args()
+
+    log_listener = start_logging(logging.ERROR)
+    with tempfile.TemporaryDirectory(prefix='raq_e2e_bench_') as tmp:
+        repo_paths = build_repositories(os.path.join(tmp, 'repos'), args)
+        ftp_root = os.path.join(tmp, 'ftp')
+        os.makedirs(ftp_root)
+
+        with GithubApiStub() as github_stub, MinimalFtpServer(ftp_root) as ftp_server:
+            main.CONFIG = {
+                'clone_strategy': args.clone_strategy,
+                'result_format': args.result_format,
+                'result_compression': args.result_compression,
+                'ftp_address': ftp_server.address,
+                'ftp_user': 'raq',
+                'ftp_password': 'raq',
+                'pipeline': 'true' if args.pipeline else 'false',
+                'clone_concurrency': args.clone_concurrency,
+                'walk_concurrency': args.walk_concurrency,
+            }
+            main.GLOBAL = {'START_TIMESTAMP': datetime.datetime.utcnow().isoformat(), 'RANDOM_ID': 'benchmark',
+                           'SHOULD_RUN': True}
+
+            msg_queue = InMemoryMessageQueue()
+            for repo_id in range(1, args.repos + 1):
+                full_name = 'bench/repo{}'.format(repo_id)
+                repo_path = repo_paths[(repo_id - 1) % len(repo_paths)]
+                github_stub.add_repository(repo_id, full_name, 'file://' + os.path.abspath(repo_path))
+                msg_queue.write_message({'task_type': 'repo', 'repo_task': {
+                    'id': repo_id, 'full_name': full_name, 'api_url': github_stub.url('/repos/' + full_name)}})
+
+            upload_pipeline = UploadPipeline(
+                partial(FtpsUploader, ftp_server.address, 'raq', 'raq', ftp_factory=ftplib.FTP),
+                spool_path=os.path.join(tmp, 'spool'), workers=2)
+            commits_before = REGISTRY.counter_value('raq_commits_total')
+            start = time.perf_counter()
+            run_tasks(msg_queue, GithubSession(), os.path.join(tmp, 'work'), upload_pipeline, args.concurrency)
+            upload_pipeline.close()
+            seconds = time.perf_counter() - start
+            commits = REGISTRY.counter_value('raq_commits_total') - commits_before
+
+            report = {
+                'benchmark': 'end_to_end',
+                'revision': source_revision(),
+                'python': platform.python_version(),
+                'timestamp': datetime.datetime.utcnow().isoformat(),
+                'parameters': vars(args),
+                'repos': args.repos,
+                'uploaded_files': ftp_server.stored_files,
+                'github_requests': github_stub.requests,
+                'commits': commits,
+                'seconds': seconds,
+                'repos_per_minute': args.repos / seconds * 60,
+                'commits_per_second': commits / seconds,
+                'peak_rss_bytes': peak_rss_bytes(),
+            }
+    log_listener.stop()
+
+    if args.baseline:
+        with open(args.baseline) as baseline_file:
+            report['change_against_baseline'] = compare(report, json.load(baseline_file))
+    output = args.output or 'end_to_end-{}.json'.format(report['timestamp'].replace(':', '-'))
+    with open(output, 'w') as output_file:
+        json.dump(report, output_file, indent=2)
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == '__main__':
+    main_benchmark()
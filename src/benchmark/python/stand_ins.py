@@ -0,0 +1,224 @@
+"""Local stand-ins for the services a crawler worker talks to: the GitHub
+API, the SQS message queue and the FTP server receiving results."""
+import json
+import os
+import socket
+import socketserver
+import threading
+from collections import deque
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from typing import Dict, Iterable, Mapping
+
+from message_queue import MessageQueue, NoMessagesAfterLongPollingAvailableException
+
+
+class _GithubApiHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        stub = self.server
+        path, _, query = self.path.partition('?')
+        if path == '/repositories':
+            since = int(dict(part.split('=', 1) for part in query.split('&') if '=' in part).get('since', 0))
+            body = [{'id': repo_id, 'full_name': meta['full_name']}
+                    for repo_id, meta in sorted(stub.repos_by_id.items()) if repo_id > since][:100]
+        elif path.endswith('/languages'):
+            body = {'Python': 1000, 'Shell': 20}
+        elif path[len('/repos/'):] in stub.repos_by_name:
+            body = stub.repos_by_name[path[len('/repos/'):]]
+        else:
+            self.send_error(404)
+            return
+        payload = json.dumps(body).encode('utf-8')
+        with stub.lock:
+            stub.requests += 1
+            remaining = max(5000 - stub.requests, 0)
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(payload)))
+        self.send_header('X-RateLimit-Remaining', str(remaining))
+        self.send_header('X-RateLimit-Reset', '4102444800')
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def log_message(self, *args):
+        pass
+
+
+class GithubApiStub(socketserver.ThreadingMixIn, HTTPServer):
+    """Serves /repositories, /repos/{full_name} and its languages for the
+    given repositories, whose clone_url may point anywhere, e.g. file://."""
+    daemon_threads = True
+
+    def __init__(self):
+        super().__init__(('127.0.0.1', 0), _GithubApiHandler)
+        self.repos_by_id = {}  # type: Dict[int, dict]
+        self.repos_by_name = {}  # type: Dict[str, dict]
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.__thread = None
+
+    def url(self, path: str) -> str:
+        return 'http://127.0.0.1:{}{}'.format(self.server_address[1], path)
+
+    def add_repository(self, repo_id: int, full_name: str, clone_url: str) -> dict:
+        meta = {
+            'id': repo_id,
+            'full_name': full_name,
+            'clone_url': clone_url,
+            'url': self.url('/repos/' + full_name),
+            'languages_url': self.url('/repos/{}/languages'.format(full_name)),
+        }
+        self.repos_by_id[repo_id] = meta
+        self.repos_by_name[full_name] = meta
+        return meta
+
+    def __enter__(self):
+        self.__thread = threading.Thread(target=self.serve_forever, daemon=True)
+        self.__thread.start()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.shutdown()
+        self.server_close()
+
+
+class InMemoryMessage:
+    """Mimics the parts of boto3's SQS.Message the crawler uses."""
+
+    def __init__(self, message_queue: 'InMemoryMessageQueue', message_dict: Mapping,
+                 message_attributes: Mapping):
+        self.__queue = message_queue
+        self.body = json.dumps(message_dict)
+        self.body_raw = self.body
+        self.body_dict = json.loads(self.body)
+        self.message_attributes = dict(message_attributes)
+
+    def delete(self):
+        self.__queue.deleted += 1
+
+    def change_visibility(self, VisibilityTimeout: int):
+        pass
+
+
+class InMemoryMessageQueue(MessageQueue):
+    """Stands in for SqsMessageQueue without any network round trips."""
+
+    def __init__(self):
+        self.__messages = deque()
+        self.__lock = threading.Lock()
+        self.deleted = 0
+
+    def __len__(self) -> int:
+        return len(self.__messages)
+
+    def pop_next_message(self) -> InMemoryMessage:
+        with self.__lock:
+            if not self.__messages:
+                raise NoMessagesAfterLongPollingAvailableException('No Messages receivable from Queue')
+            return self.__messages.popleft()
+
+    def pop_messages(self, max_messages: int = 10) -> list:
+        with self.__lock:
+            return [self.__messages.popleft() for _ in range(min(max_messages, len(self.__messages)))]
+
+    def write_message(self, message_dict: Mapping, message_attributes_dict: Mapping = {}) -> dict:
+        with self.__lock:
+            self.__messages.append(InMemoryMessage(self, message_dict, message_attributes_dict))
+        return {'MessageId': str(len(self.__messages)), 'MD5OfMessageBody': ''}
+
+    def write_messages(self, message_dicts: Iterable[Mapping], message_attributes_dict: Mapping = {}) -> int:
+        written = 0
+        for message_dict in message_dicts:
+            self.write_message(message_dict, message_attributes_dict)
+            written += 1
+        return written
+
+    def approximate_depth(self) -> int:
+        return len(self)
+
+    def close(self) -> None:
+        pass
+
+
+class _FtpHandler(socketserver.StreamRequestHandler):
+    """Just enough of RFC 959 for ftplib's login, storbinary and rename."""
+
+    def reply(self, line: str) -> None:
+        self.wfile.write((line + '\r\n').encode('utf-8'))
+
+    def handle(self):
+        server = self.server
+        passive = None
+        rename_from = None
+        self.reply('220 raq benchmark ftp')
+        for raw_line in self.rfile:
+            command, _, argument = raw_line.decode('utf-8').strip().partition(' ')
+            command = command.upper()
+            if command == 'USER':
+                self.reply('331 Password required')
+            elif command == 'PASS':
+                self.reply('230 Logged in')
+            elif command == 'TYPE':
+                self.reply('200 Type set')
+            elif command in ('PASV', 'EPSV'):
+                passive = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+                passive.bind(('127.0.0.1', 0))
+                passive.listen(1)
+                port = passive.getsockname()[1]
+                if command == 'EPSV':
+                    self.reply('229 Entering Extended Passive Mode (|||{}|)'.format(port))
+                else:
+                    self.reply('227 Entering Passive Mode (127,0,0,1,{},{})'.format(port // 256, port % 256))
+            elif command == 'STOR' and passive is not None:
+                self.reply('150 Ready')
+                data_connection, _ = passive.accept()
+                passive.close()
+                passive = None
+                target = os.path.join(server.root_path, argument.replace('/', '_'))
+                with data_connection, open(target, 'wb') as target_file:
+                    while True:
+                        chunk = data_connection.recv(65536)
+                        if not chunk:
+                            break
+                        target_file.write(chunk)
+                self.reply('226 Transfer complete')
+            elif command == 'RNFR':
+                rename_from = argument
+                self.reply('350 Ready for RNTO')
+            elif command == 'RNTO' and rename_from is not None:
+                os.replace(os.path.join(server.root_path, rename_from.replace('/', '_')),
+                           os.path.join(server.root_path, argument.replace('/', '_')))
+                with server.lock:
+                    server.stored_files += 1
+                rename_from = None
+                self.reply('250 Renamed')
+            elif command == 'QUIT':
+                self.reply('221 Bye')
+                return
+            else:
+                self.reply('502 Command not implemented')
+
+
+class MinimalFtpServer(socketserver.ThreadingMixIn, socketserver.TCPServer):
+    """Plain FTP server storing every upload flattened into root_path."""
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, root_path: str):
+        super().__init__(('127.0.0.1', 0), _FtpHandler)
+        self.root_path = root_path
+        self.lock = threading.Lock()
+        self.stored_files = 0
+
+    @property
+    def address(self) -> str:
+        return '127.0.0.1:{}'.format(self.server_address[1])
+
+    def __enter__(self):
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.shutdown()
+        self.server_close()
@@ -0,0 +1,56 @@
+"""Builds synthetic git repositories for benchmarks via git fast-import."""
+import os
+import random
+from subprocess import PIPE, Popen, run
+
+COMMITTER = 'Raq Bench <bench@example.com>'
+FIRST_TIMESTAMP = 1500000000
+
+
+def _data_block(payload: bytes) -> bytes:
+    return b'data ' + str(len(payload)).encode() + b'\n' + payload + b'\n'
+
+
+def _random_message(rnd: random.Random, index: int, message_size: int) -> bytes:
+    words = ['fix', 'add', 'remove', 'refactor', 'crawler', 'queue', 'session', 'walk', 'things']
+    body = []
+    length = 0
+    while length < message_size:
+        word = rnd.choice(words)
+        body.append(word)
+        length += len(word) + 1
+    return 'Commit {}\n\n{}\n'.format(index, ' '.join(body)).encode('utf-8')
+
+
+def build_synthetic_repo(target_path: str, commit_count: int, merge_density: float = 0.05,
+                         message_size: int = 64, blob_size: int = 16, seed: int = 42) -> str:
+    """Creates a repository with commit_count commits on its default branch.
+
+    merge_density is the probability of a commit having a second parent,
+    which is picked randomly from the earlier history. Every commit rewrites
+    one of a few files with blob_size random bytes. Returns the path of the
+    created repository."""
+    rnd = random.Random(seed)
+    os.makedirs(target_path, exist_ok=True)
+    run(['git', 'init', '-q', target_path], check=True)
+    run(['git', 'symbolic-ref', 'HEAD', 'refs/heads/master'], cwd=target_path, check=True)
+
+    importer = Popen(['git', 'fast-import', '--quiet'], cwd=target_path, stdin=PIPE)
+    for index in range(1, commit_count + 1):
+        lines = [
+            b'commit refs/heads/master\n',
+            'mark :{}\n'.format(index).encode(),
+            'committer {} {} +0000\n'.format(COMMITTER, FIRST_TIMESTAMP + index).encode(),
+            _data_block(_random_message(rnd, index, message_size)),
+        ]
+        if index > 1:
+            lines.append('from :{}\n'.format(index - 1).encode())
+        if index > 2 and rnd.random() < merge_density:
+            lines.append('merge :{}\n'.format(rnd.randint(1, index - 2)).encode())
+        lines.append('M 644 inline dir{0}/file{0}.bin\n'.format(index % 8).encode())
+        lines.append(_data_block(rnd.getrandbits(8 * blob_size).to_bytes(blob_size, 'little')))
+        importer.stdin.write(b''.join(lines))
+    importer.stdin.close()
+    if importer.wait() != 0:
+        raise Exception('git fast-import failed for {}'.format(target_path))
+    return target_path
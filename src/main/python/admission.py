@@ -0,0 +1,164 @@
+"""Decides by its size whether a repository is crawled, handed on to the
+queue of large repositories or skipped, and keeps the clone and walk of
+admitted ones within a wall-clock, disk and memory budget."""
+import os
+import signal
+import time
+from subprocess import Popen, TimeoutExpired
+from typing import Callable, Iterable, List, Optional
+
+ADMIT = 'admit'
+ROUTE_LARGE = 'large'
+SKIP = 'skip'
+
+
+class BudgetExceededException(Exception):
+    """Exception thrown when a task runs out of its time, disk or memory budget."""
+
+    def __init__(self, resource: str, limit, used):
+        super().__init__('{} budget of {} exceeded with {}'.format(resource, limit, used))
+        self.resource = resource
+        self.limit = limit
+        self.used = used
+
+
+def process_tree_rss(root_pid: int) -> int:
+    """Sums up the resident memory in bytes of the process and all its
+    descendants. Returns 0 where /proc is not available."""
+    try:
+        pids = [int(entry) for entry in os.listdir('/proc') if entry.isdigit()]
+    except OSError:
+        return 0
+    parents = {}
+    rss_pages = {}
+    for pid in pids:
+        try:
+            with open('/proc/{}/stat'.format(pid)) as stat_file:
+                stat = stat_file.read()
+        except OSError:
+            continue
+        # The command name in parentheses may contain spaces, the fields after it start with the state.
+        fields = stat[stat.rindex(')') + 2:].split()
+        parents[pid] = int(fields[1])
+        rss_pages[pid] = int(fields[21])
+    tree = {root_pid}
+    grown = True
+    while grown:
+        descendants = {pid for pid, parent in parents.items() if parent in tree} - tree
+        grown = bool(descendants)
+        tree |= descendants
+    return sum(rss_pages.get(pid, 0) for pid in tree) * os.sysconf('SC_PAGE_SIZE')
+
+
+class ResourceBudget:
+    """Limits one task to wall_seconds from its creation, disk_bytes on disk
+    and memory_bytes resident in memory. Unset limits do not apply.
+
+    Disk and memory are measured at most every check_interval seconds, as
+    that means walking directories and /proc. The wall-clock time between
+    pause() and resume() does not count."""
+
+    def __init__(self, wall_seconds: Optional[float] = None, disk_bytes: Optional[int] = None,
+                 memory_bytes: Optional[int] = None, check_interval: float = 1.0):
+        self.deadline = time.monotonic() + wall_seconds if wall_seconds is not None else None
+        self.wall_seconds = wall_seconds
+        self.disk_bytes = disk_bytes
+        self.memory_bytes = memory_bytes
+        self.__check_interval = check_interval
+        self.__next_measurement = 0.0
+        self.__paused_at = None  # type: Optional[float]
+
+    def pause(self) -> None:
+        """Stops the clock, e.g. while the task waits for a walker."""
+        if self.__paused_at is None:
+            self.__paused_at = time.monotonic()
+
+    def resume(self) -> None:
+        """Restarts the clock, moving the deadline by the time paused."""
+        if self.__paused_at is None:
+            return
+        if self.deadline is not None:
+            self.deadline += time.monotonic() - self.__paused_at
+        self.__paused_at = None
+
+    def check(self, disk_usage: Optional[Callable[[], int]] = None, pids: Iterable[int] = ()) -> None:
+        """Raises BudgetExceededException if the deadline passed, disk_usage()
+        returns more than disk_bytes or the processes pids together with
+        their descendants hold more than memory_bytes."""
+        now = time.monotonic()
+        if self.deadline is not None and now > self.deadline:
+            raise BudgetExceededException('wall-clock', '{}s'.format(self.wall_seconds),
+                                          '{:.0f}s'.format(now - self.deadline + self.wall_seconds))
+        if now < self.__next_measurement:
+            return
+        self.__next_measurement = now + self.__check_interval
+        if self.disk_bytes is not None and disk_usage is not None:
+            used = disk_usage()
+            if used > self.disk_bytes:
+                raise BudgetExceededException('disk', self.disk_bytes, used)
+        if self.memory_bytes is not None:
+            used = sum(process_tree_rss(pid) for pid in pids)
+            if used > self.memory_bytes:
+                raise BudgetExceededException('memory', self.memory_bytes, used)
+
+
+def run_within_budget(command: List[str], budget: Optional[ResourceBudget] = None,
+                      disk_usage: Optional[Callable[[], int]] = None, cwd: Optional[str] = None,
+                      poll_interval: float = 0.5) -> int:
+    """Runs the command and returns its exit code. With a budget the command
+    is checked every poll_interval seconds, counting disk_usage() and the
+    memory of the command and its children, and killed together with its
+    children once it exceeds the budget, raising BudgetExceededException."""
+    process = Popen(command, cwd=cwd, universal_newlines=True, start_new_session=True)
+    try:
+        while True:
+            try:
+                return process.wait(timeout=poll_interval if budget is not None else None)
+            except TimeoutExpired:
+                budget.check(disk_usage, [process.pid])
+    finally:
+        if process.poll() is None:
+            try:
+                os.killpg(process.pid, signal.SIGKILL)
+            except ProcessLookupError:
+                pass
+            process.wait()
+
+
+class AdmissionPolicy:
+    """Admits repositories by the size in KiB GitHub reports for them.
+
+    Repositories above max_size_kb are skipped. Those above large_size_kb
+    are routed to large_queue, if there is one, so workers with larger
+    budgets crawl them, and crawled here otherwise. Repositories of unknown
+    size are admitted. Admitted ones get a ResourceBudget of wall_seconds,
+    disk_bytes and memory_bytes for their clone and walk."""
+
+    def __init__(self, max_size_kb: Optional[int] = None, large_size_kb: Optional[int] = None, large_queue=None,
+                 wall_seconds: Optional[float] = None, disk_bytes: Optional[int] = None,
+                 memory_bytes: Optional[int] = None):
+        self.max_size_kb = max_size_kb
+        self.large_size_kb = large_size_kb
+        self.large_queue = large_queue
+        self.wall_seconds = wall_seconds
+        self.disk_bytes = disk_bytes
+        self.memory_bytes = memory_bytes
+
+    def decide(self, repo_meta_dict: dict) -> str:
+        """Returns ADMIT, ROUTE_LARGE or SKIP for the repository."""
+        size_kb = repo_meta_dict.get('size')
+        if size_kb is None:
+            return ADMIT
+        if self.max_size_kb is not None and size_kb > self.max_size_kb:
+            return SKIP
+        if self.large_queue is not None and self.large_size_kb is not None and size_kb > self.large_size_kb:
+            return ROUTE_LARGE
+        return ADMIT
+
+    def skipped(self, repo_meta_dict: dict) -> dict:
+        """Describes why the repository was skipped, as recorded in its result."""
+        return {'reason': 'too large', 'size_kb': repo_meta_dict.get('size'), 'max_size_kb': self.max_size_kb}
+
+    def budget(self) -> ResourceBudget:
+        """Starts the budget of an admitted task."""
+        return ResourceBudget(self.wall_seconds, self.disk_bytes, self.memory_bytes)
@@ -0,0 +1,322 @@
+"""Asyncio based counterpart of GithubSession keeping many requests in flight
+over a bounded pool of pipelined keep-alive connections."""
+import asyncio
+import gzip
+import logging
+import ssl
+from collections import deque
+from datetime import datetime
+from json import loads
+from typing import Dict, Iterable, List, Mapping, MutableMapping, Optional, Tuple
+from urllib.parse import urlsplit
+
+from requests.structures import CaseInsensitiveDict
+
+from github_session import RATE_REMAINING, RATE_RESET, TokenPool, utc_from_timestamp
+
+API_ROOT = 'https://api.github.com'
+USER_AGENT = 'raq-crawler'
+MAX_RETRIES_ON_CLOSED_CONNECTION = 2
+
+LOGGER = logging.getLogger(__name__)
+
+
+class HttpResponse:
+    """Status, headers and raw body of a response."""
+
+    def __init__(self, status: int, reason: str, headers: MutableMapping, body: bytes):
+        self.status = status
+        self.reason = reason
+        self.headers = headers
+        self.body = body
+
+
+class ConnectionClosedException(Exception):
+    """Exception thrown for requests whose connection closed before they were answered."""
+    pass
+
+
+class PipelinedConnection:
+    """One keep-alive HTTP/1.1 connection. Requests are written as soon as
+    they are issued, without waiting for earlier responses, and responses are
+    read back in the order the requests were sent."""
+
+    def __init__(self, host: str, port: int, use_ssl: bool, ssl_context: Optional[ssl.SSLContext] = None):
+        self.host = host
+        self.port = port
+        self.__use_ssl = use_ssl
+        self.__ssl_context = ssl_context
+        self.__reader = None
+        self.__writer = None
+        self.__reader_task = None
+        self.__pending = deque()
+        self.closed = False
+        self.on_response = None
+
+    @property
+    def in_flight(self) -> int:
+        return len(self.__pending)
+
+    async def open(self) -> None:
+        ssl_argument = (self.__ssl_context or ssl.create_default_context()) if self.__use_ssl else None
+        self.__reader, self.__writer = await asyncio.open_connection(self.host, self.port, ssl=ssl_argument)
+        self.__reader_task = asyncio.ensure_future(self.__read_responses())
+
+    async def request(self, method: str, target: str, headers: Mapping[str, str], body: bytes = b'') -> HttpResponse:
+        if self.closed:
+            raise ConnectionClosedException('Connection to {} is closed'.format(self.host))
+        lines = ['{} {} HTTP/1.1'.format(method, target), 'Host: {}'.format(self.host)]
+        lines.extend('{}: {}'.format(name, value) for name, value in headers.items())
+        if body or method in ('POST', 'PUT', 'PATCH'):
+            lines.append('Content-Length: {}'.format(len(body)))
+        future = asyncio.get_event_loop().create_future()
+        # Queueing the future and writing the request happen without yielding
+        # to the event loop, so the order of both always matches.
+        self.__pending.append(future)
+        self.__writer.write(('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1') + body)
+        try:
+            await self.__writer.drain()
+        except (ConnectionError, ssl.SSLError) as e:
+            LOGGER.debug('Writing to %s failed: %s', self.host, e)
+            self.__fail_pending()
+        return await future
+
+    async def __read_responses(self) -> None:
+        try:
+            while True:
+                response = await self.__read_response()
+                if response is None:
+                    break
+                self.__pending.popleft().set_result(response)
+                if self.on_response is not None:
+                    self.on_response(self)
+                if response.headers.get('Connection', '').lower() == 'close':
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError, ssl.SSLError) as e:
+            LOGGER.debug('Connection to %s failed: %s', self.host, e)
+        finally:
+            self.__fail_pending()
+
+    async def __read_response(self) -> Optional[HttpResponse]:
+        status_line = await self.__reader.readline()
+        if not status_line:
+            return None
+        _, status, reason = (status_line.decode('latin-1').rstrip('\r\n').split(' ', 2) + [''])[:3]
+        headers = CaseInsensitiveDict()
+        while True:
+            line = (await self.__reader.readline()).decode('latin-1').rstrip('\r\n')
+            if not line:
+                break
+            name, value = line.split(':', 1)
+            headers[name.strip()] = value.strip()
+
+        if headers.get('Transfer-Encoding', '').lower() == 'chunked':
+            body = await self.__read_chunked_body()
+        elif 'Content-Length' in headers:
+            body = await self.__reader.readexactly(int(headers['Content-Length']))
+        elif int(status) in (204, 304) or 100 <= int(status) < 200:
+            body = b''
+        else:
+            body = await self.__reader.read()
+            headers['Connection'] = 'close'
+
+        if headers.get('Content-Encoding', '').lower() == 'gzip':
+            body = gzip.decompress(body)
+        return HttpResponse(int(status), reason, headers, body)
+
+    async def __read_chunked_body(self) -> bytes:
+        chunks = []
+        while True:
+            size = int((await self.__reader.readline()).split(b';', 1)[0].strip(), 16)
+            if size == 0:
+                # Skip trailers up to the empty line.
+                while (await self.__reader.readline()).strip():
+                    pass
+                return b''.join(chunks)
+            chunks.append(await self.__reader.readexactly(size))
+            await self.__reader.readline()
+
+    def __fail_pending(self) -> None:
+        self.closed = True
+        while self.__pending:
+            future = self.__pending.popleft()
+            if not future.done():
+                future.set_exception(ConnectionClosedException('Connection to {} closed'.format(self.host)))
+        if self.__writer is not None:
+            self.__writer.close()
+        if self.on_response is not None:
+            self.on_response(self)
+
+    async def close(self) -> None:
+        if self.__writer is not None and not self.closed:
+            self.__writer.close()
+        if self.__reader_task is not None:
+            await asyncio.wait([self.__reader_task])
+
+
+class ConnectionPool:
+    """Bounded set of pipelined connections per origin. Requests prefer an
+    idle connection, then a new one, and only then queue up behind the
+    requests on the least busy connection."""
+
+    def __init__(self, max_connections: int = 4, max_pipeline_depth: int = 4,
+                 ssl_context: Optional[ssl.SSLContext] = None):
+        self.__max_connections = max_connections
+        self.__max_pipeline_depth = max_pipeline_depth
+        self.__ssl_context = ssl_context
+        self.__connections = {}  # type: Dict[Tuple[str, str, int], List[PipelinedConnection]]
+        self.__slot_freed = None
+        self.opened_connections = 0
+
+    def __condition(self) -> asyncio.Condition:
+        if self.__slot_freed is None:
+            self.__slot_freed = asyncio.Condition()
+        return self.__slot_freed
+
+    def __notify(self, _connection) -> None:
+        asyncio.ensure_future(self.__notify_waiting())
+
+    async def __notify_waiting(self) -> None:
+        async with self.__condition():
+            self.__condition().notify_all()
+
+    async def acquire(self, scheme: str, host: str, port: int) -> PipelinedConnection:
+        """Returns the connection the next request to the origin should use."""
+        key = (scheme, host, port)
+        async with self.__condition():
+            while True:
+                connections = [connection for connection in self.__connections.get(key, [])
+                               if not connection.closed]
+                self.__connections[key] = connections
+                least_busy = min(connections, key=lambda connection: connection.in_flight, default=None)
+                if least_busy is not None and least_busy.in_flight == 0:
+                    return least_busy
+                if len(connections) < self.__max_connections:
+                    connection = PipelinedConnection(host, port, scheme == 'https', self.__ssl_context)
+                    connection.on_response = self.__notify
+                    await connection.open()
+                    self.opened_connections += 1
+                    connections.append(connection)
+                    return connection
+                if least_busy.in_flight < self.__max_pipeline_depth:
+                    return least_busy
+                await self.__condition().wait()
+
+    async def close(self) -> None:
+        for connections in self.__connections.values():
+            for connection in connections:
+                await connection.close()
+        self.__connections = {}
+
+
+class AsyncGithubSession:
+    """Encapsulates an asyncio session on the GitHub API with the same
+    rate tracking as GithubSession, allowing many requests to be in flight
+    at once while sharing a bounded number of keep-alive connections."""
+
+    def __init__(self, wait_if_rate_exceeded: bool = False, min_rate_threshold_before_sleep: int = 5,
+                 max_connections: int = 4, max_pipeline_depth: int = 4, api_root: str = API_ROOT,
+                 ssl_context: Optional[ssl.SSLContext] = None):
+        self.__tokens = TokenPool()
+        self.__should_sleep = wait_if_rate_exceeded
+        self.__rate_threshold = min_rate_threshold_before_sleep
+        self.__api_root = api_root.rstrip('/')
+        self.__pool = ConnectionPool(max_connections, max_pipeline_depth, ssl_context)
+        self.__headers = {
+            'User-Agent': USER_AGENT,
+            'Accept': 'application/vnd.github.v3+json',
+            'Accept-Encoding': 'gzip',
+        }
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        await self.close()
+
+    @property
+    def rate(self) -> int:
+        """Remaining requests summed up over all tokens.
+
+        Is None if the the rate is not definitely known."""
+        return self.__tokens.rate
+
+    @property
+    def rate_reset_time(self) -> datetime:
+        """Earliest UTC time at which the rate of a token is reset.
+
+        Is None if the the rate is not definitely known."""
+        return self.__tokens.rate_reset_time
+
+    @property
+    def opened_connections(self) -> int:
+        """Number of connections opened over the lifetime of the session."""
+        return self.__pool.opened_connections
+
+    def set_credentials(self, personal_access_token: str = None, personal_access_tokens: Iterable[str] = ()) -> None:
+        """Sets the token, or several tokens whose quotas are used one after
+        another, to identify itself to the GitHub API."""
+        tokens = list(personal_access_tokens)
+        if personal_access_token is not None:
+            tokens.insert(0, personal_access_token)
+        self.__tokens = TokenPool(tokens)
+
+    async def request_api(self, path="/") -> Tuple[Mapping, MutableMapping, str]:
+        """Sends a get request against GitHub's API against the specified endpoint."""
+        if path[0] != '/':
+            path = '/' + path
+        return await self.request_url(self.__api_root + path)
+
+    async def request_url(self, url: str) -> Tuple[Mapping, MutableMapping, str]:
+        """Sends a get request against the given URL of GitHub's API."""
+        response = await self.send('GET', url)
+        text = response.body.decode('utf-8')
+        return loads(text), response.headers, text
+
+    async def send(self, method: str, url: str, body: bytes = b'',
+                   headers: Optional[Mapping[str, str]] = None) -> HttpResponse:
+        """Sends a request through the pool and tracks the rate it reports.
+        Requests whose connection closed before an answer arrived are retried."""
+        await self.sleep_if_needed()
+        parts = urlsplit(url)
+        port = parts.port or (443 if parts.scheme == 'https' else 80)
+        target = parts.path or '/'
+        if parts.query:
+            target += '?' + parts.query
+        token = self.__tokens.select()
+        request_headers = dict(self.__headers)
+        if token is not None:
+            request_headers['Authorization'] = "token {0}".format(token)
+        request_headers.update(headers or {})
+
+        try:
+            for attempt in range(MAX_RETRIES_ON_CLOSED_CONNECTION + 1):
+                connection = await self.__pool.acquire(parts.scheme, parts.hostname, port)
+                try:
+                    response = await connection.request(method, target, request_headers, body)
+                    break
+                except ConnectionClosedException:
+                    if attempt == MAX_RETRIES_ON_CLOSED_CONNECTION:
+                        raise
+        except Exception:
+            self.__tokens.release(token)
+            raise
+        if RATE_REMAINING in response.headers and RATE_RESET in response.headers:
+            self.__tokens.update(token, int(response.headers[RATE_REMAINING]),
+                                 utc_from_timestamp(int(response.headers[RATE_RESET])))
+        else:
+            self.__tokens.release(token)
+        return response
+
+    async def sleep_if_needed(self) -> None:
+        """Suspends the calling coroutine until the earliest reset if every
+        token dropped below the threshold. Other coroutines keep running meanwhile."""
+        reset_time = self.__tokens.exhausted_until(self.__rate_threshold)
+        if reset_time is not None:
+            wait_time = max((reset_time - datetime.utcnow()).total_seconds(), 0) + 3
+            LOGGER.warning('Rate reached %s/%s, hibernating for %s seconds until %s (plus a bit)',
+                           self.rate, self.__rate_threshold, wait_time, reset_time.isoformat())
+            await asyncio.sleep(wait_time)
+
+    async def close(self) -> None:
+        await self.__pool.close()
@@ -0,0 +1,150 @@
+"""Compact, array-backed representation of a repository's commit graph."""
+from array import array
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple
+
+SHA_BYTES = 20
+NOT_RECORDED = -1
+
+
+def commit_dict_for(parent_shas: List[str], message: Optional[str]) -> dict:
+    """Builds the per-commit dict of the JSON result, which only carries
+    'parents' if there are any."""
+    commit_dict = {}
+    if parent_shas:
+        commit_dict['parents'] = parent_shas
+    if message is not None:
+        commit_dict['message'] = message
+    return commit_dict
+
+
+class CommitGraph:
+    """Interns 20-byte binary SHAs into consecutive indexes and keeps parent
+    links, messages and the visited state in flat arrays instead of holding
+    one dict per commit keyed by its hex SHA.
+
+    Parent links of all commits share one integer array, messages share one
+    UTF-8 buffer and visited commits are tracked in a bitmap."""
+
+    def __init__(self):
+        self.__index = {}  # type: Dict[bytes, int]
+        self.__shas = bytearray()
+        self.__visited = bytearray()
+        self.__parent_start = array('q')
+        self.__parent_count = array('l')
+        self.__parent_links = array('l')
+        self.__message_start = array('q')
+        self.__message_length = array('q')
+        self.__messages = bytearray()
+        self.__commit_order = array('l')
+
+    def __len__(self) -> int:
+        """Number of interned SHAs, including parents whose data was not added yet."""
+        return len(self.__shas) // SHA_BYTES
+
+    def __contains__(self, sha: str) -> bool:
+        return self.is_visited(sha)
+
+    @property
+    def commit_count(self) -> int:
+        """Number of commits added with their data."""
+        return len(self.__commit_order)
+
+    def intern(self, sha: str) -> int:
+        """Returns the index of the given hex SHA, assigning the next free one if it is new."""
+        binary_sha = bytes.fromhex(sha)
+        if len(binary_sha) != SHA_BYTES:
+            raise ValueError('Expected a SHA-1 with {} bytes, got {}'.format(SHA_BYTES, sha))
+        index = self.__index.get(binary_sha)
+        if index is None:
+            index = len(self)
+            self.__index[binary_sha] = index
+            self.__shas.extend(binary_sha)
+            self.__parent_start.append(NOT_RECORDED)
+            self.__parent_count.append(0)
+            self.__message_start.append(NOT_RECORDED)
+            self.__message_length.append(NOT_RECORDED)
+            if index % 8 == 0:
+                self.__visited.append(0)
+        return index
+
+    def index_of(self, sha: str) -> Optional[int]:
+        """Returns the index of an already interned hex SHA or None."""
+        return self.__index.get(bytes.fromhex(sha))
+
+    def sha_at(self, index: int) -> str:
+        offset = index * SHA_BYTES
+        return self.__shas[offset:offset + SHA_BYTES].hex()
+
+    def is_visited(self, sha: str) -> bool:
+        index = self.index_of(sha)
+        return index is not None and self.__is_visited_index(index)
+
+    def __is_visited_index(self, index: int) -> bool:
+        return bool(self.__visited[index >> 3] & (1 << (index & 7)))
+
+    def add_commit(self, sha: str, parent_shas: Iterable[str], message: Optional[str] = None) -> bool:
+        """Records a commit with its parents and message and marks it visited.
+
+        Returns False without changing anything if the commit was visited before."""
+        index = self.intern(sha)
+        if self.__is_visited_index(index):
+            return False
+        self.__visited[index >> 3] |= 1 << (index & 7)
+
+        parent_indexes = [self.intern(parent_sha) for parent_sha in parent_shas]
+        self.__parent_start[index] = len(self.__parent_links)
+        self.__parent_count[index] = len(parent_indexes)
+        self.__parent_links.extend(parent_indexes)
+
+        if message is not None:
+            encoded = message.encode('utf-8', errors='surrogatepass')
+            self.__message_start[index] = len(self.__messages)
+            self.__message_length[index] = len(encoded)
+            self.__messages.extend(encoded)
+
+        self.__commit_order.append(index)
+        return True
+
+    def parent_indexes(self, index: int) -> List[int]:
+        start = self.__parent_start[index]
+        if start == NOT_RECORDED:
+            return []
+        return self.__parent_links[start:start + self.__parent_count[index]].tolist()
+
+    def parents(self, sha: str) -> List[str]:
+        index = self.index_of(sha)
+        if index is None:
+            return []
+        return [self.sha_at(parent) for parent in self.parent_indexes(index)]
+
+    def message_at(self, index: int) -> Optional[str]:
+        start = self.__message_start[index]
+        if start == NOT_RECORDED:
+            return None
+        end = start + self.__message_length[index]
+        return self.__messages[start:end].decode('utf-8', errors='surrogatepass')
+
+    def message(self, sha: str) -> Optional[str]:
+        index = self.index_of(sha)
+        return None if index is None else self.message_at(index)
+
+    def iter_shas(self) -> Iterator[str]:
+        """Yields the SHA of every added commit in insertion order."""
+        for index in self.__commit_order:
+            yield self.sha_at(index)
+
+    def iter_commits(self) -> Iterator[Tuple[str, List[str], Optional[str]]]:
+        """Yields (sha, parent_shas, message) of every added commit in insertion order."""
+        for index in self.__commit_order:
+            parents = [self.sha_at(parent) for parent in self.parent_indexes(index)]
+            yield self.sha_at(index), parents, self.message_at(index)
+
+    def iter_commit_dicts(self) -> Iterator[Tuple[str, dict]]:
+        """Yields (sha, commit_dict) pairs in the shape of result_dict['commits'],
+        which only carries 'parents' if there are any."""
+        for sha, parents, message in self.iter_commits():
+            yield sha, commit_dict_for(parents, message)
+
+    def to_commits_dict(self) -> Dict[str, dict]:
+        """Materializes the graph in the JSON shape of result_dict['commits']."""
+        return dict(self.iter_commit_dicts())
@@ -0,0 +1,109 @@
+"""Persistent index of the commits crawled so far, so forks and copies of a
+repository do not walk and store their shared history again."""
+import math
+import os
+import sqlite3
+import threading
+from typing import Dict, Iterable, Optional
+
+
+class BloomFilter:
+    """Fixed size set of byte strings answering membership with false
+    positives at about error_rate once capacity keys were added, but never
+    with false negatives. Keys are expected to be hashes already, e.g.
+    binary SHAs, whose first 16 bytes serve as the two base hashes."""
+
+    def __init__(self, capacity: int, error_rate: float = 0.01):
+        self.bit_count = max(64, int(-capacity * math.log(error_rate) / math.log(2) ** 2))
+        self.hash_count = max(1, round(self.bit_count / max(capacity, 1) * math.log(2)))
+        self.__bits = bytearray((self.bit_count + 7) // 8)
+
+    def __positions(self, key: bytes) -> Iterable[int]:
+        first = int.from_bytes(key[:8], 'little')
+        second = int.from_bytes(key[8:16], 'little') | 1
+        return ((first + number * second) % self.bit_count for number in range(self.hash_count))
+
+    def add(self, key: bytes) -> None:
+        for position in self.__positions(key):
+            self.__bits[position >> 3] |= 1 << (position & 7)
+
+    def __contains__(self, key: bytes) -> bool:
+        return all(self.__bits[position >> 3] & (1 << (position & 7)) for position in self.__positions(key))
+
+
+class CommitIndex:
+    """Maps the binary SHA of every crawled commit to the id of the repo
+    whose result holds it, in a SQLite table without rowids.
+
+    A Bloom filter held in memory answers most lookups of unknown commits
+    without touching the database. It is filled from the table on opening,
+    commits added by other processes afterwards are not seen until then.
+
+    Commits must only be added together with all their ancestors, so a
+    known commit stands for its whole history, see walk_unknown_commits."""
+
+    def __init__(self, path: str, expected_commits: int = 4000000, error_rate: float = 0.01):
+        directory = os.path.dirname(os.path.abspath(path))
+        os.makedirs(directory, exist_ok=True)
+        self.__lock = threading.Lock()
+        self.__connection = sqlite3.connect(path, timeout=30, isolation_level=None, check_same_thread=False)
+        self.__connection.execute('PRAGMA journal_mode=WAL')
+        self.__connection.execute('PRAGMA synchronous=NORMAL')
+        self.__connection.execute('CREATE TABLE IF NOT EXISTS commits ('
+                                  ' sha BLOB PRIMARY KEY,'
+                                  ' repo_id INTEGER NOT NULL) WITHOUT ROWID')
+        self.__bloom = BloomFilter(max(expected_commits, len(self)), error_rate)
+        for (binary_sha,) in self.__connection.execute('SELECT sha FROM commits'):
+            self.__bloom.add(binary_sha)
+        self.lookups = 0
+        self.false_positives = 0
+
+    def __len__(self) -> int:
+        return self.__connection.execute('SELECT COUNT(*) FROM commits').fetchone()[0]
+
+    def __contains__(self, sha: str) -> bool:
+        return self.repo_of(sha) is not None
+
+    def repo_of(self, sha: str) -> Optional[int]:
+        """Returns the id of the repo whose result holds the commit, None if it was not crawled."""
+        binary_sha = bytes.fromhex(sha)
+        if binary_sha not in self.__bloom:
+            return None
+        with self.__lock:
+            self.lookups += 1
+            row = self.__connection.execute('SELECT repo_id FROM commits WHERE sha = ?', (binary_sha,)).fetchone()
+            if row is None:
+                self.false_positives += 1
+                return None
+        return row[0]
+
+    def repos_of(self, shas: Iterable[str]) -> Dict[str, int]:
+        """Returns the repo ids of those of the commits that were crawled."""
+        repos = {}
+        for sha in shas:
+            repo_id = self.repo_of(sha)
+            if repo_id is not None:
+                repos[sha] = repo_id
+        return repos
+
+    def add(self, repo_id: int, shas: Iterable[str]) -> int:
+        """Records the commits as held by the result of repo_id, keeping the
+        repo of commits known before. Returns the number of new commits."""
+        with self.__lock:
+            changes_before = self.__connection.total_changes
+            self.__connection.execute('BEGIN IMMEDIATE')
+            try:
+                for sha in shas:
+                    binary_sha = bytes.fromhex(sha)
+                    self.__connection.execute('INSERT OR IGNORE INTO commits (sha, repo_id) VALUES (?, ?)',
+                                              (binary_sha, repo_id))
+                    self.__bloom.add(binary_sha)
+                self.__connection.execute('COMMIT')
+            except BaseException:
+                self.__connection.execute('ROLLBACK')
+                raise
+            return self.__connection.total_changes - changes_before
+
+    def close(self) -> None:
+        with self.__lock:
+            self.__connection.close()
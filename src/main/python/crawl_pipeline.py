@@ -0,0 +1,134 @@
+"""Runs work items through stages connected by bounded queues, every stage
+with threads of its own, so a stage waiting, e.g. on API quota, does not
+stop the others from working off what they already got."""
+import logging
+import queue
+import threading
+import time
+from typing import Callable, List, Optional, Sequence
+
+from crawler_metrics import REGISTRY, MetricsRegistry
+
+LOGGER = logging.getLogger(__name__)
+
+_STOP = object()
+
+
+class PipelineStage:
+    """A step of the pipeline. function gets an item and returns the item
+    for the next stage, or None if the item is finished early. queue_size
+    bounds the items waiting for this stage."""
+
+    def __init__(self, name: str, function: Callable, concurrency: int = 1, queue_size: int = 8):
+        self.name = name
+        self.function = function
+        self.concurrency = concurrency
+        self.queue_size = queue_size
+
+
+class CrawlPipeline:
+    """Passes every submitted item through the stages in order. Items leaving
+    the last stage, or finished early by one, go to on_done, items whose
+    stage raised go to on_failed together with the exception.
+
+    A full queue blocks the stage feeding it, down to submit, so the
+    slowest stage sets the pace without items piling up in between."""
+
+    def __init__(self, stages: Sequence[PipelineStage], on_done: Callable, on_failed: Callable,
+                 metrics: Optional[MetricsRegistry] = None):
+        if not stages:
+            raise ValueError('A pipeline needs at least one stage')
+        self.__stages = list(stages)
+        self.__on_done = on_done
+        self.__on_failed = on_failed
+        self.__metrics = metrics if metrics is not None else REGISTRY
+        self.__queues = [queue.Queue(maxsize=stage.queue_size) for stage in self.__stages]
+        self.__in_flight = 0
+        self.__in_flight_changed = threading.Condition()
+        self.done = 0
+        self.failed = 0
+        self.__threads = []  # type: List[threading.Thread]
+        for position, stage in enumerate(self.__stages):
+            for number in range(stage.concurrency):
+                thread = threading.Thread(target=self.__work, args=(position,),
+                                          name='raq_{}_{}'.format(stage.name, number), daemon=True)
+                thread.start()
+                self.__threads.append(thread)
+
+    @property
+    def in_flight(self) -> int:
+        """Number of submitted items not done or failed yet."""
+        with self.__in_flight_changed:
+            return self.__in_flight
+
+    def submit(self, item) -> None:
+        """Hands the item to the first stage, waiting while its queue is full."""
+        with self.__in_flight_changed:
+            self.__in_flight += 1
+        self.__put(0, item)
+
+    def __put(self, position: int, item) -> None:
+        self.__queues[position].put(item)
+        self.__metrics.set('raq_stage_queue_depth', self.__queues[position].qsize(),
+                           {'stage': self.__stages[position].name})
+
+    def __work(self, position: int) -> None:
+        stage = self.__stages[position]
+        stage_queue = self.__queues[position]
+        while True:
+            item = stage_queue.get()
+            if item is _STOP:
+                return
+            start = time.perf_counter()
+            try:
+                result = stage.function(item)
+            except Exception as stage_error:
+                LOGGER.exception('Stage %s failed', stage.name)
+                self.__finish(True, item, stage_error)
+                continue
+            finally:
+                self.__metrics.observe('raq_stage_seconds', time.perf_counter() - start, {'stage': stage.name})
+            if result is None:
+                self.__finish(False, item)
+            elif position + 1 < len(self.__stages):
+                self.__put(position + 1, result)
+            else:
+                self.__finish(False, result)
+
+    def __finish(self, failed: bool, item, stage_error: Optional[Exception] = None) -> None:
+        try:
+            if failed:
+                self.__on_failed(item, stage_error)
+            else:
+                self.__on_done(item)
+        except Exception:
+            LOGGER.exception('Finishing a pipeline item failed')
+        with self.__in_flight_changed:
+            if failed:
+                self.failed += 1
+            else:
+                self.done += 1
+            self.__in_flight -= 1
+            self.__in_flight_changed.notify_all()
+
+    def close(self, timeout: Optional[float] = None) -> None:
+        """Waits until every submitted item is done or failed, at most timeout
+        seconds, then stops the stage threads."""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self.__in_flight_changed:
+            while self.__in_flight > 0:
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    LOGGER.warning('Closing the pipeline with %s items in flight', self.__in_flight)
+                    break
+                self.__in_flight_changed.wait(remaining)
+            abandoned = self.__in_flight
+        for position, stage in enumerate(self.__stages):
+            for _ in range(stage.concurrency):
+                try:
+                    self.__queues[position].put(_STOP, timeout=1)
+                except queue.Full:
+                    pass
+        if not abandoned:
+            for thread in self.__threads:
+                thread.join()
@@ -0,0 +1,92 @@
+"""Structured JSON logging written from a background thread."""
+import json
+import logging
+import logging.handlers
+import queue
+import sys
+from datetime import datetime
+from typing import Mapping, Optional
+
+CONFIG_LEVEL = 45
+logging.addLevelName(CONFIG_LEVEL, 'CONFIG')
+
+# Levels of the former print based log() in main.py.
+LEGACY_LEVELS = {
+    1: logging.ERROR,
+    2: logging.WARNING,
+    3: logging.WARNING,
+    4: logging.INFO,
+    5: logging.DEBUG,
+    6: logging.DEBUG,
+}
+
+_RECORD_ATTRIBUTES = frozenset(vars(logging.LogRecord('', 0, '', 0, '', (), None))) | {'message', 'asctime'}
+
+
+class JsonFormatter(logging.Formatter):
+    """Formats every record as a single line JSON object. Fields passed as
+    extra are added to the object, so they can be indexed."""
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            'time': datetime.utcfromtimestamp(record.created).isoformat() + 'Z',
+            'level': record.levelname,
+            'logger': record.name,
+            'caller': record.funcName,
+            'thread': record.threadName,
+            'message': record.getMessage(),
+        }
+        for key, value in record.__dict__.items():
+            if key not in _RECORD_ATTRIBUTES:
+                entry[key] = value
+        if record.exc_info:
+            entry['exception'] = self.formatException(record.exc_info)
+        elif record.exc_text:
+            entry['exception'] = record.exc_text
+        return json.dumps(entry, default=str)
+
+
+class DeferredQueueHandler(logging.handlers.QueueHandler):
+    """Hands records to the listener thread after merging their arguments,
+    leaving the JSON formatting to the listener."""
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+
+def start_logging(level: int = logging.INFO, stream=None) -> logging.handlers.QueueListener:
+    """Routes all records of at least level through a queue to a thread
+    writing them as JSON lines to stream (stderr by default). Returns the
+    listener, stop it to flush the remaining records."""
+    records = queue.Queue(-1)
+    stream_handler = logging.StreamHandler(stream if stream is not None else sys.stderr)
+    stream_handler.setFormatter(JsonFormatter())
+    listener = logging.handlers.QueueListener(records, stream_handler)
+    root = logging.getLogger()
+    for handler in list(root.handlers):
+        root.removeHandler(handler)
+    root.addHandler(DeferredQueueHandler(records))
+    root.setLevel(level)
+    listener.start()
+    return listener
+
+
+def log_for_caller(logger: logging.Logger, level: int, msg, args: tuple,
+                   fields: Optional[Mapping] = None, depth: int = 2) -> None:
+    """Logs msg % args on behalf of the function depth frames up the stack.
+
+    The level is checked before anything else and the message is only
+    formatted if the record gets written. Unlike Logger.findCaller this takes
+    the caller's frame directly instead of walking the stack."""
+    if not logger.isEnabledFor(level):
+        return
+    frame = sys._getframe(depth)
+    code = frame.f_code
+    record = logger.makeRecord(logger.name, level, code.co_filename, frame.f_lineno, msg, args, None,
+                               func=code.co_name, extra=fields)
+    logger.handle(record)
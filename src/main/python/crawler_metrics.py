@@ -0,0 +1,223 @@
+"""Counters, gauges and histograms of the crawler, exported as a Prometheus
+textfile or sent to a StatsD collector."""
+import logging
+import os
+import socket
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+from typing import Dict, Iterator, List, Mapping, Optional, Sequence, Tuple
+
+SECONDS_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600, 1800)
+BYTES_BUCKETS = tuple(1024 * 4 ** exponent for exponent in range(13))
+RATE_BUCKETS = (10, 100, 1000, 5000, 10000, 25000, 50000, 100000, 250000)
+
+LOGGER = logging.getLogger(__name__)
+
+LabelKey = Tuple[Tuple[str, str], ...]
+
+
+def label_key(labels: Optional[Mapping[str, str]]) -> LabelKey:
+    return tuple(sorted((key, str(value)) for key, value in labels.items())) if labels else ()
+
+
+class Histogram:
+    """Cumulative bucket counts, sum and count of observed values."""
+
+    def __init__(self, buckets: Sequence[float]):
+        self.buckets = tuple(sorted(buckets))
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float) -> None:
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def cumulative_counts(self) -> List[Tuple[str, int]]:
+        """Pairs of upper bound and number of values below it, ending with '+Inf'."""
+        total = 0
+        result = []
+        for bound, count in zip(list(self.buckets) + ['+Inf'], self.counts):
+            total += count
+            result.append((bound if bound == '+Inf' else repr(float(bound)), total))
+        return result
+
+
+class MetricsRegistry:
+    """Holds the metrics of one worker process. Listeners, e.g. a
+    StatsdSender, get every update as it happens."""
+
+    def __init__(self):
+        self.__lock = threading.Lock()
+        self.__counters = {}  # type: Dict[str, Dict[LabelKey, float]]
+        self.__gauges = {}  # type: Dict[str, Dict[LabelKey, float]]
+        self.__histograms = {}  # type: Dict[str, Dict[LabelKey, Histogram]]
+        self.__listeners = []
+
+    def add_listener(self, listener) -> None:
+        self.__listeners.append(listener)
+
+    def inc(self, name: str, value: float = 1, labels: Optional[Mapping[str, str]] = None) -> None:
+        """Increases a counter."""
+        key = label_key(labels)
+        with self.__lock:
+            series = self.__counters.setdefault(name, {})
+            series[key] = series.get(key, 0) + value
+        for listener in self.__listeners:
+            listener.counter(name, value, key)
+
+    def set(self, name: str, value: float, labels: Optional[Mapping[str, str]] = None) -> None:
+        """Sets a gauge."""
+        key = label_key(labels)
+        with self.__lock:
+            self.__gauges.setdefault(name, {})[key] = value
+        for listener in self.__listeners:
+            listener.gauge(name, value, key)
+
+    def observe(self, name: str, value: float, labels: Optional[Mapping[str, str]] = None,
+                buckets: Sequence[float] = SECONDS_BUCKETS) -> None:
+        """Adds a value to a histogram, whose buckets are fixed by its first observation."""
+        key = label_key(labels)
+        with self.__lock:
+            series = self.__histograms.setdefault(name, {})
+            if key not in series:
+                series[key] = Histogram(buckets)
+            series[key].observe(value)
+        for listener in self.__listeners:
+            listener.histogram(name, value, key)
+
+    @contextmanager
+    def timer(self, name: str, labels: Optional[Mapping[str, str]] = None) -> Iterator[None]:
+        """Observes the seconds spent in the with block, also if it raises."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start, labels)
+
+    def counter_value(self, name: str, labels: Optional[Mapping[str, str]] = None) -> float:
+        with self.__lock:
+            return self.__counters.get(name, {}).get(label_key(labels), 0)
+
+    def gauge_value(self, name: str, labels: Optional[Mapping[str, str]] = None) -> Optional[float]:
+        with self.__lock:
+            return self.__gauges.get(name, {}).get(label_key(labels))
+
+    def histogram_count(self, name: str, labels: Optional[Mapping[str, str]] = None) -> int:
+        with self.__lock:
+            histogram = self.__histograms.get(name, {}).get(label_key(labels))
+            return histogram.count if histogram is not None else 0
+
+    def prometheus_text(self) -> str:
+        """Renders all metrics in the Prometheus text exposition format."""
+        lines = []
+        with self.__lock:
+            for name in sorted(self.__counters):
+                lines.append('# TYPE {} counter'.format(name))
+                for key, value in sorted(self.__counters[name].items()):
+                    lines.append('{}{} {}'.format(name, format_labels(key), repr(float(value))))
+            for name in sorted(self.__gauges):
+                lines.append('# TYPE {} gauge'.format(name))
+                for key, value in sorted(self.__gauges[name].items()):
+                    lines.append('{}{} {}'.format(name, format_labels(key), repr(float(value))))
+            for name in sorted(self.__histograms):
+                lines.append('# TYPE {} histogram'.format(name))
+                for key, histogram in sorted(self.__histograms[name].items()):
+                    for bound, count in histogram.cumulative_counts():
+                        lines.append('{}_bucket{} {}'.format(name, format_labels(key + (('le', bound),)), count))
+                    lines.append('{}_sum{} {}'.format(name, format_labels(key), repr(histogram.sum)))
+                    lines.append('{}_count{} {}'.format(name, format_labels(key), histogram.count))
+        return '\n'.join(lines) + '\n'
+
+
+def format_labels(key: LabelKey) -> str:
+    if not key:
+        return ''
+    return '{' + ','.join('{}="{}"'.format(name, escape_label_value(value)) for name, value in key) + '}'
+
+
+def escape_label_value(value: str) -> str:
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+class PrometheusTextfileExporter:
+    """Writes the registry every interval seconds to path, atomically, for
+    the textfile collector of the node exporter to pick up."""
+
+    def __init__(self, registry: MetricsRegistry, path: str, interval: float = 15):
+        self.__registry = registry
+        self.__path = path
+        self.__interval = interval
+        self.__stopped = threading.Event()
+        self.__thread = None
+
+    def export(self) -> None:
+        temporary_path = self.__path + '.tmp'
+        with open(temporary_path, 'w') as textfile:
+            textfile.write(self.__registry.prometheus_text())
+        os.replace(temporary_path, self.__path)
+
+    def start(self) -> None:
+        self.__thread = threading.Thread(target=self.__run, name='raq_metrics_export', daemon=True)
+        self.__thread.start()
+
+    def __run(self) -> None:
+        while not self.__stopped.wait(self.__interval):
+            try:
+                self.export()
+            except OSError as export_error:
+                LOGGER.warning('Exporting metrics to %s failed: %s', self.__path, export_error)
+
+    def stop(self) -> None:
+        """Stops the periodic export and writes the final state."""
+        self.__stopped.set()
+        if self.__thread is not None:
+            self.__thread.join()
+        self.export()
+
+
+class StatsdSender:
+    """Sends every update as a StatsD packet over UDP, histograms as timers
+    ('ms', seconds converted to milliseconds) so the collector aggregates
+    their percentiles. Label values are appended
+    to the metric name, e.g. raq.tasks_total.repo.ok. Sending never blocks
+    and lost packets are ignored."""
+
+    def __init__(self, address: str, prefix: str = 'raq'):
+        host, _, port = address.partition(':')
+        self.__target = (host or '127.0.0.1', int(port) if port else 8125)
+        self.__prefix = prefix
+        self.__socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.__socket.setblocking(False)
+
+    def __name(self, name: str, key: LabelKey) -> str:
+        parts = [self.__prefix, name[len('raq_'):] if name.startswith('raq_') else name]
+        parts.extend(value.replace('.', '_').replace(':', '_').replace('|', '_') for _, value in key)
+        return '.'.join(part for part in parts if part)
+
+    def __send(self, line: str) -> None:
+        try:
+            self.__socket.sendto(line.encode('utf-8'), self.__target)
+        except OSError:
+            pass
+
+    def counter(self, name: str, value: float, key: LabelKey) -> None:
+        self.__send('{}:{}|c'.format(self.__name(name, key), value))
+
+    def gauge(self, name: str, value: float, key: LabelKey) -> None:
+        self.__send('{}:{}|g'.format(self.__name(name, key), value))
+
+    def histogram(self, name: str, value: float, key: LabelKey) -> None:
+        if name.endswith('_seconds'):
+            self.__send('{}:{:.3f}|ms'.format(self.__name(name[:-len('_seconds')], key), value * 1000))
+        else:
+            self.__send('{}:{}|ms'.format(self.__name(name, key), value))
+
+    def close(self) -> None:
+        self.__socket.close()
+
+
+REGISTRY = MetricsRegistry()
@@ -0,0 +1,59 @@
+"""Clones repositories with strategies that skip data the crawler never reads."""
+from subprocess import run
+from typing import List, Optional
+
+# The crawler only reads commit meta data, everything but 'full' avoids
+# writing a working tree and the filtered strategies also skip
+# downloading blobs or trees altogether.
+CLONE_STRATEGIES = {
+    'full': [],
+    'no_checkout': ['--no-checkout'],
+    'bare': ['--bare'],
+    'blobless': ['--bare', '--filter=blob:none'],
+    'treeless': ['--bare', '--filter=tree:0'],
+}
+
+# Mirrors keep the branches only, fetched into the same names.
+MIRROR_REFSPEC = '+refs/heads/*:refs/heads/*'
+
+
+class UnknownCloneStrategyException(Exception):
+    """Exception thrown when a configured clone strategy does not exist."""
+    pass
+
+
+def strategy_arguments(strategy: str) -> List[str]:
+    """Returns the git clone arguments of a strategy."""
+    if strategy not in CLONE_STRATEGIES:
+        raise UnknownCloneStrategyException('Unknown clone strategy {}, use one of {}'.format(
+            strategy, ', '.join(sorted(CLONE_STRATEGIES))))
+    return CLONE_STRATEGIES[strategy]
+
+
+def clone_command(clone_url: str, target_path: str, strategy: str = 'full', depth: Optional[int] = None) -> List[str]:
+    """Returns the git clone command for the given strategy and optional history depth."""
+    command = ['git', 'clone'] + strategy_arguments(strategy)
+    if depth:
+        command.append('--depth={}'.format(int(depth)))
+    command.extend([clone_url, target_path])
+    return command
+
+
+def mirror_command(clone_url: str, target_path: str, strategy: str = 'bare') -> List[str]:
+    """Returns the git command cloning a bare mirror of the branches, keeping
+    the object filter of the given strategy so incremental fetches stay
+    partial as well. Unlike git clone --mirror it leaves out refs/pull/* and
+    other refs the crawler never walks, see mirror_fetch_command."""
+    filters = [argument for argument in strategy_arguments(strategy) if argument.startswith('--filter=')]
+    return ['git', 'clone', '--bare'] + filters + [clone_url, target_path]
+
+
+def mirror_fetch_command() -> List[str]:
+    """Returns the git command updating a mirror to the branches of its origin."""
+    return ['git', 'fetch', '--prune', '--quiet', 'origin', MIRROR_REFSPEC]
+
+
+def clone_repository(clone_url: str, target_path: str, strategy: str = 'full', depth: Optional[int] = None) -> None:
+    """Clones clone_url into target_path, raising CalledProcessError if git fails."""
+    process = run(clone_command(clone_url, target_path, strategy, depth), universal_newlines=True)
+    process.check_returncode()
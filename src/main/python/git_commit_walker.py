@@ -0,0 +1,152 @@
+"""Streams the commit history of a local git repository in a single pass."""
+import tempfile
+from subprocess import DEVNULL, PIPE, Popen, run
+from typing import Container, Iterable, Iterator, List, Optional, Set, Tuple
+
+# Every commit is printed as "<sha>\0<parent shas>\0<raw message>\0".
+# Commit messages can not contain NUL bytes, which makes it a safe delimiter.
+COMMIT_RECORD_FORMAT = '--format=%H%x00%P%x00%B'
+FIELDS_PER_COMMIT = 3
+EXIT_CODE_NO_HISTORY = 128
+
+
+class GitLogFailedException(Exception):
+    """Exception thrown when the git log process terminates unsuccessfully
+    after it already started to report commits."""
+    pass
+
+
+def decode_commit_message(raw_message: bytes) -> str:
+    """Decodes a raw commit message the same way the per-commit `git show`
+    path did, so the results stay comparable. Falls back to UTF-8 for messages
+    unicode-escape can't handle, e.g. ones ending in a single backslash."""
+    try:
+        return raw_message.decode('unicode-escape')
+    except UnicodeDecodeError:
+        return raw_message.decode('utf-8', errors='replace')
+
+
+def git_log_command(revisions: Iterable[str] = ('HEAD',)) -> List[str]:
+    """Returns the git command listing every commit reachable from revisions.
+
+    The mailmap is disabled as bare repositories read it from HEAD's tree,
+    which would make partial clones fetch trees lazily."""
+    return ['git', '--no-pager', '-c', 'log.showSignature=false', '-c', 'log.mailmap=false',
+            'log', '-z', COMMIT_RECORD_FORMAT] + list(revisions) + ['--']
+
+
+def has_history(repo_path: str, revision: str = 'HEAD') -> bool:
+    """Tells whether revision resolves to a commit in the repository."""
+    verify = run(['git', 'rev-parse', '--verify', '--quiet', revision + '^{commit}'],
+                 cwd=repo_path, stdout=DEVNULL, stderr=DEVNULL)
+    return verify.returncode == 0
+
+
+def head_shas(repo_path: str) -> List[str]:
+    """Returns the SHA HEAD points to as single item list, empty if there is no history yet."""
+    head = run(['git', 'rev-parse', '--verify', '--quiet', 'HEAD^{commit}'], cwd=repo_path,
+               stdout=PIPE, stderr=DEVNULL, universal_newlines=True)
+    return [head.stdout.strip()] if head.returncode == 0 else []
+
+
+def is_shallow(repo_path: str) -> bool:
+    """Tells whether the repository was cloned with a limited history depth."""
+    shallow = run(['git', 'rev-parse', '--is-shallow-repository'], cwd=repo_path,
+                  stdout=PIPE, stderr=DEVNULL, universal_newlines=True)
+    return shallow.stdout.strip() == 'true'
+
+
+def walk_commits(repo_path: str, revisions: Iterable[str] = ('HEAD',), chunk_size: int = 1 << 16,
+                 running_pids: Optional[Set[int]] = None) -> Iterator[Tuple[str, List[str], str]]:
+    """Yields (sha, parent_shas, message) for every commit reachable from the
+    given revisions, read from one long running git log process. Its pid is
+    in running_pids while it runs, e.g. to watch its memory.
+
+    Yields nothing if the repository has no history yet."""
+    # stderr goes to a file, a full pipe would block git while it is read
+    # from stdout only.
+    stderr_file = tempfile.TemporaryFile()
+    try:
+        process = Popen(git_log_command(revisions), cwd=repo_path, stdout=PIPE, stderr=stderr_file)
+    except BaseException:
+        stderr_file.close()
+        raise
+    if running_pids is not None:
+        running_pids.add(process.pid)
+    yielded_any = False
+    try:
+        fields = []
+        remainder = b''
+        while True:
+            chunk = process.stdout.read(chunk_size)
+            if not chunk:
+                break
+            tokens = (remainder + chunk).split(b'\x00')
+            remainder = tokens.pop()
+            for token in tokens:
+                fields.append(token)
+                if len(fields) == FIELDS_PER_COMMIT:
+                    raw_sha, raw_parents, raw_message = fields
+                    fields = []
+                    parents = raw_parents.decode('ascii').split()
+                    yielded_any = True
+                    yield raw_sha.decode('ascii'), parents, decode_commit_message(raw_message)
+
+        return_code = process.wait()
+        stderr_file.seek(0)
+        stderr = stderr_file.read()
+        if return_code == EXIT_CODE_NO_HISTORY and not yielded_any and not has_history(repo_path):
+            return
+        if return_code != 0:
+            raise GitLogFailedException('git log exited with {} in {}: {}'.format(
+                return_code, repo_path, stderr.decode('utf-8', errors='replace')))
+    finally:
+        if process.poll() is None:
+            process.kill()
+            process.wait()
+        if running_pids is not None:
+            running_pids.discard(process.pid)
+        process.stdout.close()
+        stderr_file.close()
+
+
+def walk_unknown_commits(repo_path: str, known_commits: Container[str], boundary: Set[str],
+                         revisions: Iterable[str] = ('HEAD',), max_restarts: int = 16, chunk_size: int = 1 << 16,
+                         running_pids: Optional[Set[int]] = None) -> Iterator[Tuple[str, List[str], str]]:
+    """Yields (sha, parent_shas, message) like walk_commits, but only for
+    commits not in known_commits, and stops descending at known ones.
+
+    Every known commit is expected to come with all its ancestors known. The
+    known commits the walk runs into first are added to boundary and the walk
+    restarts from revisions with the boundary excluded (git log ^<boundary>
+    ...), at most max_restarts times. Known commits found after that
+    are skipped one by one. Commits already yielded are not yielded again."""
+    revisions = list(revisions)
+    yielded = set()
+    below_boundary = set()
+    excluded = []
+    while True:
+        # Exclusions come first, a --not among the revisions would turn them into inclusions.
+        walk = walk_commits(repo_path, ['^' + sha for sha in excluded] + revisions, chunk_size, running_pids)
+        restart = False
+        try:
+            for sha, parent_shas, message in walk:
+                if sha in known_commits:
+                    # Parents mostly follow their children, ancestors of a
+                    # boundary commit are not boundary commits themselves.
+                    if sha not in below_boundary:
+                        boundary.add(sha)
+                        if len(excluded) < max_restarts:
+                            excluded.append(sha)
+                            restart = True
+                            break
+                    below_boundary.update(parent_shas)
+                    continue
+                binary_sha = bytes.fromhex(sha)
+                if binary_sha not in yielded:
+                    yielded.add(binary_sha)
+                    yield sha, parent_shas, message
+        finally:
+            walk.close()
+        if not restart:
+            return
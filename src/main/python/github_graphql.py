@@ -0,0 +1,260 @@
+"""Fetches repository meta data and languages of many repositories per
+GraphQL query, shaped like the responses of the REST API."""
+import logging
+from typing import Dict, Iterable, List, Mapping, Optional, Tuple
+
+from github_session import GithubSession, GRAPHQL_URL
+
+DEFAULT_BATCH_SIZE = 50
+REST_API_ROOT = 'https://api.github.com'
+
+REPOSITORY_FRAGMENT = '''
+fragment RepoFields on Repository {
+  id
+  databaseId
+  name
+  nameWithOwner
+  owner { __typename id login url avatarUrl ... on User { databaseId } ... on Organization { databaseId } }
+  isPrivate
+  visibility
+  isTemplate
+  url
+  description
+  isFork
+  createdAt
+  updatedAt
+  pushedAt
+  sshUrl
+  mirrorUrl
+  homepageUrl
+  diskUsage
+  stargazers { totalCount }
+  primaryLanguage { name }
+  watchers { totalCount }
+  hasIssuesEnabled
+  hasProjectsEnabled
+  hasWikiEnabled
+  hasDiscussionsEnabled
+  forkingAllowed
+  webCommitSignoffRequired
+  forkCount
+  isArchived
+  isDisabled
+  issues(states: OPEN) { totalCount }
+  pullRequests(states: OPEN) { totalCount }
+  licenseInfo { id key name spdxId url }
+  defaultBranchRef { name }
+  repositoryTopics(first: 100) { nodes { topic { name } } }
+  languages(first: 100, orderBy: {field: SIZE, direction: DESC}) { edges { size node { name } } }
+}
+'''
+
+# URLs of GET /repos/{owner}/{repo}, all below the repository's API URL.
+REPO_URL_TEMPLATES = {
+    'forks_url': '/forks',
+    'keys_url': '/keys{/key_id}',
+    'collaborators_url': '/collaborators{/collaborator}',
+    'teams_url': '/teams',
+    'hooks_url': '/hooks',
+    'issue_events_url': '/issues/events{/number}',
+    'events_url': '/events',
+    'assignees_url': '/assignees{/user}',
+    'branches_url': '/branches{/branch}',
+    'tags_url': '/tags',
+    'blobs_url': '/git/blobs{/sha}',
+    'git_tags_url': '/git/tags{/sha}',
+    'git_refs_url': '/git/refs{/sha}',
+    'trees_url': '/git/trees{/sha}',
+    'statuses_url': '/statuses/{sha}',
+    'languages_url': '/languages',
+    'stargazers_url': '/stargazers',
+    'contributors_url': '/contributors',
+    'subscribers_url': '/subscribers',
+    'subscription_url': '/subscription',
+    'commits_url': '/commits{/sha}',
+    'git_commits_url': '/git/commits{/sha}',
+    'comments_url': '/comments{/number}',
+    'issue_comment_url': '/issues/comments{/number}',
+    'contents_url': '/contents/{+path}',
+    'compare_url': '/compare/{base}...{head}',
+    'merges_url': '/merges',
+    'archive_url': '/{archive_format}{/ref}',
+    'downloads_url': '/downloads',
+    'issues_url': '/issues{/number}',
+    'pulls_url': '/pulls{/number}',
+    'milestones_url': '/milestones{/number}',
+    'notifications_url': '/notifications{?since,all,participating}',
+    'labels_url': '/labels{/name}',
+    'releases_url': '/releases{/id}',
+    'deployments_url': '/deployments',
+}
+
+# URLs of the owner in GET /repos/{owner}/{repo}, all below the owner's API URL.
+OWNER_URL_TEMPLATES = {
+    'followers_url': '/followers',
+    'following_url': '/following{/other_user}',
+    'gists_url': '/gists{/gist_id}',
+    'starred_url': '/starred{/owner}{/repo}',
+    'subscriptions_url': '/subscriptions',
+    'organizations_url': '/orgs',
+    'repos_url': '/repos',
+    'events_url': '/events{/privacy}',
+    'received_events_url': '/received_events',
+}
+
+LOGGER = logging.getLogger(__name__)
+
+
+class GraphQLBatchFailedException(Exception):
+    """Exception thrown when a batch query returned no data at all."""
+    pass
+
+
+def build_batch_query(full_names: List[str]) -> Tuple[str, Dict[str, str]]:
+    """Builds one query with an aliased repository lookup per full name."""
+    parameters = []
+    lookups = []
+    variables = {}
+    for index, full_name in enumerate(full_names):
+        owner, name = full_name.split('/', 1)
+        variables['o{}'.format(index)] = owner
+        variables['n{}'.format(index)] = name
+        parameters.append('$o{0}: String!, $n{0}: String!'.format(index))
+        lookups.append('  r{0}: repository(owner: $o{0}, name: $n{0}) {{ ...RepoFields }}'.format(index))
+    query = 'query({}) {{\n{}\n}}\n{}'.format(', '.join(parameters), '\n'.join(lookups), REPOSITORY_FRAGMENT)
+    return query, variables
+
+
+def _total(node: Optional[Mapping]) -> int:
+    return node['totalCount'] if node else 0
+
+
+def rest_shaped_owner(owner: Mapping) -> dict:
+    """Maps the owner of a GraphQL repository node to the owner in GET /repos/{owner}/{repo}."""
+    owner_url = '{}/users/{}'.format(REST_API_ROOT, owner['login'])
+    shaped = {
+        'login': owner['login'],
+        'id': owner.get('databaseId'),
+        'node_id': owner.get('id'),
+        'avatar_url': owner.get('avatarUrl'),
+        'gravatar_id': '',
+        'url': owner_url,
+        'html_url': owner['url'],
+        'type': owner['__typename'],
+        'site_admin': False,
+    }
+    shaped.update((key, owner_url + path) for key, path in OWNER_URL_TEMPLATES.items())
+    return shaped
+
+
+def rest_shaped_meta(node: Mapping) -> dict:
+    """Maps a GraphQL repository node to the fields of GET /repos/{owner}/{repo}.
+
+    GraphQL has no counterpart of has_downloads, has_pages, network_count,
+    permissions and the parent and source repositories of forks, those are
+    left out."""
+    full_name = node['nameWithOwner']
+    api_url = '{}/repos/{}'.format(REST_API_ROOT, full_name)
+    owner = rest_shaped_owner(node['owner'])
+    license_info = node.get('licenseInfo')
+    stargazers = _total(node.get('stargazers'))
+    open_issues = _total(node.get('issues')) + _total(node.get('pullRequests'))
+    visibility = node.get('visibility')
+    topics = node.get('repositoryTopics') or {'nodes': []}
+    meta = {
+        'id': node['databaseId'],
+        'node_id': node['id'],
+        'name': node['name'],
+        'full_name': full_name,
+        'private': node['isPrivate'],
+        'owner': owner,
+        'html_url': node['url'],
+        'description': node['description'],
+        'fork': node['isFork'],
+        'url': api_url,
+        'created_at': node['createdAt'],
+        'updated_at': node['updatedAt'],
+        'pushed_at': node['pushedAt'],
+        'git_url': 'git://github.com/{}.git'.format(full_name),
+        'ssh_url': node['sshUrl'],
+        'clone_url': node['url'] + '.git',
+        'svn_url': node['url'],
+        'mirror_url': node['mirrorUrl'],
+        'homepage': node['homepageUrl'],
+        'size': node['diskUsage'],
+        'stargazers_count': stargazers,
+        'watchers_count': stargazers,
+        'language': node['primaryLanguage']['name'] if node.get('primaryLanguage') else None,
+        'has_issues': node['hasIssuesEnabled'],
+        'has_projects': node.get('hasProjectsEnabled'),
+        'has_wiki': node['hasWikiEnabled'],
+        'has_discussions': node.get('hasDiscussionsEnabled'),
+        'forks_count': node['forkCount'],
+        'archived': node['isArchived'],
+        'disabled': node['isDisabled'],
+        'open_issues_count': open_issues,
+        'license': {
+            'key': license_info['key'],
+            'name': license_info['name'],
+            'spdx_id': license_info['spdxId'],
+            'url': license_info['url'],
+            'node_id': license_info.get('id'),
+        } if license_info else None,
+        'allow_forking': node.get('forkingAllowed'),
+        'is_template': node.get('isTemplate'),
+        'web_commit_signoff_required': node.get('webCommitSignoffRequired'),
+        'topics': [topic_node['topic']['name'] for topic_node in topics['nodes']],
+        'visibility': visibility.lower() if visibility else ('private' if node['isPrivate'] else 'public'),
+        'forks': node['forkCount'],
+        'open_issues': open_issues,
+        'watchers': stargazers,
+        'default_branch': node['defaultBranchRef']['name'] if node.get('defaultBranchRef') else None,
+        'temp_clone_token': None,
+        'subscribers_count': _total(node.get('watchers')),
+    }
+    meta.update((key, api_url + path) for key, path in REPO_URL_TEMPLATES.items())
+    if owner['type'] == 'Organization':
+        meta['organization'] = owner
+    return meta
+
+
+def rest_shaped_languages(node: Mapping) -> Dict[str, int]:
+    """Maps the languages of a GraphQL repository node to GET /repos/{owner}/{repo}/languages."""
+    return {edge['node']['name']: edge['size'] for edge in node['languages']['edges']}
+
+
+class GraphQLRepoFetcher:
+    """Fetches meta data and languages of up to batch_size repositories per
+    query, instead of two REST requests per repository."""
+
+    def __init__(self, github_session: GithubSession, batch_size: int = DEFAULT_BATCH_SIZE,
+                 url: str = GRAPHQL_URL):
+        self.__session = github_session
+        self.__batch_size = int(batch_size)
+        self.__url = url
+        self.queries = 0
+
+    def fetch_many(self, full_names: Iterable[str]) -> Dict[str, Optional[Tuple[dict, dict]]]:
+        """Maps every full name to its (meta, languages) dicts, or None if the
+        repository could not be resolved, e.g. because it was deleted."""
+        full_names = list(dict.fromkeys(full_names))
+        results = {}
+        for start in range(0, len(full_names), self.__batch_size):
+            batch = full_names[start:start + self.__batch_size]
+            results.update(self.__fetch_batch(batch))
+        return results
+
+    def __fetch_batch(self, full_names: List[str]) -> Dict[str, Optional[Tuple[dict, dict]]]:
+        query, variables = build_batch_query(full_names)
+        body, _, _ = self.__session.request_graphql(query, variables, url=self.__url)
+        self.queries += 1
+        data = body.get('data')
+        if not data:
+            raise GraphQLBatchFailedException('GraphQL batch returned no data: {}'.format(body.get('errors')))
+        for graphql_error in body.get('errors') or []:
+            LOGGER.debug('GraphQL batch error: %s', graphql_error.get('message'))
+        results = {}
+        for index, full_name in enumerate(full_names):
+            node = data.get('r{}'.format(index))
+            results[full_name] = (rest_shaped_meta(node), rest_shaped_languages(node)) if node else None
+        return results
@@ -1,26 +1,243 @@
 """Encasulation of Github-API and session management."""
+import fcntl
+import logging
+import multiprocessing
+import tempfile
+import threading
 import time
-from datetime import datetime
+from contextlib import contextmanager
+from datetime import datetime, timezone
 from json import loads
-from typing import MutableMapping, Mapping, Tuple
+from typing import Iterable, List, MutableMapping, Mapping, Optional, Tuple
 
 from requests import Session
 
+from crawler_metrics import REGISTRY, MetricsRegistry
+from response_cache import ResponseCache
+
 RATE_REMAINING = 'X-RateLimit-Remaining'
 RATE_LIMIT = 'X-RateLimit-Limit'
 RATE_RESET = 'X-RateLimit-Reset'
+OK = 200
+NOT_MODIFIED = 304
+GRAPHQL_URL = 'https://api.github.com/graphql'
+EPOCH = datetime(1970, 1, 1)
+
+LOGGER = logging.getLogger(__name__)
+
+
+def utc_from_timestamp(timestamp: float) -> datetime:
+    """Returns the naive UTC datetime of a POSIX timestamp, as the
+    deprecated datetime.utcfromtimestamp did."""
+    return datetime.fromtimestamp(timestamp, timezone.utc).replace(tzinfo=None)
+
+
+class TokenState:
+    """Quota of a single personal access token as last reported by GitHub."""
+
+    def __init__(self, token: Optional[str]):
+        self.token = token
+        self.rate = None
+        self.reset_time = None
+        self.reserved = 0
+
+    def headroom(self, now: datetime) -> float:
+        """Requests left for this token minus those in flight, unknown or
+        already reset quotas count as unlimited."""
+        if self.rate is None or self.reset_time is None or self.reset_time <= now:
+            return float('inf')
+        return self.rate - self.reserved
+
+
+class SharedTokenState(TokenState):
+    """TokenState kept in shared memory, seen and changed by all processes
+    forked after it was created. Occupies FIELDS slots of the array.
+
+    Reservations are counted per worker in one slot of the reservations
+    array each, so those of a worker that died can be dropped. The process
+    changes the count of worker, see TokenPool.use_worker."""
+
+    FIELDS = 2
+
+    def __init__(self, token: Optional[str], slots, index: int, reservations, workers: int):
+        self.__slots = slots
+        self.__offset = index * self.FIELDS
+        self.__reservations = reservations
+        self.__reservations_offset = index * workers
+        self.__workers = workers
+        self.worker = 0
+        super().__init__(token)
+
+    @property
+    def rate(self) -> Optional[int]:
+        rate = self.__slots[self.__offset]
+        return None if rate < 0 else int(rate)
+
+    @rate.setter
+    def rate(self, rate: Optional[int]) -> None:
+        self.__slots[self.__offset] = -1 if rate is None else rate
+
+    @property
+    def reset_time(self) -> Optional[datetime]:
+        timestamp = self.__slots[self.__offset + 1]
+        return utc_from_timestamp(timestamp) if timestamp > 0 else None
+
+    @reset_time.setter
+    def reset_time(self, reset_time: Optional[datetime]) -> None:
+        self.__slots[self.__offset + 1] = (reset_time - EPOCH).total_seconds() if reset_time is not None else 0
+
+    @property
+    def reserved(self) -> int:
+        start = self.__reservations_offset
+        return sum(self.__reservations[start:start + self.__workers])
+
+    @reserved.setter
+    def reserved(self, reserved: int) -> None:
+        # Other workers' reservations stay, the count of this one can not drop below 0.
+        own = self.__reservations_offset + self.worker
+        self.__reservations[own] = max(self.__reservations[own] + reserved - self.reserved, 0)
+
+    def drop_reservations(self, worker: int) -> None:
+        self.__reservations[self.__reservations_offset + worker] = 0
+
+
+class ProcessLock:
+    """Lock shared by the threads of all processes forked after its
+    creation. Unlike a multiprocessing.Lock it is released by the kernel
+    when the process holding it dies, so a killed worker can not leave the
+    others waiting forever."""
+
+    def __init__(self):
+        self.__thread_lock = threading.Lock()
+        self.__file = tempfile.TemporaryFile()
+
+    def __enter__(self) -> 'ProcessLock':
+        self.__thread_lock.acquire()
+        try:
+            # POSIX record locks belong to the process, the threads of one
+            # process are kept apart by the thread lock.
+            fcntl.lockf(self.__file, fcntl.LOCK_EX)
+        except BaseException:
+            self.__thread_lock.release()
+            raise
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        try:
+            fcntl.lockf(self.__file, fcntl.LOCK_UN)
+        finally:
+            self.__thread_lock.release()
+
+
+class TokenPool:
+    """Tracks remaining quota and reset time per personal access token and
+    hands out the token with the most headroom.
+
+    Selecting a token reserves one request of its quota, so concurrent
+    requests spread over all tokens instead of piling onto the same one.
+    A pool without tokens sends unauthenticated requests.
+
+    A shared pool keeps quotas and reservations in shared memory behind a
+    process lock, so up to workers worker processes forked off after its
+    creation draw on one view of the quota instead of each spending it
+    blindly. Each of them calls use_worker with its number first."""
+
+    def __init__(self, tokens: Iterable[Optional[str]] = (), shared: bool = False, workers: int = 1):
+        tokens = list(tokens) or [None]
+        if shared:
+            slots = multiprocessing.RawArray('d', len(tokens) * SharedTokenState.FIELDS)
+            reservations = multiprocessing.RawArray('i', len(tokens) * workers)
+            self.__states = [SharedTokenState(token, slots, index, reservations, workers)
+                             for index, token in enumerate(tokens)]  # type: List[TokenState]
+            self.__lock = ProcessLock()
+        else:
+            self.__states = [TokenState(token) for token in tokens]
+            self.__lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self.__states)
+
+    def use_worker(self, worker: int) -> None:
+        """Counts the reservations of this process as those of worker in a shared pool."""
+        for state in self.__states:
+            state.worker = worker
+
+    def drop_reservations(self, worker: int) -> None:
+        """Drops the reservations of a worker that exited, e.g. one killed
+        while its requests were in flight, in a shared pool."""
+        with self.__lock:
+            for state in self.__states:
+                if isinstance(state, SharedTokenState):
+                    state.drop_reservations(worker)
+
+    def select(self) -> Optional[str]:
+        """Returns the token with the most requests left and reserves one of them."""
+        with self.__lock:
+            now = datetime.utcnow()
+            state = max(self.__states, key=lambda candidate: candidate.headroom(now))
+            state.reserved += 1
+            return state.token
+
+    def update(self, token: Optional[str], rate: int, reset_time: datetime) -> None:
+        """Records the quota GitHub reported in the response to a request sent
+        with token and releases the request's reservation."""
+        with self.__lock:
+            for state in self.__states:
+                if state.token == token:
+                    # Responses of concurrent requests arrive in any order, within
+                    # one rate window the lowest remaining count is the latest.
+                    if state.rate is not None and state.reset_time == reset_time:
+                        rate = min(rate, state.rate)
+                    state.rate = rate
+                    state.reset_time = reset_time
+                    state.reserved = max(state.reserved - 1, 0)
+
+    def release(self, token: Optional[str]) -> None:
+        """Releases the reservation of a request that did not get a response."""
+        with self.__lock:
+            for state in self.__states:
+                if state.token == token:
+                    state.reserved = max(state.reserved - 1, 0)
+
+    def __known_states(self) -> List[TokenState]:
+        return [state for state in self.__states if state.rate is not None]
+
+    @property
+    def rate(self) -> Optional[int]:
+        """Sum of the requests left over all tokens with a known quota, None if no quota is known."""
+        with self.__lock:
+            known = self.__known_states()
+            return sum(state.rate for state in known) if known else None
+
+    @property
+    def rate_reset_time(self) -> Optional[datetime]:
+        """Earliest reset time of all tokens with a known quota, None if no quota is known."""
+        with self.__lock:
+            known = self.__known_states()
+            return min(state.reset_time for state in known) if known else None
+
+    def exhausted_until(self, threshold: int) -> Optional[datetime]:
+        """Returns the earliest reset time if every token dropped below threshold, otherwise None."""
+        with self.__lock:
+            now = datetime.utcnow()
+            if any(state.headroom(now) >= threshold for state in self.__states):
+                return None
+            return min(state.reset_time for state in self.__states)
 
 
 class GithubSession:
     """Encapsulates Session on GitHub API for easy resource tracking and
     easier navigation by reducing redundancy."""
 
-    def __init__(self, wait_if_rate_exceeded: bool = False, min_rate_threshold_before_sleep: int = 5):
-        self.__rate = None
-        self.__rater_reset_time = None
+    def __init__(self, wait_if_rate_exceeded: bool = False, min_rate_threshold_before_sleep: int = 5,
+                 response_cache: Optional[ResponseCache] = None, metrics: Optional[MetricsRegistry] = None):
+        self.__tokens = TokenPool()
+        self.__graphql_tokens = TokenPool()
         self.__session = Session()
         self.__should_sleep = wait_if_rate_exceeded
         self.__rate_threshold = min_rate_threshold_before_sleep
+        self.__response_cache = response_cache
+        self.__metrics = metrics if metrics is not None else REGISTRY
 
     def __del__(self):
         self.__session.close()
@@ -29,10 +246,10 @@ class GithubSession:
     @property
     def rate(self) -> int:
         """Maximum rate of requests this GithubAdapter is able to
-        send with its current configuration.
+        send with its current configuration, summed up over all tokens.
 
         Is None if the the rate is not definitely known."""
-        return self.__rate
+        return self.__tokens.rate
 
     @property
     def rate_reset_time(self) -> datetime:
@@ -40,7 +257,11 @@ class GithubSession:
         send with its current configuration.
 
         Is None if the the rate is not definitely known."""
-        return self.__rater_reset_time
+        return self.__tokens.rate_reset_time
+
+    @property
+    def response_cache(self) -> Optional[ResponseCache]:
+        return self.__response_cache
 
     def request_api(self, path="/") -> Tuple[Mapping, MutableMapping, str]:
         """Sends a get request against GitHub's API against the specified endpoint."""
@@ -52,37 +273,127 @@ class GithubSession:
         return self.request_url(url)
 
     def request_url(self, url) -> Tuple[Mapping, MutableMapping, str]:
-        """Sends a get request against GitHub's API against the specified endpoint."""
+        """Sends a get request against GitHub's API against the specified endpoint,
+        authorized by the token with the most requests left.
+
+        With a response cache the request is conditional and a cached body is
+        served if GitHub answers '304 Not Modified'."""
 
         self.sleep_if_needed()
 
-        response = self.__session.get(url)
-        json_body, headers = loads(response.text), response.headers
-        self.__rate = int(headers[RATE_REMAINING])
+        token = self.__tokens.select()
+        cached = self.__response_cache.lookup(url) if self.__response_cache is not None else None
+        request_headers = ResponseCache.conditional_headers(cached)
+        if token is not None:
+            request_headers["Authorization"] = "token {0}".format(token)
+        try:
+            with self.__measured('rest') as measurement:
+                response = self.__session.get(url, headers=request_headers)
+                measurement['status'] = response.status_code
+        except Exception:
+            self.__tokens.release(token)
+            raise
+        headers = response.headers
+        if response.status_code == NOT_MODIFIED and cached is not None:
+            self.__response_cache.record_not_modified()
+            text = cached['body']
+        else:
+            text = response.text
+            if self.__response_cache is not None and response.status_code == OK:
+                self.__response_cache.store(url, headers.get('ETag'), headers.get('Last-Modified'), text)
+        json_body = loads(text)
 
         # The X-RateLimit-Reset header shows UTC [non-milli]seconds,
         # which is exactly what datetime wants.
-        self.__rater_reset_time = datetime.utcfromtimestamp(int(headers[RATE_RESET]))
+        self.__tokens.update(token, int(headers[RATE_REMAINING]),
+                             utc_from_timestamp(int(headers[RATE_RESET])))
+        self.__metrics.set('raq_github_rate_remaining', self.__tokens.rate, {'kind': 'rest'})
+
+        return json_body, headers, text
+
+    @contextmanager
+    def __measured(self, kind: str):
+        """Observes the latency of a request and counts it by its status,
+        which the with block puts into the yielded dict."""
+        measurement = {'status': 'error'}
+        start = time.perf_counter()
+        try:
+            yield measurement
+        finally:
+            self.__metrics.observe('raq_github_request_seconds', time.perf_counter() - start, {'kind': kind})
+            self.__metrics.inc('raq_github_requests_total', labels={'kind': kind, 'status': measurement['status']})
+
+    def set_credentials(self, personal_access_token: str = None, personal_access_tokens: Iterable[str] = ()) -> None:
+        """Sets the token, or several tokens whose quotas are used one after
+        another, to identify itself to the GitHub API."""
+        tokens = list(personal_access_tokens)
+        if personal_access_token is not None:
+            tokens.insert(0, personal_access_token)
+        self.__tokens = TokenPool(tokens)
+        self.__graphql_tokens = TokenPool(tokens)
+
+    def use_token_pools(self, tokens: TokenPool, graphql_tokens: TokenPool) -> None:
+        """Draws on the given pools for REST and GraphQL requests, e.g. ones
+        shared with other processes, see shared_token_pools."""
+        self.__tokens = tokens
+        self.__graphql_tokens = graphql_tokens
 
-        return json_body, headers, response.text
+    def request_graphql(self, query: str, variables: Optional[Mapping] = None,
+                        url: str = GRAPHQL_URL) -> Tuple[Mapping, MutableMapping, str]:
+        """Posts a GraphQL query, authorized by the token with the most GraphQL
+        quota left. GraphQL has a rate limit of its own, which is tracked apart
+        from the REST one."""
+        self.__sleep_until_reset(self.__graphql_tokens)
 
-    def set_credentials(self, personal_access_token: str) -> None:
-        """Sets headers permanently, according to the given token,
-        to identify itself to the GitHub API."""
-        token_string = "token {0}".format(personal_access_token)
-        self.__session.headers.update({"Authorization": token_string})
-        self.__rate = None
-        self.__rater_reset_time = None
+        token = self.__graphql_tokens.select()
+        request_headers = {"Authorization": "bearer {0}".format(token)} if token is not None else {}
+        try:
+            with self.__measured('graphql') as measurement:
+                response = self.__session.post(url, json={'query': query, 'variables': variables or {}},
+                                               headers=request_headers)
+                measurement['status'] = response.status_code
+        except Exception:
+            self.__graphql_tokens.release(token)
+            raise
+        headers = response.headers
+        if RATE_REMAINING in headers and RATE_RESET in headers:
+            self.__graphql_tokens.update(token, int(headers[RATE_REMAINING]),
+                                         utc_from_timestamp(int(headers[RATE_RESET])))
+            self.__metrics.set('raq_github_rate_remaining', self.__graphql_tokens.rate, {'kind': 'graphql'})
+        else:
+            self.__graphql_tokens.release(token)
+        return loads(response.text), headers, response.text
+
+    @property
+    def graphql_rate(self) -> int:
+        """Remaining GraphQL points summed up over all tokens, None if not known."""
+        return self.__graphql_tokens.rate
 
     def sleep_if_needed(self):
-        if self.__rate is not None and self.__rate < self.__rate_threshold:
+        """Sleeps until the earliest reset if every token dropped below the threshold."""
+        self.__sleep_until_reset(self.__tokens)
+
+    def __sleep_until_reset(self, tokens: TokenPool):
+        reset_time = tokens.exhausted_until(self.__rate_threshold)
+        if reset_time is not None:
             hibernate_start = datetime.utcnow()
-            wait_time = (hibernate_start - self.rate_reset_time).seconds
+            wait_time = max(int((reset_time - hibernate_start).total_seconds()), 0)
             wait_time += 3
-            print('Rate reached {}/{}'.format(self.__rate, self.__rate_threshold))
-            print('Current UTC: {}'.format(hibernate_start.isoformat()))
-            print("Hibernating for {} seconds until {} (plus a bit)".format(
-                wait_time, self.rate_reset_time.isoformat())
-            )
+            LOGGER.warning('Rate reached %s/%s on all %s tokens at %s UTC, hibernating for %s seconds until %s '
+                           '(plus a bit)', tokens.rate, self.__rate_threshold, len(tokens),
+                           hibernate_start.isoformat(), wait_time, reset_time.isoformat())
             time.sleep(wait_time)
-            print('Done hibernating since {}'.format(hibernate_start.isoformat()))
+            LOGGER.info('Done hibernating since %s', hibernate_start.isoformat())
+
+
+def shared_token_pools(tokens: Iterable[str], workers: int = 1) -> Tuple[TokenPool, TokenPool]:
+    """Creates the REST and the GraphQL TokenPool of the tokens in shared
+    memory, for up to workers processes forked afterwards to share their quota."""
+    tokens = list(tokens)
+    return TokenPool(tokens, shared=True, workers=workers), TokenPool(tokens, shared=True, workers=workers)
+
+
+def github_tokens_from_config(config: Mapping) -> List[str]:
+    """Reads the comma separated tokens of github_tokens, falling back to github_token."""
+    raw_tokens = config.get('github_tokens') or config.get('github_token') or ''
+    return [token.strip() for token in raw_tokens.split(',') if token.strip()]
@@ -1,51 +1,74 @@
 """Runs the Crawler with configuration given by the environment."""
 import datetime
-import ftplib
-import inspect
-import json
+import itertools
+import logging
 import os
+import queue
 import random
 import shutil
 import string
 import sys
-from subprocess import PIPE, run
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import ExitStack, contextmanager
+from functools import partial
+from subprocess import CalledProcessError
 
 import boto3
 from botocore import exceptions
 
-from github_session import GithubSession
+from admission import ROUTE_LARGE, SKIP, AdmissionPolicy, BudgetExceededException, run_within_budget
+from commit_graph import CommitGraph
+from commit_index import CommitIndex
+from crawl_pipeline import CrawlPipeline, PipelineStage
+from crawler_logging import CONFIG_LEVEL, LEGACY_LEVELS, log_for_caller, start_logging
+from crawler_metrics import (BYTES_BUCKETS, RATE_BUCKETS, REGISTRY as METRICS, PrometheusTextfileExporter,
+                             StatsdSender)
+from git_commit_walker import (GitLogFailedException, has_history, head_shas, is_shallow, walk_commits,
+                               walk_unknown_commits)
+from git_clone import clone_command, clone_repository
+from github_graphql import DEFAULT_BATCH_SIZE, GraphQLRepoFetcher
+from github_session import GithubSession, github_tokens_from_config, shared_token_pools
+from message_queue import MessageLeaseKeeper, NoMessagesAfterLongPollingAvailableException, SqliteMessageQueue
+from mirror_cache import MirrorCache, directory_size
+from refill_planner import follow_up_refills, ids_in_range, plan_ranges
+from response_cache import ResponseCache
+from result_bundler import ResultBundler
+from result_writer import create_result_writer
 from sqs_queue_capsuling import SqsMessageQueue
+from supervisor import WorkerSupervisor
+from upload_pipeline import FtpsUploader, UploadPipeline
+from watermark_store import WatermarkStore
 
+LOGGER = logging.getLogger('raq_crawler')
 
-def debug(*objects, sep=' ', end='\n', file=sys.stdout, flush=False):
-    log(*objects, sep=' ', end='\n', file=sys.stdout, flush=False, level=5)
+MSG_VISIBILITY_TIMEOUT = 30
 
+# Paths of state only one process may own, every supervised worker gets its own.
+WORKER_PATH_KEYS = ('mirror_cache_path', 'response_cache_path', 'upload_spool_path', 'bundles_path',
+                    'metrics_textfile_path')
+# Limits of that state, configured for all workers together and split among them.
+WORKER_LIMIT_KEYS = ('mirror_cache_max_bytes', 'mirror_cache_max_entries', 'response_cache_max_bytes')
 
-def info(*objects, sep=' ', end='\n', file=sys.stdout, flush=False):
-    log(*objects, sep=' ', end='\n', file=sys.stdout, flush=False, level=4)
 
+def debug(msg, *args, **fields):
+    log_for_caller(LOGGER, logging.DEBUG, msg, args, fields)
 
-def warn(*objects, sep=' ', end='\n', file=sys.stdout, flush=False):
-    log(*objects, sep=' ', end='\n', file=sys.stdout, flush=False, level=2)
 
+def info(msg, *args, **fields):
+    log_for_caller(LOGGER, logging.INFO, msg, args, fields)
 
-def error(*objects, sep=' ', end='\n', file=sys.stdout, flush=False):
-    log(*objects, sep=' ', end='\n', file=sys.stdout, flush=False, level=1)
 
+def warn(msg, *args, **fields):
+    log_for_caller(LOGGER, logging.WARNING, msg, args, fields)
 
-def conf_info(*objects, sep=' ', end='\n', file=sys.stdout, flush=False):
-    log(*objects, sep=' ', end='\n', file=sys.stdout, flush=False, level=1)
 
+def error(msg, *args, **fields):
+    log_for_caller(LOGGER, logging.ERROR, msg, args, fields)
 
-def log(*objects, sep=' ', end='\n', file=sys.stdout, flush=False, level=6):
-    if level <= LOG_LEVEL:
-        stuff = []
-        timestamp = datetime.datetime.now().strftime('[%H:%M:%S]')
-        caller = "[{}]".format(inspect.stack()[2].function)
-        stuff.append(timestamp)
-        stuff.append(caller)
-        stuff.extend(objects)
-        print(*stuff, sep=sep, end=end, flush=flush, file=sys.stderr)
+
+def conf_info(msg, *args, **fields):
+    log_for_caller(LOGGER, CONFIG_LEVEL, msg, args, fields)
 
 
 def read_config_from_environment(stage: str = "DEV"):
@@ -60,72 +83,352 @@ def read_config_from_environment(stage: str = "DEV"):
     return conf
 
 
-def run_crawler_with_config(config, boto3_session):
-    """Instantiates connections and instances, ties them together and runs the crawler."""
+def run_crawler_with_config(config, boto3_session, token_pools=None):
+    """Instantiates connections and instances, ties them together and runs
+    the crawler. token_pools are the REST and GraphQL quota to draw on, if
+    shared with other workers, see shared_token_pools."""
     global GLOBAL
 
-    github_session = GithubSession()
-    github_session.set_credentials(personal_access_token=config['github_token'])
+    metrics_exporter = metrics_exporter_from_config(config)
+
+    github_session = GithubSession(response_cache=response_cache_from_config(config))
+    if token_pools is not None:
+        github_session.use_token_pools(*token_pools)
+    else:
+        github_session.set_credentials(personal_access_tokens=github_tokens_from_config(config))
+
+    mirror_cache = mirror_cache_from_config(config)
+    commit_index = commit_index_from_config(config)
+    watermark_store = watermark_store_from_config(config)
+    metadata_fetcher = metadata_fetcher_from_config(config, github_session)
 
-    msg_queue = SqsMessageQueue(botosession=boto3_session,
-                                wait_time=20,
-                                queue_address=config['msg_queue_address'],
-                                msg_visibility_timeout=30)
+    msg_queue = msg_queue_from_config(config, boto3_session)
+    admission_policy = admission_policy_from_config(config, boto3_session)
 
     my_prefix = 'raq_crawler_{}'.format(GLOBAL['RANDOM_ID'])
 
-    working_path = '/tmp/{}'.format(my_prefix)
+    working_path = config.get('working_path') or '/tmp/{}'.format(my_prefix)
     results_path = working_path + '/results/'
     os.makedirs(working_path)
     os.makedirs(results_path)
     GLOBAL['ORIGIN_DIR'] = working_path
-    while GLOBAL['SHOULD_RUN']:
-        os.chdir(GLOBAL['ORIGIN_DIR'])
-        message = msg_queue.pop_next_message()
-        if github_session.rate is not None:
-            info('Current rate left: {}'.format(github_session.rate))
-            info('Resets at {}'.format(github_session.rate_reset_time.isoformat()))
-        debug('Received Msg')
-        debug(message.body_raw)
-
-        if 'task_type' not in message.body_dict:
-            warn("Received Message without task_type. '{}'\nIgnoring message and deleting it.".format(message.body_raw))
-            message.delete()
-        if message.body_dict['task_type'] == 'repo':
-            handle_repo_task(github_session, message, working_path, results_path)
-            message.delete()
-        elif message.body_dict['task_type'] == 'refill':
-            handle_refill_task(github_session, message, msg_queue)
-            message.delete()
-        elif message.body_dict['task_type'] == 'kill-15':
-            error('Received kill-15 task.')
-            GLOBAL['SHOULD_RUN'] = False
-            msg_queue.write_message(message_dict={'task_type': 'kill-15'})
 
+    upload_pipeline = upload_pipeline_from_config(config, working_path + '/spool/')
+    result_bundler = result_bundler_from_config(config, working_path + '/bundles/', upload_pipeline)
+
+    # Every task in flight owns one of these directories, so taking one
+    # from the queue also bounds the number of concurrent tasks.
+    concurrency = int(config.get('concurrency', 1))
+    free_task_paths = queue.Queue()
+    for slot in range(concurrency):
+        task_path = '{}/tasks/{}'.format(working_path, slot)
+        os.makedirs(task_path)
+        free_task_paths.put(task_path)
+
+    executor = ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix='raq_task') if concurrency > 1 else None
+
+    # Holds the messages of repo tasks until their results are uploaded.
+    lease_keeper = MessageLeaseKeeper(msg_queue, msg_visibility_timeout_from_config(config))
+    # The pipeline takes over repo tasks, other tasks are still handled here.
+    repo_pipeline = None
+    if config.get('pipeline', 'false').lower() in ('1', 'true', 'yes'):
+        repo_pipeline = create_repo_pipeline(config, github_session, lease_keeper, working_path, results_path,
+                                             mirror_cache, upload_pipeline, result_bundler, commit_index,
+                                             watermark_store, admission_policy)
+    # Deferred refills stay hidden for longer than a long poll, so the worker
+    # only stops once the queue stayed empty for max_idle seconds.
+    max_idle = float(config.get('max_idle', 2 * int(config.get('refill_backoff', 60))))
+    idle_since = None
+    try:
+        while GLOBAL['SHOULD_RUN']:
+            task_path = free_task_paths.get()
+            try:
+                with METRICS.timer('raq_queue_wait_seconds'):
+                    message = msg_queue.pop_next_message()
+            except NoMessagesAfterLongPollingAvailableException:
+                free_task_paths.put(task_path)
+                idle_since = idle_since if idle_since is not None else time.monotonic()
+                if time.monotonic() - idle_since >= max_idle:
+                    info('No messages for %ss, stopping', max_idle)
+                    break
+                continue
+            finally:
+                if result_bundler is not None:
+                    result_bundler.rotate_if_due()
+            idle_since = None
+            if github_session.rate is not None:
+                info('Current rate left: %s', github_session.rate)
+                info('Resets at %s', github_session.rate_reset_time.isoformat())
+            if github_session.response_cache is not None:
+                info('Requests saved by the response cache: %s', github_session.response_cache.saved_requests)
+            debug('Received Msg')
+            debug(message.body_raw)
+
+            if repo_pipeline is not None and message.body_dict.get('task_type') == 'repo':
+                free_task_paths.put(task_path)
+                lease_keeper.hold(message)
+                repo_pipeline.submit({'message': message, 'start': time.perf_counter()})
+            # kill-15 is handled right away so no further message gets popped.
+            elif executor is None or message.body_dict.get('task_type') == 'kill-15':
+                handle_message(github_session, msg_queue, message, task_path, results_path, mirror_cache,
+                               metadata_fetcher, upload_pipeline, result_bundler, commit_index, watermark_store,
+                               admission_policy, lease_keeper)
+                free_task_paths.put(task_path)
+            else:
+                future = executor.submit(handle_message, github_session, msg_queue, message,
+                                         task_path, results_path, mirror_cache, metadata_fetcher, upload_pipeline,
+                                         result_bundler, commit_index, watermark_store, admission_policy,
+                                         lease_keeper)
+                future.add_done_callback(partial(finish_concurrent_task, free_task_paths, task_path))
+    finally:
+        if executor is not None:
+            executor.shutdown(wait=True)
+        if repo_pipeline is not None:
+            repo_pipeline.close()
+        if result_bundler is not None:
+            result_bundler.close()
+        # Messages are acknowledged as their results are uploaded, those of
+        # results left spooled are released to be delivered again.
+        upload_pipeline.close(timeout=float(config.get('upload_drain_timeout', 300)))
+        info('Uploaded %s result files, %s left spooled', upload_pipeline.uploaded,
+             upload_pipeline.failed + upload_pipeline.pending)
+        lease_keeper.close()
+        msg_queue.close()
+        if admission_policy is not None and admission_policy.large_queue is not None:
+            admission_policy.large_queue.close()
+        if commit_index is not None:
+            commit_index.close()
+        if watermark_store is not None:
+            watermark_store.close()
+        if metrics_exporter is not None:
+            metrics_exporter.stop()
+
+
+def run_supervisor_with_config(config, boto3_session):
+    """Forks workers crawler processes, one per core by default, off this
+    process, which was set up once. They share the GitHub quota through
+    shared memory, crashed ones are forked again."""
+    workers = supervised_workers(config)
+    token_pools = shared_token_pools(github_tokens_from_config(config), workers)
+    supervisor = WorkerSupervisor(partial(run_worker, config, boto3_session, token_pools), workers,
+                                  restart_delay=float(config.get('worker_restart_delay', 1)),
+                                  max_restart_delay=float(config.get('worker_max_restart_delay', 60)),
+                                  on_exit=partial(clean_up_worker, token_pools, GLOBAL['RANDOM_ID']))
+    conf_info('Supervising %s workers', workers)
+    supervisor.run()
+    info('All workers exited, %s restarts', supervisor.restarts)
+
+
+def run_worker(config, boto3_session, token_pools, slot):
+    """Runs the crawler in a process forked by the supervisor, with logging,
+    random state and a worker id of its own."""
+    global GLOBAL
 
-def upload_to_server(file_path):
+    log_listener = start_logging(logging.getLogger().level)
+    random.seed()
+    GLOBAL = dict(GLOBAL, WORKER_SLOT=slot, SUPERVISOR_ID=GLOBAL['RANDOM_ID'],
+                  RANDOM_ID=''.join(random.choices(string.ascii_letters + string.digits, k=32)))
+    conf_info("Worker %s RANDOM_ID: %s", slot, GLOBAL['RANDOM_ID'])
+    for token_pool in token_pools:
+        token_pool.use_worker(slot)
+    try:
+        run_crawler_with_config(dict(worker_config(config, slot, supervised_workers(config)),
+                                     working_path=worker_working_path(GLOBAL['SUPERVISOR_ID'], slot)),
+                                boto3_session, token_pools)
+    except Exception as e:
+        error('Worker %s crashed', slot)
+        error(e)
+        raise
+    finally:
+        log_listener.stop()
+
+
+def worker_working_path(supervisor_id, slot):
+    """Working path of the worker in slot, the same for all its restarts."""
+    return '/tmp/raq_crawler_{}-{}'.format(supervisor_id, slot)
+
+
+def clean_up_worker(token_pools, supervisor_id, slot):
+    """Drops the quota reservations and removes the working path a worker
+    left, which a killed worker could not do itself."""
+    for token_pool in token_pools:
+        token_pool.drop_reservations(slot)
+    shutil.rmtree(worker_working_path(supervisor_id, slot), ignore_errors=True)
+
+
+def supervised_workers(config):
+    """Number of workers the supervisor runs, workers or one per core."""
+    return int(config.get('workers', 0)) or os.cpu_count() or 1
+
+
+def worker_config(config, slot, workers=1):
+    """Returns the config of a supervised worker, with the paths of
+    WORKER_PATH_KEYS made its own, e.g. /cache/mirrors-0 or raq-0.prom,
+    and its share of the configured WORKER_LIMIT_KEYS, so all workers
+    together stay within them."""
+    config = dict(config)
+    for key in WORKER_PATH_KEYS:
+        if config.get(key):
+            root, extension = os.path.splitext(config[key].rstrip('/'))
+            config[key] = '{}-{}{}'.format(root, slot, extension)
+    for key in WORKER_LIMIT_KEYS:
+        if config.get(key):
+            config[key] = str(max(int(config[key]) // workers, 1))
+    return config
+
+
+def finish_concurrent_task(free_task_paths, task_path, future):
+    """Logs the failure of a concurrently handled message and frees its task directory."""
+    if future.exception() is not None:
+        error('Task failed, its message will be redelivered')
+        error(future.exception())
+    free_task_paths.put(task_path)
+
+
+def handle_message(github_session, msg_queue, message, task_path, results_path, mirror_cache=None,
+                   metadata_fetcher=None, upload_pipeline=None, result_bundler=None, commit_index=None,
+                   watermark_store=None, admission_policy=None, lease_keeper=None):
+    """Dispatches a received message to the handler of its task_type."""
+    task_type = str(message.body_dict.get('task_type'))
+    outcome = 'failed'
+    start = time.perf_counter()
+    try:
+        outcome = dispatch_message(github_session, msg_queue, message, task_path, results_path, mirror_cache,
+                                   metadata_fetcher, upload_pipeline, result_bundler, commit_index, watermark_store,
+                                   admission_policy, lease_keeper)
+    finally:
+        METRICS.observe('raq_task_seconds', time.perf_counter() - start, {'task_type': task_type})
+        METRICS.inc('raq_tasks_total', labels={'task_type': task_type, 'outcome': outcome})
+
+
+def dispatch_message(github_session, msg_queue, message, task_path, results_path, mirror_cache,
+                     metadata_fetcher, upload_pipeline, result_bundler, commit_index,
+                     watermark_store, admission_policy=None, lease_keeper=None):
+    """Handles the message according to its task_type and returns the
+    outcome of the task: 'ok', 'failed', 'skipped' or 'deferred'."""
+    global GLOBAL
+
+    if 'task_type' not in message.body_dict:
+        warn("Received Message without task_type. '%s'\nIgnoring message and deleting it.", message.body_raw)
+        message.delete()
+        return 'skipped'
+    outcome = 'ok'
+    if message.body_dict['task_type'] == 'repo':
+        if not handle_repo_task(github_session, message, task_path, results_path, mirror_cache, upload_pipeline,
+                                result_bundler, commit_index, watermark_store, admission_policy, lease_keeper):
+            outcome = 'failed'
+
+    elif message.body_dict['task_type'] == 'refill':
+        if handle_refill_task(github_session, message, msg_queue, metadata_fetcher):
+            message.delete()
+        else:
+            # Left in the queue, the refill is delivered again after the backoff.
+            outcome = 'deferred'
+            msg_queue.extend_visibility(message, int(CONFIG.get('refill_backoff', 60)))
+    elif message.body_dict['task_type'] == 'refill_plan':
+        handle_refill_plan_task(message, msg_queue)
+        message.delete()
+    elif message.body_dict['task_type'] == 'kill-15':
+        error('Received kill-15 task.')
+        GLOBAL['SHOULD_RUN'] = False
+        msg_queue.write_message(message_dict={'task_type': 'kill-15'})
+    return outcome
+
+
+def upload_to_server(file_path, on_uploaded=None, on_failed=None):
+    """Uploads a single file over a session of its own, see UploadPipeline
+    for uploading many and the callbacks."""
     if not os.path.isfile(file_path):
-        error("Source file {} does not exist")
+        error("Source file %s does not exist", file_path)
 
-    ip = CONFIG['ftp_address']
-    uname = CONFIG['ftp_user']
-    passw = CONFIG['ftp_password']
-    ftp_conn = ftplib.FTP_TLS(ip)
-    ftp_conn.login(user=uname, passwd=passw)
-    ftp_conn.prot_p()
+    uploader = ftps_uploader_from_config(CONFIG)
+    try:
+        with METRICS.timer('raq_upload_seconds'):
+            uploader.upload(file_path)
+        METRICS.observe('raq_upload_bytes', os.path.getsize(file_path), buckets=BYTES_BUCKETS)
+        METRICS.inc('raq_uploads_total', labels={'outcome': 'ok'})
+    except Exception:
+        METRICS.inc('raq_uploads_total', labels={'outcome': 'failed'})
+        if on_failed is not None:
+            on_failed(file_path)
+        raise
+    finally:
+        uploader.close()
+    if on_uploaded is not None:
+        on_uploaded(file_path)
+
+
+def metrics_exporter_from_config(config):
+    """Starts sending metrics to the StatsD collector at statsd_address and
+    exporting them to the Prometheus textfile metrics_textfile_path, if
+    configured. Returns the started textfile exporter or None."""
+    if config.get('statsd_address'):
+        METRICS.add_listener(StatsdSender(config['statsd_address'], prefix=config.get('statsd_prefix', 'raq')))
+    if not config.get('metrics_textfile_path'):
+        return None
+    exporter = PrometheusTextfileExporter(METRICS, config['metrics_textfile_path'],
+                                          interval=float(config.get('metrics_export_interval', 15)))
+    exporter.start()
+    return exporter
 
-    file_name = file_path.split('/')[-1]
 
-    target_path = "ftp/raq/results/{}".format(file_name)
+def ftps_uploader_from_config(config):
+    return FtpsUploader(config['ftp_address'], config['ftp_user'], config['ftp_password'],
+                        target_dir=config.get('ftp_target_dir', 'ftp/raq/results'))
 
-    fh = open(file_path, 'rb')
-    stor_cmd = 'STOR {}'.format(target_path)
-    ftp_conn.storbinary(stor_cmd, fh)
-    fh.close()
 
+def result_bundler_from_config(config, default_bundles_path, upload_pipeline):
+    """Creates the ResultBundler handing closed bundles to upload_pipeline if
+    result_bundling is enabled, otherwise None."""
+    if config.get('result_bundling', 'false').lower() not in ('1', 'true', 'yes'):
+        return None
+    return ResultBundler(config.get('bundles_path', default_bundles_path), config, GLOBAL,
+                         on_close=upload_pipeline.submit,
+                         compression=config.get('bundle_compression', 'gzip'),
+                         max_bytes=int(config.get('bundle_max_bytes', 64 * 1024 * 1024)),
+                         max_age=float(config.get('bundle_max_age', 600)))
+
+
+def upload_pipeline_from_config(config, default_spool_path):
+    """Creates the UploadPipeline spooling below upload_spool_path, which
+    should outlive the worker for spooled files to survive a restart."""
+    return UploadPipeline(partial(ftps_uploader_from_config, config),
+                          spool_path=config.get('upload_spool_path', default_spool_path),
+                          workers=int(config.get('upload_workers', 1)),
+                          max_attempts=int(config.get('upload_max_attempts', 5)))
+
+
+def handle_repo_task(github_session, message, working_path, results_path, mirror_cache=None, upload_pipeline=None,
+                     result_bundler=None, commit_index=None, watermark_store=None, admission_policy=None,
+                     lease_keeper=None):
+    """Crawls the repo of a repo task and hands its result over. Returns
+    False if the repo could not be cloned. The message is deleted once the
+    task is done, or with a lease_keeper held from the start, so it is not
+    delivered again however long the crawl takes, and only acknowledged
+    once its result is uploaded. It is released if the task fails."""
+    item = {'message': message}
+    if lease_keeper is not None:
+        lease_keeper.hold(message)
+    try:
+        cloned = crawl_repo_task(github_session, item, working_path, results_path, mirror_cache, upload_pipeline,
+                                 result_bundler, commit_index, watermark_store, admission_policy, lease_keeper)
+    except BaseException:
+        if lease_keeper is not None and not item.get('uploading'):
+            lease_keeper.release(message)
+        raise
+    if item.get('uploading'):
+        return cloned
+    if lease_keeper is not None:
+        lease_keeper.acknowledge(message)
+    else:
+        message.delete()
+    return cloned
 
-def handle_repo_task(github_session, message, working_path, results_path):
-    delimiter = b'\x22\x23\x24\x25\x26\x27\x28\x29\x2a\x7b'
+
+def crawl_repo_task(github_session, item, working_path, results_path, mirror_cache, upload_pipeline,
+                    result_bundler, commit_index, watermark_store, admission_policy, lease_keeper):
+    """Crawls the repo of the repo task item for handle_repo_task."""
+    message = item['message']
     try:
         task = message.body_dict['repo_task']
         info('Received repo_task')
@@ -133,130 +436,451 @@ def handle_repo_task(github_session, message, working_path, results_path):
         debug(message.message_attributes)
     except FileExistsError as e:
         error(e)
-        return 0x10
-
-    warn('Working on repo with id {}'.format(task['id']))
+        return False
 
-    result_dict = {}
+    warn('Working on repo with id %s', task['id'], repo_id=task['id'])
 
+    hand_over = partial(hand_over_repo_result, lease_keeper, upload_pipeline, result_bundler)
+    repo_meta_dict, languages_dict = resolve_repo_task(github_session, task)
+    cloned = True
+    if admit_repo(admission_policy, task, repo_meta_dict, languages_dict, results_path, result_bundler,
+                  partial(hand_over, item)):
+        budget = admission_policy.budget() if admission_policy is not None else None
+        result_path = record_crawl = None
+        try:
+            with ExitStack() as stack:
+                repo_git_path = checkout_repository(stack, repo_meta_dict, working_path + "/git_repo/",
+                                                    mirror_cache, budget)
+                cloned = repo_git_path is not None
+                if cloned:
+                    result_path, record_crawl = write_repo_result(repo_git_path, results_path, repo_meta_dict,
+                                                                  languages_dict, result_bundler, commit_index,
+                                                                  watermark_store, budget)
+        except BudgetExceededException as exceeded:
+            result_path = skip_exceeding_repo(exceeded, results_path, repo_meta_dict, languages_dict,
+                                              result_bundler)
+        if result_path is not None:
+            hand_over(item, result_path, record_crawl)
+        if cloned:
+            info('Done with task for %s', repo_meta_dict['id'], repo_id=repo_meta_dict['id'])
+    return cloned
+
+
+def resolve_repo_task(github_session, task):
+    """Returns the meta data and languages of the task's repository."""
+    if 'meta' in task and 'languages' in task:
+        # Resolved in bulk through GraphQL by the refill task.
+        return task['meta'], task['languages']
     repo_meta_dict, headers, resp_body = github_session.request_url(task['api_url'])
 
-    result_dict['meta'] = repo_meta_dict
-
-    languages_dict, languages_headers, languages_resp_body = github_session.request_url(repo_meta_dict['languages_url'])
-
-    result_dict['languages'] = languages_dict
-
+    languages_dict, languages_headers, languages_resp_body = github_session.request_url(
+        repo_meta_dict['languages_url'])
+    return repo_meta_dict, languages_dict
+
+
+def admit_repo(admission_policy, task, repo_meta_dict, languages_dict, results_path, result_bundler, hand_over):
+    """Applies the admission policy to a resolved repo task. Returns True if
+    the repo is to be crawled here, False if it was handed on to the queue
+    of large repos or skipped, handing over a result recording it was too large."""
+    if admission_policy is None:
+        return True
+    decision = admission_policy.decide(repo_meta_dict)
+    METRICS.inc('raq_admissions_total', labels={'decision': decision})
+    repo_id = repo_meta_dict['id']
+    if decision == ROUTE_LARGE:
+        info('Routing %s of %s KiB to the large repo queue', repo_id, repo_meta_dict['size'], repo_id=repo_id)
+        # Resolved already, the large repo worker does not ask the API again.
+        large_task = dict(task, meta=repo_meta_dict, languages=languages_dict)
+        admission_policy.large_queue.write_message({'task_type': 'repo', 'repo_task': large_task},
+                                                   message_attributes_dict=task_attributes())
+        return False
+    if decision == SKIP:
+        warn('Skipping %s, its %s KiB exceed max_repo_size_kb', repo_id, repo_meta_dict['size'], repo_id=repo_id)
+        hand_over(skip_repo(admission_policy.skipped(repo_meta_dict), results_path, repo_meta_dict,
+                            languages_dict, result_bundler))
+        return False
+    return True
+
+
+def skip_exceeding_repo(exceeded, results_path, repo_meta_dict, languages_dict, result_bundler=None):
+    """Records a repo whose clone or walk was aborted for exceeding its
+    budget as skipped and returns the path of the result."""
+    warn('Aborting %s, %s', repo_meta_dict['id'], exceeded, repo_id=repo_meta_dict['id'])
+    METRICS.inc('raq_budget_exceeded_total', labels={'resource': exceeded.resource})
+    return skip_repo({'reason': 'too large', 'exceeded': exceeded.resource, 'limit': exceeded.limit,
+                      'used': exceeded.used}, results_path, repo_meta_dict, languages_dict, result_bundler)
+
+
+def skip_repo(skipped, results_path, repo_meta_dict, languages_dict, result_bundler=None):
+    """Writes a result without commits recording why the repo was skipped and returns its path."""
+    result_writer = create_repo_result_writer(results_path, repo_meta_dict['id'], result_bundler)
+    with result_writer:
+        result_writer.begin(repo_meta_dict, languages_dict)
+        result_writer.finish(CONFIG, GLOBAL, {'skipped': skipped})
+    return result_writer.path
+
+
+def checkout_repository(stack, repo_meta_dict, clone_path, mirror_cache=None, budget=None):
+    """Clones the repository into clone_path, or checks it out of the mirror
+    cache, until the stack is closed. Returns the path of the repository, or
+    None if it could not be cloned. Raises BudgetExceededException if the
+    clone runs out of the budget."""
+    clone_start = time.perf_counter()
     try:
-        repo_git_path = working_path + "/git_repo/"
-        info("Cloning {} {}".format(repo_meta_dict['id'], repo_meta_dict['full_name']))
-        clone_repository_into_directory(target_path=repo_git_path, clone_url=repo_meta_dict['clone_url'])
+        info("Cloning %s %s", repo_meta_dict['id'], repo_meta_dict['full_name'], repo_id=repo_meta_dict['id'])
+        if mirror_cache is not None:
+            repo_git_path = stack.enter_context(
+                mirror_cache.checkout(repo_meta_dict['id'], repo_meta_dict['clone_url'], budget))
+        else:
+            repo_git_path = stack.enter_context(cloned_repository(clone_path, repo_meta_dict['clone_url'], budget))
+    except BudgetExceededException:
+        raise
     except Exception as e:
-        error('Aborting {}, {} because of error'.format(repo_meta_dict['id'], repo_meta_dict['full_name']))
+        error('Aborting %s, %s because of error', repo_meta_dict['id'], repo_meta_dict['full_name'],
+              repo_id=repo_meta_dict['id'])
         error(e)
-        return
-
-    os.chdir(repo_git_path)
-    initial_sha = git_log_get_initial_sha()
-
-    result_dict['commits'] = {}
-    if initial_sha is None:
         return None
-    done_shas = []
-    agenda = [initial_sha]
-    for current_sha in agenda:
-        debug('Working on sha {}'.format(current_sha))
-        if current_sha in done_shas:
-            continue
-        if current_sha == '':
-            continue
-
-        result_dict['commits'][current_sha] = {}
-
-        try:
-            parents_exit_code, parents_out = git_parent_shas_space_separated(current_sha, delimiter)
-
-            if parents_exit_code != 0:
-                pass
-            else:
-                parent_shas = parents_out.split(" ")
-                if len(parent_shas) == 1 and parent_shas[0] == '':
-                    pass
-                else:
-                    agenda.extend(parent_shas)
-                    result_dict['commits'][current_sha]['parents'] = parent_shas
-
-            message_exit_code, message_out = git_show_commit_msg(current_sha, delimiter)
-
-            if message_exit_code != 0:
-                warn("Failed git_show_commit_msg with exit code {}\nRepo {}\nSHA {}\nDelimiter {}"
-                     .format(message_exit_code, repo_meta_dict['id'], current_sha, delimiter))
-                pass
-            else:
-                result_dict['commits'][current_sha]['message'] = message_out
-                debug('Added {}'.format(message_out))
-
-        except Exception as e:
-            error("Exception occured")
-            error(e)
-        done_shas.append(current_sha)
-
-    result_dict['CONFIG'] = CONFIG
-    result_dict['GLOBAL'] = GLOBAL
+    METRICS.observe('raq_clone_seconds', time.perf_counter() - clone_start,
+                    {'source': 'mirror_cache' if mirror_cache is not None else 'clone'})
+    # Sizing a checkout means walking all its files, so only a sample of
+    # clone_bytes_sample_rate of them is measured.
+    if random.random() < float(CONFIG.get('clone_bytes_sample_rate', 0.05)):
+        METRICS.observe('raq_clone_bytes', directory_size(repo_git_path), buckets=BYTES_BUCKETS)
+    return repo_git_path
+
+
+def hand_over_result(result_path, upload_pipeline=None, result_bundler=None, on_uploaded=None, on_failed=None):
+    """Passes a finished result on to the bundle, the upload pipeline or
+    uploads it right away. on_uploaded is called with the uploaded path
+    once the result is uploaded, on_failed if it is not."""
+    if result_bundler is not None:
+        result_bundler.append(result_path, on_uploaded, on_failed)
+    elif upload_pipeline is not None:
+        upload_pipeline.submit(result_path, on_uploaded, on_failed)
+    else:
+        upload_to_server(result_path, on_uploaded, on_failed)
 
-    final_content = json.dumps(result_dict)
-    result_json_f_path = results_path + '/{}-steak.json'.format(result_dict['meta']['id'])
-    result_json_f = open(result_json_f_path, 'w')
-    result_json_f.write(final_content)
-    result_json_f.flush()
-    result_json_f.close()
 
-    shutil.rmtree(repo_git_path)
+def hand_over_repo_result(lease_keeper, upload_pipeline, result_bundler, item, result_path, on_uploaded=None):
+    """Hands over the result of the repo task item, see hand_over_result.
+    With a lease_keeper the task's message is held and marked as uploading
+    until the result is uploaded and only then acknowledged, after calling
+    on_uploaded. If the upload fails it is released, to be delivered again."""
+    if lease_keeper is None:
+        hand_over_result(result_path, upload_pipeline, result_bundler, on_uploaded)
+        return
+    item['uploading'] = True
+    lease_keeper.hold(item['message'])
+    hand_over_result(result_path, upload_pipeline, result_bundler,
+                     on_uploaded=partial(acknowledge_uploaded, lease_keeper, item['message'], on_uploaded),
+                     on_failed=partial(release_not_uploaded, lease_keeper, item['message']))
+
+
+def acknowledge_uploaded(lease_keeper, message, on_uploaded, uploaded_path):
+    if on_uploaded is not None:
+        on_uploaded(uploaded_path)
+    lease_keeper.acknowledge(message)
+
+
+def release_not_uploaded(lease_keeper, message, file_path):
+    warn('%s was not uploaded, its task will be delivered again', file_path)
+    lease_keeper.release(message)
+
+
+def create_repo_pipeline(config, github_session, lease_keeper, working_path, results_path, mirror_cache,
+                         upload_pipeline, result_bundler, commit_index, watermark_store, admission_policy=None):
+    """Creates the CrawlPipeline handling repo tasks in the stages resolve
+    (GitHub API), clone and walk, with api_concurrency, clone_concurrency and
+    walk_concurrency threads and up to pipeline_queue_size repos waiting for
+    each. Messages are held by the lease_keeper while in the pipeline.
+    Repos not admitted by the admission_policy leave after resolve."""
+    queue_size = int(config.get('pipeline_queue_size', 8))
+    hand_over = partial(hand_over_repo_result, lease_keeper, upload_pipeline, result_bundler)
+    stages = [
+        PipelineStage('resolve', partial(resolve_stage, github_session, admission_policy, results_path,
+                                         result_bundler, hand_over),
+                      int(config.get('api_concurrency', 2)), queue_size),
+        PipelineStage('clone', partial(clone_stage, working_path + '/clones', itertools.count(), mirror_cache,
+                                       admission_policy, results_path, result_bundler, hand_over),
+                      int(config.get('clone_concurrency', 4)), queue_size),
+        PipelineStage('walk', partial(walk_stage, results_path, result_bundler, commit_index, watermark_store,
+                                      hand_over),
+                      int(config.get('walk_concurrency', 2)), queue_size),
+    ]
+    return CrawlPipeline(stages, on_done=partial(finish_pipeline_item, lease_keeper),
+                         on_failed=partial(fail_pipeline_item, lease_keeper))
+
+
+def resolve_stage(github_session, admission_policy, results_path, result_bundler, hand_over, item):
+    task = item['message'].body_dict['repo_task']
+    warn('Working on repo with id %s', task['id'], repo_id=task['id'])
+    item['meta'], item['languages'] = resolve_repo_task(github_session, task)
+    if not admit_repo(admission_policy, task, item['meta'], item['languages'], results_path, result_bundler,
+                      partial(hand_over, item)):
+        return None
+    return item
 
-    upload_to_server(result_json_f_path)
 
-    info('Done with task for {}'.format(repo_meta_dict['id']))
+def clone_stage(clones_path, clone_numbers, mirror_cache, admission_policy, results_path, result_bundler, hand_over,
+                item):
+    # The budget starts with the clone and is paused while the clone waits
+    # for a walker, waiting in the pipeline does not count.
+    item['budget'] = admission_policy.budget() if admission_policy is not None else None
+    item['stack'] = ExitStack()
+    clone_path = '{}/{}/'.format(clones_path, next(clone_numbers))
+    try:
+        item['repo_git_path'] = checkout_repository(item['stack'], item['meta'], clone_path, mirror_cache,
+                                                    item['budget'])
+    except BudgetExceededException as exceeded:
+        item['stack'].close()
+        hand_over(item, skip_exceeding_repo(exceeded, results_path, item['meta'], item['languages'], result_bundler))
+        return None
+    if item['repo_git_path'] is None:
+        item['stack'].close()
+        item['outcome'] = 'failed'
+        return None
+    if item['budget'] is not None:
+        item['budget'].pause()
+    return item
 
 
-def git_log_get_initial_sha():
-    log_process = run(['git', '--no-pager', 'log', '--pretty=%H', '--max-count=1'],
-                      stdout=PIPE, encoding='utf-8', universal_newlines=True)
-    log_out = log_process.stdout
-    if log_process.returncode == 128:
-        initial_sha = None
+def walk_stage(results_path, result_bundler, commit_index, watermark_store, hand_over, item):
+    if item['budget'] is not None:
+        item['budget'].resume()
+    try:
+        with item['stack']:
+            result_path, record_crawl = write_repo_result(item['repo_git_path'], results_path, item['meta'],
+                                                          item['languages'], result_bundler, commit_index,
+                                                          watermark_store, item['budget'])
+    except BudgetExceededException as exceeded:
+        hand_over(item, skip_exceeding_repo(exceeded, results_path, item['meta'], item['languages'], result_bundler))
+        return None
+    if result_path is not None:
+        hand_over(item, result_path, record_crawl)
+    info('Done with task for %s', item['meta']['id'], repo_id=item['meta']['id'])
+    return item
+
+
+def finish_pipeline_item(lease_keeper, item):
+    """Deletes the message of a repo that went through the pipeline, also if
+    it could not be cloned, unless it waits for its result to be uploaded."""
+    if not item.get('uploading'):
+        lease_keeper.acknowledge(item['message'])
+    METRICS.observe('raq_task_seconds', time.perf_counter() - item['start'], {'task_type': 'repo'})
+    METRICS.inc('raq_tasks_total', labels={'task_type': 'repo', 'outcome': item.get('outcome', 'ok')})
+
+
+def fail_pipeline_item(lease_keeper, item, stage_error):
+    """Leaves the message of a failed repo to be delivered again once its visibility timeout is over."""
+    if 'stack' in item:
+        item['stack'].close()
+    lease_keeper.release(item['message'])
+    error('Task failed, its message will be redelivered')
+    error(stage_error)
+    METRICS.observe('raq_task_seconds', time.perf_counter() - item['start'], {'task_type': 'repo'})
+    METRICS.inc('raq_tasks_total', labels={'task_type': 'repo', 'outcome': 'failed'})
+
+
+def write_repo_result(repo_git_path, results_path, repo_meta_dict, languages_dict, result_bundler=None,
+                      commit_index=None, watermark_store=None, budget=None):
+    """Walks the history of the repository at repo_git_path into its result
+    file. Returns the path of the file and the callback recording the crawl
+    once the file is uploaded, or None if there is nothing to record. With a
+    result_bundler the file is an entry to be appended to the current bundle.
+    With a commit_index the walk stops at commits crawled before, the result
+    references their repos in known_commits instead, and the new commits are
+    indexed once the result is uploaded. With a watermark_store only the
+    commits added since the previous crawl of the repo are walked, the delta
+    result references it in previous_crawl, and the watermark of the repo is
+    moved to the uploaded result. Returns (None, None) without writing a
+    result if the heads did not move since the previous crawl.
+    With a budget the walk raises BudgetExceededException and discards the
+    result once it takes too long, or the clone and the result together
+    take up too much disk, or git log too much memory."""
+    repo_id = repo_meta_dict['id']
+    revisions = ['HEAD']
+    references = {}
+    delta_head = delta_base = None
+    if watermark_store is not None:
+        crawled_head_shas = head_shas(repo_git_path)
+        previous_crawl = watermark_store.get(repo_id)
+        if previous_crawl is not None and crawled_head_shas and crawled_head_shas == previous_crawl['head_shas']:
+            # An empty delta would only replace the previous result of the same name.
+            info('Repo %s did not change since %s', repo_id, previous_crawl['result_name'], repo_id=repo_id)
+            METRICS.inc('raq_walks_total', labels={'kind': 'unchanged'})
+            return None, None
+        if previous_crawl is not None:
+            # Heads lost to a force push can not bound the walk.
+            walked_before = [sha for sha in previous_crawl['head_shas'] if has_history(repo_git_path, sha)]
+            if walked_before:
+                revisions += ['^' + sha for sha in walked_before]
+                references['previous_crawl'] = previous_crawl
+                delta_head = crawled_head_shas[0] if crawled_head_shas else walked_before[0]
+                delta_base = walked_before[0]
+    # Commits go straight from git into the result file, the graph only
+    # remembers which SHAs were written already.
+    commit_graph = CommitGraph()
+    boundary = set()
+    walk_pids = set()
+    if commit_index is not None:
+        commits = walk_unknown_commits(repo_git_path, commit_index, boundary, revisions, running_pids=walk_pids)
     else:
-        if log_out[-1] == '\n':
-            initial_sha = log_out[:-1]
+        commits = walk_commits(repo_git_path, revisions, running_pids=walk_pids)
+    result_writer = create_repo_result_writer(results_path, repo_id, result_bundler, delta_head, delta_base)
+    clone_bytes = directory_size(repo_git_path) if budget is not None and budget.disk_bytes is not None else 0
+    # Walking and writing interleave, the time spent in the writer is
+    # summed up separately to tell serialization apart from git.
+    write_seconds = 0.0
+    walk_start = time.perf_counter()
+    walked_completely = False
+    with result_writer:
+        result_writer.begin(repo_meta_dict, languages_dict)
+        try:
+            for current_sha, parent_shas, message_out in commits:
+                if budget is not None:
+                    budget.check(lambda: clone_bytes + result_writer.written_bytes(), walk_pids)
+                debug('Working on sha %s', current_sha)
+                if commit_graph.add_commit(current_sha, parent_shas):
+                    write_start = time.perf_counter()
+                    result_writer.write_commit(current_sha, parent_shas, message_out)
+                    write_seconds += time.perf_counter() - write_start
+                    debug('Added %s', message_out)
+            walked_completely = True
+        except GitLogFailedException as e:
+            warn("Failed walking history of repo %s", repo_id, repo_id=repo_id)
+            warn(e)
+        if boundary:
+            references['known_commits'] = commit_index.repos_of(sorted(boundary))
+        write_start = time.perf_counter()
+        result_writer.finish(CONFIG, GLOBAL, references)
+    write_seconds += time.perf_counter() - write_start
+    walk_seconds = time.perf_counter() - walk_start - write_seconds
+    METRICS.observe('raq_walk_seconds', walk_seconds)
+    METRICS.observe('raq_result_write_seconds', write_seconds)
+    METRICS.inc('raq_commits_total', result_writer.commit_count)
+    # Commits are indexed and the watermark is moved only once the result
+    # is uploaded, other crawls must not stop at commits of a result that
+    # never arrived.
+    index_graph = None
+    if commit_index is not None:
+        METRICS.inc('raq_known_commit_boundaries_total', len(boundary))
+        # A partial history must not be indexed, known commits stand for all their ancestors.
+        if walked_completely and not is_shallow(repo_git_path):
+            index_graph = commit_graph
+    watermark = None
+    if watermark_store is not None and walked_completely:
+        METRICS.inc('raq_walks_total', labels={'kind': 'delta' if delta_head else 'full'})
+        watermark = crawled_head_shas
+    record_crawl = None
+    if index_graph is not None or watermark is not None:
+        record_crawl = partial(record_uploaded_crawl, repo_id, commit_index, index_graph, watermark_store,
+                               watermark)
+    if walk_seconds > 0:
+        METRICS.observe('raq_walk_commits_per_second', result_writer.commit_count / walk_seconds,
+                        buckets=RATE_BUCKETS)
+    return result_writer.path, record_crawl
+
+
+def record_uploaded_crawl(repo_id, commit_index, commit_graph, watermark_store, crawled_head_shas, uploaded_path):
+    """Indexes the commits of commit_graph, if any, and moves the watermark
+    of the repo to crawled_head_shas, if any, once its result is uploaded,
+    naming the uploaded file, the bundle for bundled results."""
+    if commit_graph is not None:
+        commit_index.add(repo_id, commit_graph.iter_shas())
+    if crawled_head_shas is not None:
+        watermark_store.set(repo_id, crawled_head_shas, os.path.basename(uploaded_path))
+
+
+def create_repo_result_writer(results_path, repo_id, result_bundler=None, delta_head=None, delta_base=None):
+    """Creates the writer of the repo's result in the configured format, or
+    of its entry in the current bundle with a result_bundler."""
+    if result_bundler is not None:
+        return result_bundler.create_entry_writer(results_path, repo_id, delta_head)
+    return create_result_writer(results_path, repo_id,
+                                result_format=CONFIG.get('result_format', 'json'),
+                                compression=CONFIG.get('result_compression', 'none'),
+                                delta_head=delta_head, delta_base=delta_base)
+
+
+def clone_repository_into_directory(target_path: str, clone_url: str, strategy: str = 'full', depth=None):
+    clone_repository(clone_url=clone_url, target_path=target_path, strategy=strategy, depth=depth)
+
+
+@contextmanager
+def cloned_repository(target_path: str, clone_url: str, budget=None):
+    """Clones the repository as configured and removes it after the with
+    block. With a budget the clone is killed once it exceeds it."""
+    strategy = CONFIG.get('clone_strategy', 'full')
+    try:
+        if budget is None:
+            clone_repository_into_directory(target_path=target_path, clone_url=clone_url,
+                                            strategy=strategy, depth=CONFIG.get('clone_depth'))
         else:
-            initial_sha = None
-    return initial_sha
+            command = clone_command(clone_url, target_path, strategy, CONFIG.get('clone_depth'))
+            clone_code = run_within_budget(command, budget, partial(directory_size, target_path))
+            if clone_code != 0:
+                raise CalledProcessError(clone_code, command)
+        yield target_path
+    finally:
+        shutil.rmtree(target_path, ignore_errors=True)
+
+
+def mirror_cache_from_config(config):
+    """Creates the MirrorCache configured by mirror_cache_path or None if there is none."""
+    if not config.get('mirror_cache_path'):
+        return None
+    return MirrorCache(cache_path=config['mirror_cache_path'],
+                       max_bytes=config.get('mirror_cache_max_bytes'),
+                       max_entries=config.get('mirror_cache_max_entries'),
+                       strategy=config.get('clone_strategy', 'bare'))
+
 
+def commit_index_from_config(config):
+    """Creates the CommitIndex if commit_index_path is configured, otherwise None."""
+    if not config.get('commit_index_path'):
+        return None
+    return CommitIndex(config['commit_index_path'],
+                       expected_commits=int(config.get('commit_index_expected_commits', 4000000)))
 
-def git_show_commit_msg(current_sha, delimiter):
-    combi_format = '--pretty=%B{}'.format(delimiter.decode())
-    show_commit_cmd = ['git', '--no-pager', 'show', '--shortstat', combi_format, current_sha]
-    show_commit_proc = run(show_commit_cmd, stdout=PIPE, )
-    show_commit_out_bytes = show_commit_proc.stdout
-    show_commit_out_bytes_target = show_commit_out_bytes[:show_commit_out_bytes.find(delimiter)]
-    show_commit_exit_code = show_commit_proc.returncode
-    show_out = show_commit_out_bytes_target.decode('unicode-escape')
-    return show_commit_exit_code, show_out
 
+def watermark_store_from_config(config):
+    """Creates the WatermarkStore if watermark_store_path is configured, otherwise None."""
+    if not config.get('watermark_store_path'):
+        return None
+    return WatermarkStore(config['watermark_store_path'])
+
+
+def admission_policy_from_config(config, boto3_session):
+    """Creates the AdmissionPolicy if any of max_repo_size_kb,
+    large_repo_size_kb, task_timeout, task_max_disk_bytes or
+    task_max_memory_bytes is configured, otherwise None. Repos above
+    large_repo_size_kb are routed to the queue at large_msg_queue_address,
+    or large_msg_queue_path with the sqlite backend, if configured."""
+    limits = {key: config[key] for key in ('max_repo_size_kb', 'large_repo_size_kb', 'task_timeout',
+                                           'task_max_disk_bytes', 'task_max_memory_bytes') if config.get(key)}
+    if not limits:
+        return None
+    large_queue = None
+    if config.get('large_msg_queue_address') or config.get('large_msg_queue_path'):
+        large_queue = msg_queue_from_config(config, boto3_session, 'large_msg_queue')
+    return AdmissionPolicy(max_size_kb=optional_int(limits, 'max_repo_size_kb'),
+                           large_size_kb=optional_int(limits, 'large_repo_size_kb'),
+                           large_queue=large_queue,
+                           wall_seconds=float(limits['task_timeout']) if 'task_timeout' in limits else None,
+                           disk_bytes=optional_int(limits, 'task_max_disk_bytes'),
+                           memory_bytes=optional_int(limits, 'task_max_memory_bytes'))
 
-def git_parent_shas_space_separated(current_sha, delimiter):
-    parents_format = '--pretty=format:%P{}'.format(delimiter.decode())
-    parents_cmd = ['git', '--no-pager', 'show', '--shortstat', parents_format, current_sha]
-    parents_proc = run(parents_cmd, stdout=PIPE, stderr=PIPE)
-    parents_exit_code = parents_proc.returncode
-    parents_out_bytes = parents_proc.stdout
-    parents_out_bytes_target = parents_out_bytes[:parents_out_bytes.find(delimiter)]
-    parents_out = parents_out_bytes_target.decode('unicode-escape')
-    return parents_exit_code, parents_out
 
+def optional_int(config, key):
+    return int(config[key]) if key in config else None
 
-def clone_repository_into_directory(target_path: str, clone_url: str):
-    pop = run(['git', 'clone', clone_url, target_path], universal_newlines=True)
-    pop.check_returncode()
+
+def response_cache_from_config(config):
+    """Creates the ResponseCache configured by response_cache_path or None if there is none."""
+    if not config.get('response_cache_path'):
+        return None
+    return ResponseCache(cache_path=config['response_cache_path'],
+                         max_bytes=config.get('response_cache_max_bytes', 64 * 1024 * 1024))
 
 
 def write_meta_json(metaf_name, resp_body):
@@ -266,16 +890,61 @@ def write_meta_json(metaf_name, resp_body):
     metaf.close()
 
 
-def handle_refill_task(github_session, message, msg_queue):
-    global GLOBAL
+def task_attributes():
+    """Message attributes identifying this worker as creator of a task."""
+    return {
+        'creator_id': {
+            'DataType': "String",
+            'StringValue': GLOBAL['RANDOM_ID']
+        },
+        'creator_started_timestamp': {
+            'DataType': "String",
+            'StringValue': GLOBAL['START_TIMESTAMP']
+        },
+    }
 
+
+def handle_refill_plan_task(message, msg_queue):
+    """Splits the id range of a refill_plan task into refill tasks, e.g.
+    {'start_id': 0, 'stop_id': 400000000, 'ranges': 64, 'lookahead': 2}."""
+    plan = message.body_dict['refill_plan']
+    info('Received refill_plan task')
+    debug(plan)
+    refill_tasks = plan_ranges(int(plan.get('start_id', 0)), int(plan['stop_id']), int(plan.get('ranges', 1)),
+                               int(plan.get('lookahead', 1)))
+    msg_queue.write_messages(refill_tasks, message_attributes_dict=task_attributes())
+    info('refill_plan added %s ranges', len(refill_tasks))
+
+
+def handle_refill_task(github_session, message, msg_queue, metadata_fetcher=None):
+    """Enqueues the repo tasks of the next page of the refill range and the
+    refills covering the rest of it, see refill_planner. Returns False
+    without doing so if the refill has to wait: the queue holds more than
+    refill_max_queue_depth messages already, or there are no repositories
+    after the start of the range yet. Bounded ranges wait as well, their
+    ids may still be taken by repositories created later."""
     info('Received refill_task')
     debug(message.body_dict)
     debug(message.message_attributes)
-    url = "https://api.github.com/repositories?since={}".format(message.body_dict['refill_task']['since_id'])
+    refill_task = message.body_dict['refill_task']
+    max_queue_depth = int(CONFIG.get('refill_max_queue_depth', 0))
+    if max_queue_depth > 0:
+        queue_depth = msg_queue.approximate_depth()
+        if queue_depth is not None and queue_depth >= max_queue_depth:
+            info('refill_task deferred, %s messages queued', queue_depth)
+            return False
+
+    url = "https://api.github.com/repositories?since={}".format(refill_task['since_id'])
     res_dict, headers, resp_body = github_session.request_url(url)
-    last_id = 0
-    for repo_dict in res_dict:
+    page_ids = [int(repo_dict['id']) for repo_dict in res_dict]
+    if not page_ids:
+        info('refill_task deferred, no repositories after %s yet', refill_task['since_id'])
+        return False
+    in_range = set(ids_in_range(refill_task, page_ids))
+    repo_dicts = [repo_dict for repo_dict in res_dict if int(repo_dict['id']) in in_range]
+    resolved = resolve_repo_metadata(metadata_fetcher, [repo_dict['full_name'] for repo_dict in repo_dicts])
+    repo_tasks = []
+    for repo_dict in repo_dicts:
         task = {
             'task_type': 'repo',
             'repo_task': {
@@ -284,41 +953,72 @@ def handle_refill_task(github_session, message, msg_queue):
                 'api_url': "https://api.github.com/repos/{}".format(repo_dict['full_name'])
             }
         }
-        task_attr = {
-            'creator_id': {
-                'DataType': "String",
-                'StringValue': GLOBAL['RANDOM_ID']
-            },
-            'creator_started_timestamp': {
-                'DataType': "String",
-                'StringValue': GLOBAL['START_TIMESTAMP']
-            },
-        }
-        last_id = int(repo_dict['id'])
-        debug('refill_task adding id {} for repo {}'.format(repo_dict['id'], repo_dict['full_name']))
-        msg_queue.write_message(message_dict=task,
-                                message_attributes_dict=task_attr)
-    task = {
-        'task_type': 'refill',
-        'refill_task': {
-            'since_id': last_id,
-        }
-    }
-    task_attr = {
-        'creator_id': {
-            'DataType': "String",
-            'StringValue': GLOBAL['RANDOM_ID']
-        },
-        'creator_started_timestamp': {
-            'DataType': "String",
-            'StringValue': GLOBAL['START_TIMESTAMP']
-        },
-    }
-    info('refill_task adding since id {} '.format(last_id))
-    msg_queue.write_message(message_dict=task,
-                            message_attributes_dict=task_attr)
+        if resolved.get(repo_dict['full_name']) is not None:
+            task['repo_task']['meta'], task['repo_task']['languages'] = resolved[repo_dict['full_name']]
+        debug('refill_task adding id %s for repo %s', repo_dict['id'], repo_dict['full_name'])
+        repo_tasks.append(task)
+    task_attr = task_attributes()
+    msg_queue.write_messages(repo_tasks, message_attributes_dict=task_attr)
+    follow_ups = follow_up_refills(refill_task, page_ids)
+    for follow_up in follow_ups:
+        info('refill_task adding since id %s up to %s', follow_up['refill_task']['since_id'],
+             follow_up['refill_task'].get('stop_id'))
+    if follow_ups:
+        msg_queue.write_messages(follow_ups, message_attributes_dict=task_attr)
+    else:
+        info('refill_task finished range up to %s', refill_task.get('stop_id'))
 
     info('refill_task done')
+    return True
+
+
+def resolve_repo_metadata(metadata_fetcher, full_names):
+    """Fetches meta data and languages of all repositories in bulk. Repositories
+    missing in the result are resolved through REST by their repo task."""
+    if metadata_fetcher is None:
+        return {}
+    try:
+        return metadata_fetcher.fetch_many(full_names)
+    except Exception as e:
+        warn('Resolving meta data through GraphQL failed, falling back to REST')
+        warn(e)
+        return {}
+
+
+def metadata_fetcher_from_config(config, github_session):
+    """Creates the GraphQLRepoFetcher resolving metadata_batch_size
+    repositories per query, 50 by default. Returns None if it is set to 0."""
+    batch_size = int(config.get('metadata_batch_size', DEFAULT_BATCH_SIZE))
+    if batch_size <= 0:
+        return None
+    return GraphQLRepoFetcher(github_session, batch_size=batch_size)
+
+
+def msg_visibility_timeout_from_config(config):
+    """Seconds a popped task stays hidden from other workers, set by
+    msg_visibility_timeout, 30 by default. Held tasks are extended by as much."""
+    return int(config.get('msg_visibility_timeout', MSG_VISIBILITY_TIMEOUT))
+
+
+def msg_queue_from_config(config, boto3_session, name='msg_queue'):
+    """Creates the task queue of the configured msg_queue_backend, 'sqs' by
+    default or 'sqlite' for a queue in the local file msg_queue_path. Other
+    queues of the same backend are configured with their name in place of
+    msg_queue, e.g. large_msg_queue_address. Polls wait up to msg_wait_time
+    seconds for a message, 20 by default."""
+    backend = config.get('msg_queue_backend', 'sqs')
+    msg_visibility_timeout = msg_visibility_timeout_from_config(config)
+    wait_time = float(config.get('msg_wait_time', 20))
+    if backend == 'sqlite':
+        return SqliteMessageQueue(config[name + '_path'], msg_visibility_timeout=msg_visibility_timeout,
+                                  wait_time=wait_time)
+    if backend != 'sqs':
+        raise ValueError('Unknown msg_queue_backend {}'.format(backend))
+    return SqsMessageQueue(botosession=boto3_session,
+                           wait_time=int(wait_time),
+                           queue_address=config[name + '_address'],
+                           msg_visibility_timeout=msg_visibility_timeout,
+                           prefetch_size=int(config.get('msg_prefetch_size', 0)))
 
 
 def boto_session_and_sts_id(config):
@@ -338,14 +1038,15 @@ def boto_session_and_sts_id(config):
 
 if __name__ == '__main__':
     LOG_LEVEL = 4
+    log_listener = start_logging(LEGACY_LEVELS[LOG_LEVEL])
     GLOBAL = {
         'START_TIMESTAMP': datetime.datetime.utcnow().isoformat(),
         'RANDOM_ID': ''.join(random.choices(string.ascii_letters + string.digits, k=32)),
         'SHOULD_RUN': True
     }
 
-    conf_info("START_TIMESTAMP: {}".format(GLOBAL['START_TIMESTAMP']))
-    conf_info("RANDOM_ID: {}".format(GLOBAL['RANDOM_ID']))
+    conf_info("START_TIMESTAMP: %s", GLOBAL['START_TIMESTAMP'])
+    conf_info("RANDOM_ID: %s", GLOBAL['RANDOM_ID'])
 
     if len(sys.argv) > 1:
         CONFIG = read_config_from_environment(sys.argv[1])
@@ -353,14 +1054,19 @@ if __name__ == '__main__':
         CONFIG = read_config_from_environment()
     debug(CONFIG)
 
-    boto3_session, sts_id = boto_session_and_sts_id(CONFIG)
-    GLOBAL['STS_ARN'] = sts_id['Arn']
+    boto3_session = None
+    if CONFIG.get('msg_queue_backend', 'sqs') == 'sqs':
+        boto3_session, sts_id = boto_session_and_sts_id(CONFIG)
+        GLOBAL['STS_ARN'] = sts_id['Arn']
 
     conf_info(GLOBAL)
     conf_info(CONFIG)
 
     try:
-        run_crawler_with_config(CONFIG, boto3_session)
+        if CONFIG.get('supervisor', 'false').lower() in ('1', 'true', 'yes'):
+            run_supervisor_with_config(CONFIG, boto3_session)
+        else:
+            run_crawler_with_config(CONFIG, boto3_session)
     except Exception as e:
         error("Something horrible happended")
         error(e)
@@ -369,3 +1075,5 @@ if __name__ == '__main__':
         error("Locals")
         error(locals())
         error('rip')
+    finally:
+        log_listener.stop()
@@ -0,0 +1,263 @@
+"""Queue of crawl tasks: the interface the crawler works against and a
+local backend on SQLite for runs without SQS."""
+import abc
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+import uuid
+from typing import Iterable, List, Mapping, Optional
+
+BACKENDS = ('sqs', 'sqlite')
+
+LOGGER = logging.getLogger(__name__)
+
+
+class NoMessagesAfterLongPollingAvailableException(Exception):
+    """Exception throws when no Messages are received after a Long Polling."""
+    pass
+
+
+class StaleReceiptHandleException(Exception):
+    """Exception thrown when a message is changed through the receipt handle of an outdated delivery."""
+    pass
+
+
+class MessageQueue(abc.ABC):
+    """Delivers every message at least once: a popped message is hidden
+    for the visibility timeout and delivered again unless it is deleted
+    before the timeout runs out.
+
+    Popped messages carry body_raw, body_dict, message_attributes and
+    message_id and can be deleted or have their visibility extended through
+    the queue or themselves, like messages of boto3."""
+
+    @abc.abstractmethod
+    def pop_next_message(self):
+        """Receives one message, waiting a while for one to arrive. Raises
+        NoMessagesAfterLongPollingAvailableException if none did."""
+
+    @abc.abstractmethod
+    def pop_messages(self, max_messages: int = 10) -> list:
+        """Receives up to max_messages at once, waiting a while for the
+        first to arrive. Returns an empty list if none did."""
+
+    @abc.abstractmethod
+    def write_message(self, message_dict: dict, message_attributes_dict: dict = {}):
+        """Writes the provided dict JSON-encoded into the queue."""
+
+    @abc.abstractmethod
+    def write_messages(self, message_dicts, message_attributes_dict: dict = {}) -> int:
+        """Writes the provided dicts JSON-encoded into the queue and returns how many were written."""
+
+    def delete_message(self, message) -> None:
+        """Acknowledges a popped message, so it is not delivered again."""
+        message.delete()
+
+    def extend_visibility(self, message, visibility_timeout: int) -> None:
+        """Hides a popped message for another visibility_timeout seconds from now on."""
+        message.change_visibility(VisibilityTimeout=visibility_timeout)
+
+    def approximate_depth(self) -> Optional[int]:
+        """Approximate number of messages waiting to be popped, None if the backend can not tell."""
+        return None
+
+    def close(self) -> None:
+        """Releases the resources of the queue."""
+        pass
+
+
+class SqliteMessage:
+    """A message popped from a SqliteMessageQueue, tied to this delivery by its receipt_handle."""
+
+    def __init__(self, message_queue: 'SqliteMessageQueue', message_id: int, receipt_handle: str,
+                 body: str, attributes: str, receive_count: int):
+        self.__queue = message_queue
+        self.message_id = str(message_id)
+        self.receipt_handle = receipt_handle
+        self.body = body
+        self.body_raw = body
+        self.body_dict = json.loads(body)
+        self.message_attributes = json.loads(attributes) if attributes else {}
+        self.receive_count = receive_count
+
+    def delete(self) -> None:
+        self.__queue.delete_message(self)
+
+    def change_visibility(self, VisibilityTimeout: int) -> None:
+        self.__queue.extend_visibility(self, VisibilityTimeout)
+
+
+class SqliteMessageQueue(MessageQueue):
+    """Keeps messages in a SQLite database in WAL mode, so several threads
+    and worker processes on one machine can share the queue.
+
+    A pop hands out the oldest visible messages together with a fresh
+    receipt handle and hides them until the visibility timeout. Deleting or
+    extending a message only works with the handle of its latest delivery,
+    so a worker that overran the timeout cannot ack a redelivered message."""
+
+    def __init__(self, path: str, msg_visibility_timeout: int = 600, wait_time: int = 20,
+                 poll_interval: float = 0.05):
+        self._path = path
+        self._vis_timeout = msg_visibility_timeout
+        self._wait_time = wait_time
+        self._poll_interval = poll_interval
+        self._local = threading.local()
+        directory = os.path.dirname(os.path.abspath(path))
+        os.makedirs(directory, exist_ok=True)
+        connection = self._connection()
+        connection.execute('CREATE TABLE IF NOT EXISTS messages ('
+                           ' id INTEGER PRIMARY KEY AUTOINCREMENT,'
+                           ' body TEXT NOT NULL,'
+                           ' attributes TEXT,'
+                           ' visible_at REAL NOT NULL,'
+                           ' receipt_handle TEXT,'
+                           ' receive_count INTEGER NOT NULL DEFAULT 0)')
+        connection.execute('CREATE INDEX IF NOT EXISTS messages_visible_at ON messages (visible_at, id)')
+
+    def _connection(self) -> sqlite3.Connection:
+        # sqlite3 connections must not be shared between threads.
+        connection = getattr(self._local, 'connection', None)
+        if connection is None:
+            connection = sqlite3.connect(self._path, timeout=30, isolation_level=None)
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.execute('PRAGMA synchronous=NORMAL')
+            self._local.connection = connection
+        return connection
+
+    def __len__(self) -> int:
+        """Number of messages in the queue, including hidden ones."""
+        return self._connection().execute('SELECT COUNT(*) FROM messages').fetchone()[0]
+
+    def approximate_depth(self) -> int:
+        """Number of messages visible right now."""
+        return self._connection().execute('SELECT COUNT(*) FROM messages WHERE visible_at <= ?',
+                                          (time.time(),)).fetchone()[0]
+
+    def _receive(self, max_messages: int) -> List[SqliteMessage]:
+        connection = self._connection()
+        now = time.time()
+        connection.execute('BEGIN IMMEDIATE')
+        try:
+            rows = connection.execute('SELECT id, body, attributes, receive_count FROM messages'
+                                      ' WHERE visible_at <= ? ORDER BY visible_at, id LIMIT ?',
+                                      (now, max_messages)).fetchall()
+            messages = []
+            for message_id, body, attributes, receive_count in rows:
+                receipt_handle = uuid.uuid4().hex
+                connection.execute('UPDATE messages SET visible_at = ?, receipt_handle = ?,'
+                                   ' receive_count = receive_count + 1 WHERE id = ?',
+                                   (now + self._vis_timeout, receipt_handle, message_id))
+                messages.append(SqliteMessage(self, message_id, receipt_handle, body, attributes,
+                                              receive_count + 1))
+            connection.execute('COMMIT')
+        except BaseException:
+            connection.execute('ROLLBACK')
+            raise
+        return messages
+
+    def pop_messages(self, max_messages: int = 10) -> List[SqliteMessage]:
+        deadline = time.monotonic() + self._wait_time
+        while True:
+            messages = self._receive(max_messages)
+            if messages or time.monotonic() >= deadline:
+                return messages
+            time.sleep(self._poll_interval)
+
+    def pop_next_message(self) -> SqliteMessage:
+        messages = self.pop_messages(1)
+        if not messages:
+            raise NoMessagesAfterLongPollingAvailableException("No Messages receivable from Queue")
+        return messages[0]
+
+    def write_message(self, message_dict: dict, message_attributes_dict: dict = {}) -> dict:
+        message_id = self._insert([message_dict], message_attributes_dict)[0]
+        return {'MessageId': str(message_id)}
+
+    def write_messages(self, message_dicts: Iterable[Mapping], message_attributes_dict: dict = {}) -> int:
+        return len(self._insert(message_dicts, message_attributes_dict))
+
+    def _insert(self, message_dicts: Iterable[Mapping], message_attributes_dict: Mapping) -> List[int]:
+        connection = self._connection()
+        attributes = json.dumps(message_attributes_dict) if message_attributes_dict else None
+        now = time.time()
+        connection.execute('BEGIN IMMEDIATE')
+        try:
+            message_ids = [connection.execute('INSERT INTO messages (body, attributes, visible_at) VALUES (?, ?, ?)',
+                                              (json.dumps(message_dict), attributes, now)).lastrowid
+                           for message_dict in message_dicts]
+            connection.execute('COMMIT')
+        except BaseException:
+            connection.execute('ROLLBACK')
+            raise
+        return message_ids
+
+    def delete_message(self, message: SqliteMessage) -> None:
+        self._connection().execute('DELETE FROM messages WHERE id = ? AND receipt_handle = ?',
+                                   (int(message.message_id), message.receipt_handle))
+
+    def extend_visibility(self, message: SqliteMessage, visibility_timeout: int) -> None:
+        updated = self._connection().execute(
+            'UPDATE messages SET visible_at = ? WHERE id = ? AND receipt_handle = ?',
+            (time.time() + visibility_timeout, int(message.message_id), message.receipt_handle)).rowcount
+        if not updated:
+            raise StaleReceiptHandleException('Message {} was redelivered or deleted'.format(message.message_id))
+
+    def close(self) -> None:
+        connection = getattr(self._local, 'connection', None)
+        if connection is not None:
+            connection.close()
+            self._local.connection = None
+
+
+class MessageLeaseKeeper:
+    """Extends the visibility of held messages by visibility_timeout every
+    interval seconds, so messages waiting in a pipeline longer than the
+    visibility timeout are not delivered to another worker meanwhile."""
+
+    def __init__(self, msg_queue: MessageQueue, visibility_timeout: int, interval: Optional[float] = None):
+        self.__queue = msg_queue
+        self.__visibility_timeout = visibility_timeout
+        self.__interval = interval if interval is not None else visibility_timeout / 3
+        self.__held = {}
+        self.__lock = threading.Lock()
+        self.__stopped = threading.Event()
+        self.__thread = threading.Thread(target=self.__run, name='raq_lease_keeper', daemon=True)
+        self.__thread.start()
+
+    def hold(self, message) -> None:
+        with self.__lock:
+            self.__held[id(message)] = message
+
+    def release(self, message) -> None:
+        with self.__lock:
+            self.__held.pop(id(message), None)
+
+    def acknowledge(self, message) -> None:
+        """Stops holding the message and deletes it from the queue."""
+        self.release(message)
+        self.__queue.delete_message(message)
+
+    @property
+    def held(self) -> int:
+        with self.__lock:
+            return len(self.__held)
+
+    def __run(self) -> None:
+        while not self.__stopped.wait(self.__interval):
+            with self.__lock:
+                messages = list(self.__held.values())
+            for message in messages:
+                try:
+                    self.__queue.extend_visibility(message, self.__visibility_timeout)
+                except Exception as lease_error:
+                    LOGGER.warning('Extending the visibility of message %s failed: %s',
+                                   getattr(message, 'message_id', None), lease_error)
+                    self.release(message)
+
+    def close(self) -> None:
+        self.__stopped.set()
+        self.__thread.join()
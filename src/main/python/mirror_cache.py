@@ -0,0 +1,177 @@
+"""On-disk cache of bare repository mirrors shared by consecutive crawl tasks."""
+import json
+import logging
+import os
+import shutil
+import threading
+import time
+from contextlib import contextmanager
+from functools import partial
+from subprocess import CalledProcessError
+from typing import Dict, Iterator, Optional
+
+from admission import BudgetExceededException, ResourceBudget, run_within_budget
+from git_clone import mirror_command, mirror_fetch_command
+
+INDEX_FILE_NAME = 'mirror-index.json'
+MIRRORS_DIR_NAME = 'mirrors'
+
+LOGGER = logging.getLogger(__name__)
+
+
+def directory_size(path: str) -> int:
+    """Sums up the apparent size of all files below path."""
+    total = 0
+    for root, _, files in os.walk(path):
+        for file_name in files:
+            try:
+                total += os.lstat(os.path.join(root, file_name)).st_size
+            except FileNotFoundError:
+                pass
+    return total
+
+
+class MirrorCache:
+    """Keeps bare mirrors keyed by repo id below cache_path. A cache miss
+    clones a fresh mirror, a hit only fetches what changed since.
+
+    Mirrors not in use are evicted least recently used first as soon as the
+    cache grows beyond max_bytes or max_entries. Usage is tracked in an index
+    file, so the cache survives worker restarts."""
+
+    def __init__(self, cache_path: str, max_bytes: Optional[int] = None, max_entries: Optional[int] = None,
+                 strategy: str = 'bare'):
+        self.__cache_path = cache_path
+        self.__mirrors_path = os.path.join(cache_path, MIRRORS_DIR_NAME)
+        self.__index_path = os.path.join(cache_path, INDEX_FILE_NAME)
+        self.__max_bytes = int(max_bytes) if max_bytes else None
+        self.__max_entries = int(max_entries) if max_entries else None
+        self.__strategy = strategy
+        self.__lock = threading.Lock()
+        self.__repo_locks = {}  # type: Dict[str, threading.Lock]
+        self.__pinned = {}  # type: Dict[str, int]
+        self.hits = 0
+        self.misses = 0
+        os.makedirs(self.__mirrors_path, exist_ok=True)
+        self.__index = self.__load_index()
+
+    def __load_index(self) -> Dict[str, dict]:
+        index = {}
+        try:
+            with open(self.__index_path) as index_file:
+                index = json.load(index_file)
+        except (FileNotFoundError, ValueError):
+            pass
+        # Mirrors on disk are the source of truth, the index only adds usage.
+        on_disk = set(os.listdir(self.__mirrors_path))
+        index = {key: entry for key, entry in index.items() if key in on_disk}
+        for key in on_disk - set(index):
+            index[key] = {'last_used': 0, 'bytes': directory_size(self.mirror_path(key))}
+        return index
+
+    def __save_index(self) -> None:
+        temporary_path = self.__index_path + '.tmp'
+        with open(temporary_path, 'w') as index_file:
+            json.dump(self.__index, index_file)
+        os.replace(temporary_path, self.__index_path)
+
+    @property
+    def total_bytes(self) -> int:
+        with self.__lock:
+            return sum(entry['bytes'] for entry in self.__index.values())
+
+    def __len__(self) -> int:
+        with self.__lock:
+            return len(self.__index)
+
+    def __contains__(self, repo_id) -> bool:
+        with self.__lock:
+            return str(repo_id) in self.__index
+
+    def mirror_path(self, repo_id) -> str:
+        return os.path.join(self.__mirrors_path, str(repo_id))
+
+    @contextmanager
+    def checkout(self, repo_id, clone_url: str, budget: Optional[ResourceBudget] = None) -> Iterator[str]:
+        """Provides an up to date mirror of the repository for the duration of
+        the with block. The mirror can not be evicted while it is in use.
+        A clone or fetch running out of the budget drops the mirror."""
+        key = str(repo_id)
+        with self.__lock:
+            repo_lock = self.__repo_locks.setdefault(key, threading.Lock())
+            self.__pinned[key] = self.__pinned.get(key, 0) + 1
+        try:
+            with repo_lock:
+                path = self.mirror_path(key)
+                try:
+                    if not self.__refresh(key, path, budget):
+                        self.__clone(key, path, clone_url, budget)
+                except BudgetExceededException:
+                    self.__drop(key)
+                    raise
+                yield path
+        finally:
+            self.__release(key)
+
+    def __refresh(self, key: str, path: str, budget: Optional[ResourceBudget]) -> bool:
+        with self.__lock:
+            cached = key in self.__index
+        if not cached or not os.path.isdir(path):
+            return False
+        fetch_code = run_within_budget(mirror_fetch_command(), budget, partial(directory_size, path), cwd=path)
+        if fetch_code != 0:
+            LOGGER.warning('Fetch into cached mirror %s failed with %s, cloning it again', key, fetch_code)
+            self.__drop(key)
+            return False
+        self.hits += 1
+        return True
+
+    def __clone(self, key: str, path: str, clone_url: str, budget: Optional[ResourceBudget]) -> None:
+        shutil.rmtree(path, ignore_errors=True)
+        self.misses += 1
+        command = mirror_command(clone_url, path, self.__strategy)
+        clone_code = run_within_budget(command, budget, partial(directory_size, path))
+        if clone_code != 0:
+            shutil.rmtree(path, ignore_errors=True)
+            raise CalledProcessError(clone_code, command)
+        with self.__lock:
+            self.__index[key] = {'last_used': time.time(), 'bytes': 0}
+
+    def __drop(self, key: str) -> None:
+        with self.__lock:
+            self.__index.pop(key, None)
+        shutil.rmtree(self.mirror_path(key), ignore_errors=True)
+
+    def __release(self, key: str) -> None:
+        size = directory_size(self.mirror_path(key))
+        with self.__lock:
+            self.__pinned[key] -= 1
+            if not self.__pinned[key]:
+                # Checkouts waiting for the repo lock pinned the key first, none is left.
+                del self.__pinned[key]
+                del self.__repo_locks[key]
+            if key in self.__index:
+                self.__index[key] = {'last_used': time.time(), 'bytes': size}
+            evicted = self.__select_evictions()
+            for evicted_key in evicted:
+                del self.__index[evicted_key]
+            self.__save_index()
+        for evicted_key in evicted:
+            LOGGER.info('Evicting cached mirror %s', evicted_key)
+            shutil.rmtree(self.mirror_path(evicted_key), ignore_errors=True)
+
+    def __select_evictions(self):
+        total_bytes = sum(entry['bytes'] for entry in self.__index.values())
+        entries = len(self.__index)
+        evicted = []
+        for key, entry in sorted(self.__index.items(), key=lambda item: item[1]['last_used']):
+            over_bytes = self.__max_bytes is not None and total_bytes > self.__max_bytes
+            over_entries = self.__max_entries is not None and entries > self.__max_entries
+            if not over_bytes and not over_entries:
+                break
+            if key in self.__pinned:
+                continue
+            evicted.append(key)
+            total_bytes -= entry['bytes']
+            entries -= 1
+        return evicted
@@ -0,0 +1,68 @@
+"""Splits the repository id space into ranges refilled independently.
+
+A refill task covers the ids since_id < id <= stop_id, or all ids above
+since_id without a stop_id. Every refill fetches one /repositories page of
+its range and enqueues the follow-ups covering the rest of it, so several
+ranges, and with lookahead several pages of one range, are in flight at once."""
+from typing import List, Optional, Sequence
+
+# Repositories GitHub lists per /repositories page.
+PAGE_SIZE = 100
+
+
+def refill_task_dict(since_id: int, stop_id: Optional[int] = None, lookahead: int = 1) -> dict:
+    """Builds the message of a refill task for the given range."""
+    refill_task = {'since_id': since_id}
+    if stop_id is not None:
+        refill_task['stop_id'] = stop_id
+    if lookahead > 1:
+        refill_task['lookahead'] = lookahead
+    return {'task_type': 'refill', 'refill_task': refill_task}
+
+
+def plan_ranges(start_id: int, stop_id: int, range_count: int, lookahead: int = 1) -> List[dict]:
+    """Splits the ids start_id < id <= stop_id into range_count refill tasks
+    of about equal width."""
+    if stop_id <= start_id or range_count < 1:
+        raise ValueError('Can not split ids {} to {} into {} ranges'.format(start_id, stop_id, range_count))
+    range_count = min(range_count, stop_id - start_id)
+    bounds = [start_id + (stop_id - start_id) * number // range_count for number in range(range_count + 1)]
+    return [refill_task_dict(since_id, until_id, lookahead) for since_id, until_id in zip(bounds, bounds[1:])]
+
+
+def ids_in_range(refill_task: dict, page_ids: Sequence[int]) -> List[int]:
+    """Returns the ids of a fetched page that belong to the range of the refill task."""
+    stop_id = refill_task.get('stop_id')
+    return [repo_id for repo_id in page_ids if stop_id is None or repo_id <= stop_id]
+
+
+def follow_up_refills(refill_task: dict, page_ids: Sequence[int], page_size: int = PAGE_SIZE) -> List[dict]:
+    """Returns the refill tasks covering what is left of the range after the
+    page with page_ids, in ascending order. None are left once the page
+    came back empty or reached the stop_id of a bounded range.
+
+    With a lookahead above one and a full page of page_size ids the rest is
+    split further: the next lookahead - 1 ranges are about as wide as the
+    ids the page covered, expected to take one page each, and the last
+    range keeps the lookahead. A page that is not full reached the newest
+    repository, ranges ahead of it would only come back empty."""
+    since_id = refill_task['since_id']
+    stop_id = refill_task.get('stop_id')
+    lookahead = int(refill_task.get('lookahead', 1))
+    in_range = ids_in_range(refill_task, page_ids)
+    if not in_range:
+        return []
+    last_id = max(in_range)
+    if stop_id is not None and (len(in_range) < len(page_ids) or last_id >= stop_id):
+        return []
+    page_width = max(last_id - since_id, 1)
+    follow_ups = []
+    cursor = last_id
+    for _ in range(lookahead - 1 if len(page_ids) >= page_size else 0):
+        # The last range must still have room for at least one page of its own.
+        if stop_id is not None and cursor + 2 * page_width > stop_id:
+            break
+        follow_ups.append(refill_task_dict(cursor, cursor + page_width))
+        cursor += page_width
+    follow_ups.append(refill_task_dict(cursor, stop_id, lookahead))
+    return follow_ups
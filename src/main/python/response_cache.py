@@ -0,0 +1,125 @@
+"""On-disk cache of GitHub API responses for conditional requests."""
+import hashlib
+import json
+import os
+import threading
+from collections import OrderedDict
+from typing import Dict, Mapping, Optional
+
+ENTRY_SUFFIX = '.json'
+
+
+class ResponseCache:
+    """Stores body, ETag and Last-Modified of responses keyed by URL below
+    cache_path, so requests can be sent conditionally. GitHub does not count
+    a '304 Not Modified' against the rate limit, the cached body is served
+    instead.
+
+    Entries are evicted least recently used first once their total size
+    exceeds max_bytes. The order survives restarts through the files' mtime."""
+
+    def __init__(self, cache_path: str, max_bytes: int = 64 * 1024 * 1024):
+        self.__cache_path = cache_path
+        self.__max_bytes = int(max_bytes)
+        self.__lock = threading.Lock()
+        self.__entries = OrderedDict()  # type: OrderedDict[str, int]
+        self.__total_bytes = 0
+        self.not_modified = 0
+        self.stored = 0
+        self.evicted = 0
+        os.makedirs(cache_path, exist_ok=True)
+        self.__load()
+
+    def __load(self) -> None:
+        files = []
+        for file_name in os.listdir(self.__cache_path):
+            if file_name.endswith(ENTRY_SUFFIX):
+                stat = os.stat(os.path.join(self.__cache_path, file_name))
+                files.append((stat.st_mtime, file_name[:-len(ENTRY_SUFFIX)], stat.st_size))
+        for _, key, size in sorted(files):
+            self.__entries[key] = size
+            self.__total_bytes += size
+
+    @staticmethod
+    def key_for(url: str) -> str:
+        return hashlib.sha256(url.encode('utf-8')).hexdigest()
+
+    def __path(self, key: str) -> str:
+        return os.path.join(self.__cache_path, key + ENTRY_SUFFIX)
+
+    def __len__(self) -> int:
+        with self.__lock:
+            return len(self.__entries)
+
+    @property
+    def total_bytes(self) -> int:
+        return self.__total_bytes
+
+    @property
+    def saved_requests(self) -> int:
+        """Number of requests answered with '304 Not Modified', which did not cost any quota."""
+        return self.not_modified
+
+    def lookup(self, url: str) -> Optional[Dict[str, str]]:
+        """Returns the cached entry of url with 'etag', 'last_modified' and 'body', or None."""
+        key = self.key_for(url)
+        with self.__lock:
+            if key not in self.__entries:
+                return None
+            self.__entries.move_to_end(key)
+        try:
+            with open(self.__path(key)) as entry_file:
+                entry = json.load(entry_file)
+            os.utime(self.__path(key))
+        except (OSError, ValueError):
+            self.__forget(key)
+            return None
+        return entry if entry.get('url') == url else None
+
+    @staticmethod
+    def conditional_headers(entry: Optional[Mapping[str, str]]) -> Dict[str, str]:
+        """Headers making a request conditional on the cached entry."""
+        headers = {}
+        if entry is not None:
+            if entry.get('etag'):
+                headers['If-None-Match'] = entry['etag']
+            if entry.get('last_modified'):
+                headers['If-Modified-Since'] = entry['last_modified']
+        return headers
+
+    def record_not_modified(self) -> None:
+        with self.__lock:
+            self.not_modified += 1
+
+    def store(self, url: str, etag: Optional[str], last_modified: Optional[str], body: str) -> None:
+        """Caches a response body, which is only useful if it carries an ETag or Last-Modified."""
+        if not etag and not last_modified:
+            return
+        key = self.key_for(url)
+        content = json.dumps({'url': url, 'etag': etag, 'last_modified': last_modified, 'body': body})
+        size = len(content.encode('utf-8'))
+        if size > self.__max_bytes:
+            return
+        temporary_path = self.__path(key) + '.tmp.{}'.format(threading.get_ident())
+        with open(temporary_path, 'w') as entry_file:
+            entry_file.write(content)
+        os.replace(temporary_path, self.__path(key))
+        with self.__lock:
+            self.__total_bytes += size - self.__entries.pop(key, 0)
+            self.__entries[key] = size
+            self.stored += 1
+            evicted = []
+            while self.__total_bytes > self.__max_bytes:
+                evicted_key, evicted_size = self.__entries.popitem(last=False)
+                self.__total_bytes -= evicted_size
+                evicted.append(evicted_key)
+            self.evicted += len(evicted)
+        for evicted_key in evicted:
+            try:
+                os.remove(self.__path(evicted_key))
+            except FileNotFoundError:
+                pass
+
+    def __forget(self, key: str) -> None:
+        with self.__lock:
+            self.__total_bytes -= self.__entries.pop(key, 0)
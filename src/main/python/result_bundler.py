@@ -0,0 +1,147 @@
+"""Collects the results of many repos in rolling, compressed JSON Lines bundles."""
+import json
+import os
+import shutil
+import threading
+import time
+from datetime import datetime
+from typing import Callable, List, Mapping, Optional
+
+from result_writer import COMPRESSIONS, PARTIAL_SUFFIX, JsonLinesResultWriter, open_compressed
+
+ENTRY_SUFFIX = '.entry.jsonl'
+
+
+class BundleEntryWriter(JsonLinesResultWriter):
+    """Writes the block of one repo inside a bundle: the lines of
+    JsonLinesResultWriter, closed by an 'end' line instead of the worker
+    configuration, which the bundle header carries once for all repos.
+    The end line of a delta result holds the delta_head it was walked to."""
+
+    def __init__(self, path: str, repo_id, delta_head: Optional[str] = None):
+        super().__init__(path)
+        self.__repo_id = repo_id
+        self.__delta_head = delta_head
+
+    def finish(self, config: Mapping, global_dict: Mapping, references: Optional[Mapping] = None) -> None:
+        end = {'end': self.__repo_id, 'commit_count': self.commit_count}
+        if self.__delta_head:
+            end['delta_head'] = self.__delta_head
+        end.update(references or {})
+        self._write_line(end)
+        self._finished = True
+
+
+def bundle_file_name(worker_id: str, sequence: int, compression: str = 'gzip') -> str:
+    """Name of a bundle, e.g. 'bundle-<worker_id>-000003.jsonl.gz'."""
+    return 'bundle-{}-{:06d}.jsonl{}'.format(worker_id, sequence, COMPRESSIONS[compression])
+
+
+class ResultBundler:
+    """Appends finished repo results to a bundle below bundles_path. The
+    first line of every bundle holds the worker's CONFIG and GLOBAL.
+
+    A bundle is closed once it holds max_bytes of uncompressed results or has been
+    open for max_age seconds, and only then handed to on_close, e.g. to be
+    uploaded. Results of concurrent tasks are written to entry files first
+    and appended as a whole, so blocks of different repos never interleave.
+
+    on_close gets the bundle path with an on_uploaded and an on_failed
+    callback, which call those passed to append for the entries of the
+    bundle with the bundle path, e.g. UploadPipeline.submit."""
+
+    def __init__(self, bundles_path: str, config: Mapping, global_dict: Mapping,
+                 on_close: Callable[[str, Callable[[str], None], Callable[[str], None]], None],
+                 compression: str = 'gzip',
+                 max_bytes: int = 64 * 1024 * 1024, max_age: float = 600):
+        self.__bundles_path = bundles_path
+        self.__config = config
+        self.__global = global_dict
+        self.__on_close = on_close
+        self.__compression = compression
+        self.__max_bytes = int(max_bytes)
+        self.__max_age = float(max_age)
+        self.__worker_id = global_dict.get('RANDOM_ID', 'worker')
+        self.__lock = threading.Lock()
+        self.__out = None
+        self.__path = None
+        self.__opened_at = None
+        self.__written_bytes = 0
+        self.__uploaded_callbacks = []  # type: List[Callable[[str], None]]
+        self.__failed_callbacks = []  # type: List[Callable[[str], None]]
+        self.__sequence = 0
+        self.closed_bundles = 0
+        os.makedirs(bundles_path, exist_ok=True)
+
+    def create_entry_writer(self, results_path: str, repo_id, delta_head: Optional[str] = None) -> BundleEntryWriter:
+        """Creates the writer for the result of one repo, to be appended with
+        append(), for a delta result with the delta_head it is walked to."""
+        return BundleEntryWriter(os.path.join(results_path, '{}{}'.format(repo_id, ENTRY_SUFFIX)), repo_id,
+                                 delta_head)
+
+    def append(self, entry_path: str, on_uploaded: Optional[Callable[[str], None]] = None,
+               on_failed: Optional[Callable[[str], None]] = None) -> None:
+        """Moves the result written by an entry writer into the current
+        bundle. on_uploaded and on_failed are called with the bundle path
+        once the bundle is uploaded or given up on, see on_close."""
+        with self.__lock:
+            if self.__out is None:
+                self.__open()
+            with open(entry_path, 'rb') as entry_file:
+                shutil.copyfileobj(entry_file, self.__out)
+                self.__written_bytes += entry_file.tell()
+            os.remove(entry_path)
+            if on_uploaded is not None:
+                self.__uploaded_callbacks.append(on_uploaded)
+            if on_failed is not None:
+                self.__failed_callbacks.append(on_failed)
+            self.__rotate_if_due()
+
+    def rotate_if_due(self) -> None:
+        """Closes the current bundle if it is too large or too old. Call it
+        regularly, so bundles of a quiet worker do not stay open forever."""
+        with self.__lock:
+            self.__rotate_if_due()
+
+    def close(self) -> None:
+        """Closes the current bundle, if any."""
+        with self.__lock:
+            self.__close()
+
+    def __open(self) -> None:
+        self.__sequence += 1
+        self.__path = os.path.join(self.__bundles_path,
+                                   bundle_file_name(self.__worker_id, self.__sequence, self.__compression))
+        self.__out = open_compressed(self.__path + PARTIAL_SUFFIX, self.__compression)
+        self.__opened_at = time.monotonic()
+        header = {'CONFIG': self.__config, 'GLOBAL': self.__global,
+                  'bundle': {'sequence': self.__sequence, 'opened_at': datetime.utcnow().isoformat()}}
+        header_line = json.dumps(header).encode('utf-8') + b'\n'
+        self.__out.write(header_line)
+        self.__written_bytes = len(header_line)
+
+    def __rotate_if_due(self) -> None:
+        if self.__out is None:
+            return
+        if time.monotonic() - self.__opened_at >= self.__max_age or self.__written_bytes >= self.__max_bytes:
+            self.__close()
+
+    def __close(self) -> None:
+        if self.__out is None:
+            return
+        self.__out.close()
+        self.__out = None
+        os.replace(self.__path + PARTIAL_SUFFIX, self.__path)
+        self.closed_bundles += 1
+        on_uploaded = _call_all(self.__uploaded_callbacks)
+        on_failed = _call_all(self.__failed_callbacks)
+        self.__uploaded_callbacks = []
+        self.__failed_callbacks = []
+        self.__on_close(self.__path, on_uploaded, on_failed)
+
+
+def _call_all(callbacks: List[Callable[[str], None]]) -> Callable[[str], None]:
+    def call_all(bundle_path: str) -> None:
+        for callback in callbacks:
+            callback(bundle_path)
+    return call_all
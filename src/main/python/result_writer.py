@@ -0,0 +1,361 @@
+"""Incremental writers for crawl results, emitting commits while they are walked."""
+import abc
+import gzip
+import io
+import json
+import os
+import sqlite3
+from typing import Dict, List, Mapping, Optional
+
+from commit_graph import SHA_BYTES, commit_dict_for
+
+RESULT_FORMATS = ('json', 'jsonl', 'sqlite', 'parquet')
+# Formats compressing inside the file, their names carry no compression suffix.
+SELF_CONTAINED_FORMATS = ('sqlite', 'parquet')
+COMPRESSIONS = {'none': '', 'gzip': '.gz', 'zstd': '.zst'}
+PARTIAL_SUFFIX = '.part'
+PARQUET_CODECS = {'none': 'snappy', 'gzip': 'gzip', 'zstd': 'zstd'}
+
+
+class UnsupportedResultOptionException(Exception):
+    """Exception thrown when a result format or compression is unknown or
+    its optional dependency is not installed."""
+    pass
+
+
+def open_compressed(path: str, compression: str = 'none'):
+    """Opens path for binary writing through the requested compression."""
+    if compression == 'none':
+        return open(path, 'wb')
+    if compression == 'gzip':
+        return gzip.open(path, 'wb', compresslevel=6)
+    if compression == 'zstd':
+        try:
+            import zstandard
+        except ImportError:
+            raise UnsupportedResultOptionException('zstd compression requires the zstandard package')
+        return zstandard.ZstdCompressor(level=3).stream_writer(open(path, 'wb'))
+    raise UnsupportedResultOptionException('Unknown compression {}'.format(compression))
+
+
+def result_file_name(repo_id, result_format: str = 'json', compression: str = 'none',
+                     delta_head: Optional[str] = None, delta_base: Optional[str] = None) -> str:
+    """Name of the result file of a repo, e.g. '42-steak.json.gz'. Delta
+    results are told apart by the HEAD they were crawled up to and the one
+    of the previous crawl they start from, if known, e.g.
+    '42-delta-ba9876543210-0123456789ab-steak.json.gz'."""
+    if result_format not in RESULT_FORMATS:
+        raise UnsupportedResultOptionException('Unknown result format {}'.format(result_format))
+    if compression not in COMPRESSIONS:
+        raise UnsupportedResultOptionException('Unknown compression {}'.format(compression))
+    if delta_head and delta_base:
+        repo_id = '{}-delta-{}-{}'.format(repo_id, delta_base[:12], delta_head[:12])
+    elif delta_head:
+        repo_id = '{}-delta-{}'.format(repo_id, delta_head[:12])
+    if result_format in SELF_CONTAINED_FORMATS:
+        return '{}-steak.{}'.format(repo_id, result_format)
+    return '{}-steak.{}{}'.format(repo_id, result_format, COMPRESSIONS[compression])
+
+
+def encodable_message(message: Optional[str]) -> Optional[str]:
+    """Returns the commit message as text UTF-8 can encode. Messages with
+    escaped astral characters decode to surrogates, pairs of them are
+    joined to the character and lone ones replaced by U+FFFD."""
+    if message is None:
+        return None
+    try:
+        message.encode('utf-8')
+        return message
+    except UnicodeEncodeError:
+        return message.encode('utf-16-le', errors='surrogatepass').decode('utf-16-le', errors='replace')
+
+
+class ResultWriter(abc.ABC):
+    """Writes one repo result to disk piece by piece so the full result never
+    has to be held in memory. The file is written under a temporary name and
+    only moved to its final path once finish() was called and it is closed."""
+
+    def __init__(self, path: str, compression: str = 'none'):
+        self.path = path
+        self._partial_path = path + PARTIAL_SUFFIX
+        self._finished = False
+        self.commit_count = 0
+        self._out = self._open(compression)
+
+    def _open(self, compression: str):
+        """Opens the output at the partial path, a text stream through the
+        compression unless a format needs another kind of output."""
+        return io.TextIOWrapper(open_compressed(self._partial_path, compression), encoding='utf-8')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    @abc.abstractmethod
+    def begin(self, meta: Mapping, languages: Mapping) -> None:
+        """Writes the repository meta data preceding all commits."""
+
+    @abc.abstractmethod
+    def write_commit(self, sha: str, parent_shas: List[str], message: Optional[str]) -> None:
+        """Appends a single commit to the result."""
+
+    @abc.abstractmethod
+    def finish(self, config: Mapping, global_dict: Mapping, references: Optional[Mapping] = None) -> None:
+        """Writes the trailing worker configuration and marks the result complete.
+
+        references are sections linking the result to results crawled
+        before: known_commits maps commits the walk stopped at to the id of
+        the repo whose result holds their history, previous_crawl describes
+        the crawl a delta result continues. skipped records why the commits
+        of a repo were not crawled."""
+
+    def written_bytes(self) -> int:
+        """Size of the unfinished result on disk so far."""
+        try:
+            return os.path.getsize(self._partial_path)
+        except FileNotFoundError:
+            return 0
+
+    def close(self) -> None:
+        """Closes the file, moving a finished result to its final path and
+        discarding an unfinished one."""
+        if self._out is None:
+            return
+        self._out.close()
+        self._out = None
+        if self._finished:
+            os.replace(self._partial_path, self.path)
+        else:
+            os.remove(self._partial_path)
+
+
+class JsonResultWriter(ResultWriter):
+    """Streams the same document json.dumps(result_dict) used to produce:
+    {"meta": ..., "languages": ..., "commits": {sha: {...}}, "CONFIG": ..., "GLOBAL": ...}
+
+    References to earlier results, e.g. "known_commits", come before "CONFIG"."""
+
+    def begin(self, meta: Mapping, languages: Mapping) -> None:
+        self._out.write('{"meta": ')
+        self._out.write(json.dumps(meta))
+        self._out.write(', "languages": ')
+        self._out.write(json.dumps(languages))
+        self._out.write(', "commits": {')
+
+    def write_commit(self, sha: str, parent_shas: List[str], message: Optional[str]) -> None:
+        if self.commit_count:
+            self._out.write(', ')
+        self._out.write(json.dumps(sha))
+        self._out.write(': ')
+        self._out.write(json.dumps(commit_dict_for(parent_shas, message)))
+        self.commit_count += 1
+
+    def finish(self, config: Mapping, global_dict: Mapping, references: Optional[Mapping] = None) -> None:
+        self._out.write('}')
+        for name, section in (references or {}).items():
+            self._out.write(', {}: '.format(json.dumps(name)))
+            self._out.write(json.dumps(section))
+        self._out.write(', "CONFIG": ')
+        self._out.write(json.dumps(config))
+        self._out.write(', "GLOBAL": ')
+        self._out.write(json.dumps(global_dict))
+        self._out.write('}')
+        self._finished = True
+
+
+class JsonLinesResultWriter(ResultWriter):
+    """Writes one JSON document per line: first the meta data, then one line
+    per commit carrying its 'sha' and finally the worker configuration."""
+
+    def _write_line(self, line_dict: Mapping) -> None:
+        self._out.write(json.dumps(line_dict))
+        self._out.write('\n')
+
+    def begin(self, meta: Mapping, languages: Mapping) -> None:
+        self._write_line({'meta': meta, 'languages': languages})
+
+    def write_commit(self, sha: str, parent_shas: List[str], message: Optional[str]) -> None:
+        commit_dict = {'sha': sha}
+        commit_dict.update(commit_dict_for(parent_shas, message))
+        self._write_line(commit_dict)
+        self.commit_count += 1
+
+    def finish(self, config: Mapping, global_dict: Mapping, references: Optional[Mapping] = None) -> None:
+        if references:
+            self._write_line(references)
+        self._write_line({'CONFIG': config, 'GLOBAL': global_dict})
+        self._finished = True
+
+
+class SqliteResultWriter(ResultWriter):
+    """Writes the result into a SQLite database holding the table repos, one
+    row with meta data, languages, references and worker configuration as
+    JSON, and the table commits, one row per commit. SHAs are stored as
+    20-byte blobs, parents as their concatenation, use hex() to read them.
+    commits is indexed by repo_id and sha, so results can be queried right
+    away or merged into one database with ATTACH.
+
+    The database is not compressed beyond the binary SHAs."""
+
+    INSERT_BATCH = 1000
+
+    def _open(self, compression: str):
+        if compression != 'none':
+            raise UnsupportedResultOptionException('sqlite results can not be compressed')
+        if os.path.exists(self._partial_path):
+            os.remove(self._partial_path)
+        connection = sqlite3.connect(self._partial_path, isolation_level=None)
+        # The partial file is discarded on any failure, there is nothing to journal.
+        connection.execute('PRAGMA journal_mode=OFF')
+        connection.execute('PRAGMA synchronous=OFF')
+        connection.execute('CREATE TABLE repos (repo_id INTEGER PRIMARY KEY, full_name TEXT, meta TEXT,'
+                           ' languages TEXT, refs TEXT, config TEXT, global TEXT)')
+        connection.execute('CREATE TABLE commits (repo_id INTEGER NOT NULL, sha BLOB NOT NULL,'
+                           ' parents BLOB, message TEXT)')
+        connection.execute('BEGIN')
+        self.__repo_id = None
+        self.__rows = []
+        return connection
+
+    def begin(self, meta: Mapping, languages: Mapping) -> None:
+        self.__repo_id = meta['id']
+        self._out.execute('INSERT INTO repos (repo_id, full_name, meta, languages) VALUES (?, ?, ?, ?)',
+                          (self.__repo_id, meta.get('full_name'), json.dumps(meta), json.dumps(languages)))
+
+    def write_commit(self, sha: str, parent_shas: List[str], message: Optional[str]) -> None:
+        parents = b''.join(bytes.fromhex(parent_sha) for parent_sha in parent_shas)
+        self.__rows.append((self.__repo_id, bytes.fromhex(sha), parents or None, encodable_message(message)))
+        self.commit_count += 1
+        if len(self.__rows) >= self.INSERT_BATCH:
+            self.__insert_rows()
+
+    def __insert_rows(self) -> None:
+        self._out.executemany('INSERT INTO commits (repo_id, sha, parents, message) VALUES (?, ?, ?, ?)',
+                              self.__rows)
+        self.__rows = []
+
+    def finish(self, config: Mapping, global_dict: Mapping, references: Optional[Mapping] = None) -> None:
+        self.__insert_rows()
+        self._out.execute('UPDATE repos SET refs = ?, config = ?, global = ? WHERE repo_id = ?',
+                          (json.dumps(references or {}), json.dumps(config), json.dumps(global_dict),
+                           self.__repo_id))
+        # Indexes built once at the end are cheaper than maintained on every insert.
+        self._out.execute('CREATE INDEX commits_repo_id ON commits (repo_id)')
+        self._out.execute('CREATE INDEX commits_sha ON commits (sha)')
+        self._out.execute('COMMIT')
+        self._finished = True
+
+
+class ParquetResultWriter(ResultWriter):
+    """Writes the commits as Parquet file with the columns repo_id, index,
+    sha, parent_indexes and message, in row groups of ROW_GROUP_SIZE commits.
+    SHAs are stored as their 20 raw bytes and repo_id, the same in every
+    row, dictionary encoded.
+
+    Every SHA gets the next index when it is first seen, as commit or as
+    parent, so parent_indexes refer to the index column. Parents without a
+    row of their own, e.g. known commits, are listed in the file metadata
+    under external_parents together with meta, languages, references and
+    the worker configuration, all as JSON.
+
+    Requires pyarrow 11 or later. The columns are compressed with snappy, or
+    with gzip or zstd if that is the configured compression."""
+
+    ROW_GROUP_SIZE = 10000
+
+    def _open(self, compression: str):
+        try:
+            import pyarrow
+            import pyarrow.parquet
+        except ImportError:
+            raise UnsupportedResultOptionException('parquet results require the pyarrow package')
+        self.__pyarrow = pyarrow
+        self.__parquet = pyarrow.parquet
+        self.__codec = PARQUET_CODECS[compression]
+        self.__repo_id = None
+        self.__indexes = {}  # type: Dict[bytes, int]
+        self.__written = bytearray()
+        self.__columns = self.__empty_columns()
+        # The writer needs the schema with its metadata, it is created by begin().
+        return None
+
+    @staticmethod
+    def __empty_columns() -> Dict[str, list]:
+        return {'index': [], 'sha': [], 'parent_indexes': [], 'message': []}
+
+    def __index_of(self, binary_sha: bytes) -> int:
+        index = self.__indexes.get(binary_sha)
+        if index is None:
+            index = len(self.__indexes)
+            self.__indexes[binary_sha] = index
+            if index % 8 == 0:
+                self.__written.append(0)
+        return index
+
+    def begin(self, meta: Mapping, languages: Mapping) -> None:
+        pyarrow = self.__pyarrow
+        self.__repo_id = meta['id']
+        schema = pyarrow.schema([
+            ('repo_id', pyarrow.dictionary(pyarrow.int32(), pyarrow.int64())),
+            ('index', pyarrow.int32()),
+            ('sha', pyarrow.binary(SHA_BYTES)),
+            ('parent_indexes', pyarrow.list_(pyarrow.int32())),
+            ('message', pyarrow.string()),
+        ], metadata={'meta': json.dumps(meta), 'languages': json.dumps(languages)})
+        # Only repo_id repeats, the indexes mostly count up by one. zstd
+        # defaults to level 1, level 3 packs messages a tenth smaller.
+        self._out = self.__parquet.ParquetWriter(self._partial_path, schema, compression=self.__codec,
+                                                 compression_level=3 if self.__codec == 'zstd' else None,
+                                                 use_dictionary=['repo_id'],
+                                                 column_encoding={'index': 'DELTA_BINARY_PACKED',
+                                                                  'parent_indexes.list.element': 'DELTA_BINARY_PACKED'})
+
+    def write_commit(self, sha: str, parent_shas: List[str], message: Optional[str]) -> None:
+        binary_sha = bytes.fromhex(sha)
+        index = self.__index_of(binary_sha)
+        self.__written[index >> 3] |= 1 << (index & 7)
+        columns = self.__columns
+        columns['index'].append(index)
+        columns['sha'].append(binary_sha)
+        columns['parent_indexes'].append([self.__index_of(bytes.fromhex(parent_sha)) for parent_sha in parent_shas])
+        columns['message'].append(encodable_message(message))
+        self.commit_count += 1
+        if len(columns['sha']) >= self.ROW_GROUP_SIZE:
+            self.__write_row_group()
+
+    def __write_row_group(self) -> None:
+        if not self.__columns['sha']:
+            return
+        self.__columns['repo_id'] = [self.__repo_id] * len(self.__columns['sha'])
+        self._out.write_table(self.__pyarrow.table(self.__columns, schema=self._out.schema))
+        self.__columns = self.__empty_columns()
+
+    def finish(self, config: Mapping, global_dict: Mapping, references: Optional[Mapping] = None) -> None:
+        self.__write_row_group()
+        external_parents = {str(index): binary_sha.hex() for binary_sha, index in self.__indexes.items()
+                            if not self.__written[index >> 3] & (1 << (index & 7))}
+        self._out.add_key_value_metadata({
+            'external_parents': json.dumps(external_parents),
+            'references': json.dumps(references or {}),
+            'CONFIG': json.dumps(config),
+            'GLOBAL': json.dumps(global_dict),
+        })
+        self._finished = True
+
+
+WRITERS = {
+    'json': JsonResultWriter,
+    'jsonl': JsonLinesResultWriter,
+    'sqlite': SqliteResultWriter,
+    'parquet': ParquetResultWriter,
+}
+
+
+def create_result_writer(results_path: str, repo_id, result_format: str = 'json',
+                         compression: str = 'none', delta_head: Optional[str] = None,
+                         delta_base: Optional[str] = None) -> ResultWriter:
+    """Creates the writer for the given format inside results_path."""
+    path = os.path.join(results_path, result_file_name(repo_id, result_format, compression, delta_head, delta_base))
+    return WRITERS[result_format](path, compression)
@@ -1,8 +1,22 @@
 """Encapsulate SQS.Queue calls."""
 
 import json
+import logging
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 
 import boto3
+from botocore import exceptions
+
+from message_queue import MessageLeaseKeeper, MessageQueue, NoMessagesAfterLongPollingAvailableException
+
+MAX_RECEIVE_BATCH = 10
+MAX_SEND_BATCH = 10
+MAX_SEND_BATCH_BYTES = 256 * 1024
+
+LOGGER = logging.getLogger(__name__)
 
 
 def dict_for_message(message):
@@ -12,28 +26,62 @@ def dict_for_message(message):
     return message
 
 
-class SqsMessageQueue:
-    """Encapsulates reading boto3.SQS.Queue calls. """
+class SqsMessageQueue(MessageQueue):
+    """Encapsulates reading boto3.SQS.Queue calls.
+
+    With a prefetch_size above 0 a background thread receives up to ten
+    messages per long poll into a local buffer of that size, so popping a
+    message does not wait on SQS. Buffered messages are leased by SQS for
+    msg_visibility_timeout seconds at a time and a MessageLeaseKeeper renews
+    their leases on a timer, at the latest lease_margin seconds before they
+    run out. A popped message gets its lease renewed once more, so a handler
+    has the same time as for an unbuffered message. Messages whose lease
+    could not be renewed are dropped and left to SQS to redeliver."""
 
     def __init__(self, botosession: boto3.session.Session, queue_address: str,
-                 msg_visibility_timeout: int = 600, wait_time: int = 20):
+                 msg_visibility_timeout: int = 600, wait_time: int = 20,
+                 prefetch_size: int = 0, lease_margin: float = 5,
+                 send_concurrency: int = 4, send_attempts: int = 3):
         self._session = botosession
         self._queue_address = queue_address
         self._msq_queue = self._session.resource('sqs').Queue(self._queue_address)
         self._vis_timeout = msg_visibility_timeout
         self._wait_time = wait_time
+        self._prefetch_size = prefetch_size
+        self._send_concurrency = send_concurrency
+        self._send_attempts = send_attempts
+        self._buffer = deque()
+        self._buffer_changed = threading.Condition()
+        self._empty_polls = 0
+        self._closed = False
+        self.expired_leases = 0
+        self._poller = None
+        self._lease_keeper = None
+        if prefetch_size > 0:
+            self._lease_keeper = MessageLeaseKeeper(self, msg_visibility_timeout,
+                                                    max(msg_visibility_timeout - lease_margin, 0.1) / 2)
+            # boto3 resources are not thread safe, the poller gets one of its own.
+            poll_queue = self._session.resource('sqs').Queue(self._queue_address)
+            self._poller = threading.Thread(target=self._poll, args=(poll_queue,),
+                                            name='raq_sqs_prefetch', daemon=True)
+            self._poller.start()
 
-    def pop_next_message(self):
-        """Receives one message with all attributes available. Uses Long Polling
-        as there might be worker refilling the queue. Raises an exception if nothing is received
-        as the refilling should take less than 20 seconds. It """
-        messages = self._msq_queue.receive_messages(
+    def _receive(self, msg_queue, max_messages: int):
+        return msg_queue.receive_messages(
             AttributeNames=['All'],
             MessageAttributeNames=['All'],
-            MaxNumberOfMessages=1,
+            MaxNumberOfMessages=max_messages,
             VisibilityTimeout=self._vis_timeout,
             WaitTimeSeconds=self._wait_time,
         )
+
+    def pop_next_message(self):
+        """Receives one message with all attributes available. Uses Long Polling
+        as there might be worker refilling the queue. Raises an exception if nothing is received
+        as the refilling should take less than 20 seconds. It """
+        if self._poller is not None:
+            return self._pop_buffered_message()
+        messages = self._receive(self._msq_queue, 1)
         if not messages:
             raise NoMessagesAfterLongPollingAvailableException("No Messages receivable from Queue")
         elif len(messages) == 1:
@@ -41,6 +89,103 @@ class SqsMessageQueue:
         else:
             raise Exception("Received more Messages than intended")
 
+    def pop_messages(self, max_messages: int = MAX_RECEIVE_BATCH):
+        """Receives up to max_messages, at most ten unless prefetching, with
+        one long poll. Returns an empty list if nothing is received."""
+        if self._poller is None:
+            return [dict_for_message(message)
+                    for message in self._receive(self._msq_queue, min(max_messages, MAX_RECEIVE_BATCH))]
+        try:
+            messages = [self._pop_buffered_message()]
+        except NoMessagesAfterLongPollingAvailableException:
+            return []
+        with self._buffer_changed:
+            while self._buffer and len(messages) < max_messages:
+                message = self._buffer.popleft()
+                if self._renew_lease(message):
+                    messages.append(dict_for_message(message))
+            self._buffer_changed.notify_all()
+        return messages
+
+    def _pop_buffered_message(self):
+        with self._buffer_changed:
+            empty_polls = self._empty_polls
+            while True:
+                while self._buffer:
+                    message = self._buffer.popleft()
+                    self._buffer_changed.notify_all()
+                    if self._renew_lease(message):
+                        return dict_for_message(message)
+                if self._closed:
+                    raise NoMessagesAfterLongPollingAvailableException("Queue is closed")
+                if self._empty_polls > empty_polls:
+                    raise NoMessagesAfterLongPollingAvailableException("No Messages receivable from Queue")
+                self._buffer_changed.wait()
+
+    def _renew_lease(self, message) -> bool:
+        self._lease_keeper.release(message)
+        try:
+            message.change_visibility(VisibilityTimeout=self._vis_timeout)
+        except exceptions.ClientError as client_error:
+            LOGGER.warning('Dropping buffered message %s: %s', message.message_id, client_error)
+            self.expired_leases += 1
+            return False
+        return True
+
+    def _poll(self, msg_queue):
+        while True:
+            with self._buffer_changed:
+                while not self._closed and len(self._buffer) >= self._prefetch_size:
+                    self._buffer_changed.wait()
+                if self._closed:
+                    return
+                free_slots = min(self._prefetch_size - len(self._buffer), MAX_RECEIVE_BATCH)
+            try:
+                messages = self._receive(msg_queue, free_slots)
+            except Exception as poll_error:
+                LOGGER.warning('Receiving messages failed: %s', poll_error)
+                time.sleep(1)
+                continue
+            for message in messages:
+                self._lease_keeper.hold(message)
+            with self._buffer_changed:
+                self._buffer.extend(messages)
+                if self._closed:
+                    return
+                if not messages:
+                    self._empty_polls += 1
+                self._buffer_changed.notify_all()
+
+    @property
+    def buffered(self) -> int:
+        """Number of received messages waiting in the prefetch buffer."""
+        with self._buffer_changed:
+            return len(self._buffer)
+
+    def approximate_depth(self) -> int:
+        """ApproximateNumberOfMessages of the queue, asked through the thread safe client."""
+        response = self._msq_queue.meta.client.get_queue_attributes(
+            QueueUrl=self._msq_queue.url, AttributeNames=['ApproximateNumberOfMessages'])
+        return int(response['Attributes']['ApproximateNumberOfMessages'])
+
+    def close(self):
+        """Stops prefetching and makes all buffered messages visible to other workers again."""
+        with self._buffer_changed:
+            self._closed = True
+            self._buffer_changed.notify_all()
+        if self._poller is not None:
+            self._poller.join(timeout=self._wait_time + 5)
+        if self._lease_keeper is not None:
+            self._lease_keeper.close()
+        with self._buffer_changed:
+            buffered = list(self._buffer)
+            self._buffer.clear()
+        for message in buffered:
+            try:
+                message.change_visibility(VisibilityTimeout=0)
+            except exceptions.ClientError as client_error:
+                LOGGER.warning('Could not release buffered message %s: %s', message.message_id, client_error)
+
     def write_message(self, message_dict: dict, message_attributes_dict: dict = {}):
         """Writes the provided dict JSON-encoded into the Msg Queue."""
         msg_body = json.dumps(message_dict)
@@ -53,7 +198,66 @@ class SqsMessageQueue:
             raise Exception("")
         return response
 
+    def write_messages(self, message_dicts, message_attributes_dict: dict = {}) -> int:
+        """Writes the provided dicts JSON-encoded into the Msg Queue, ten per
+        SendMessageBatch call and several calls at once. Entries the batch
+        reports as failed are resent, unless SQS blames the sender.
+
+        Returns the number of messages written, raises
+        BatchWriteFailedException if some could not be written."""
+        entries = [{
+            'Id': str(index),
+            'MessageBody': json.dumps(message_dict),
+            'DelaySeconds': 0,
+            'MessageAttributes': message_attributes_dict,
+        } for index, message_dict in enumerate(message_dicts)]
+        batches = list(batches_of_entries(entries))
+        if len(batches) <= 1 or self._send_concurrency <= 1:
+            failures = [failure for batch in batches for failure in self._send_batch(batch)]
+        else:
+            # The low level client is thread safe, unlike the Queue resource.
+            with ThreadPoolExecutor(max_workers=min(self._send_concurrency, len(batches)),
+                                    thread_name_prefix='raq_sqs_send') as executor:
+                failures = [failure for batch_failures in executor.map(self._send_batch, batches)
+                            for failure in batch_failures]
+        if failures:
+            raise BatchWriteFailedException('{} of {} messages could not be written: {}'.format(
+                len(failures), len(entries), failures))
+        return len(entries)
+
+    def _send_batch(self, entries):
+        client = self._msq_queue.meta.client
+        rejected = []
+        for attempt in range(1, self._send_attempts + 1):
+            response = client.send_message_batch(QueueUrl=self._msq_queue.url, Entries=entries)
+            failed = response.get('Failed', [])
+            rejected.extend(failure for failure in failed if failure.get('SenderFault'))
+            retryable_ids = {failure['Id'] for failure in failed if not failure.get('SenderFault')}
+            entries = [entry for entry in entries if entry['Id'] in retryable_ids]
+            if not entries or attempt == self._send_attempts:
+                break
+            LOGGER.debug('Resending %d messages of a batch', len(entries))
+            time.sleep(0.1 * 2 ** (attempt - 1))
+        return rejected + [failure for failure in failed if failure['Id'] in retryable_ids]
+
+
+def batches_of_entries(entries):
+    """Groups send entries into batches within the SQS limits of ten
+    messages and 256 KiB per SendMessageBatch call."""
+    batch = []
+    batch_bytes = 0
+    for entry in entries:
+        entry_bytes = len(entry['MessageBody'].encode('utf-8')) + len(json.dumps(entry['MessageAttributes']))
+        if batch and (len(batch) == MAX_SEND_BATCH or batch_bytes + entry_bytes > MAX_SEND_BATCH_BYTES):
+            yield batch
+            batch = []
+            batch_bytes = 0
+        batch.append(entry)
+        batch_bytes += entry_bytes
+    if batch:
+        yield batch
+
 
-class NoMessagesAfterLongPollingAvailableException(Exception):
-    """Exception throws when no Messages are received after a Long Polling."""
+class BatchWriteFailedException(Exception):
+    """Exception thrown when messages of a batch write could not be written."""
     pass
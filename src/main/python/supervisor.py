@@ -0,0 +1,109 @@
+"""Forks worker processes off a process initialized once and keeps them
+running, so restarting a crashed worker costs a fork instead of a cold
+start with configuration, AWS session and STS call."""
+import logging
+import multiprocessing
+import multiprocessing.connection
+import signal
+import time
+from typing import Callable, Dict, Optional, Tuple
+
+LOGGER = logging.getLogger(__name__)
+
+
+def _run_worker(target: Callable[[int], None], slot: int) -> None:
+    # The supervisor's SIGTERM handler is inherited by the fork.
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    target(slot)
+
+
+class WorkerSupervisor:
+    """Runs target(slot) for every slot in range(workers), each in a process
+    forked off this one, sharing whatever was set up before.
+
+    Workers exiting with code 0 are done and not restarted. Others are
+    forked again after restart_delay seconds, doubling up to
+    max_restart_delay for workers that crash within min_uptime seconds
+    of their start. on_exit(slot) is called in this process whenever a
+    worker exited, before it is restarted, e.g. to clean up after it."""
+
+    def __init__(self, target: Callable[[int], None], workers: int, restart_delay: float = 1.0,
+                 max_restart_delay: float = 60.0, min_uptime: float = 10.0,
+                 on_exit: Optional[Callable[[int], None]] = None):
+        if workers < 1:
+            raise ValueError('A supervisor needs at least one worker')
+        self.__target = target
+        self.__workers = workers
+        self.__restart_delay = restart_delay
+        self.__max_restart_delay = max_restart_delay
+        self.__min_uptime = min_uptime
+        self.__on_exit = on_exit
+        self.__context = multiprocessing.get_context('fork')
+        self.__processes = {}  # type: Dict[int, Tuple[multiprocessing.Process, float]]
+        self.__delays = {slot: restart_delay for slot in range(workers)}
+        self.__restart_at = {}  # type: Dict[int, float]
+        self.__stopping = False
+        self.restarts = 0
+
+    def __start(self, slot: int) -> None:
+        process = self.__context.Process(target=_run_worker, args=(self.__target, slot),
+                                         name='raq_worker_{}'.format(slot))
+        process.start()
+        self.__processes[slot] = (process, time.monotonic())
+        LOGGER.info('Started worker %s as process %s', slot, process.pid)
+
+    def __reap(self, now: float) -> None:
+        for slot, (process, started) in list(self.__processes.items()):
+            if process.exitcode is None:
+                continue
+            process.join()
+            del self.__processes[slot]
+            if self.__on_exit is not None:
+                try:
+                    self.__on_exit(slot)
+                except Exception:
+                    LOGGER.exception('Cleaning up after worker %s failed', slot)
+            if process.exitcode == 0 or self.__stopping:
+                LOGGER.info('Worker %s exited with %s', slot, process.exitcode)
+                continue
+            if now - started < self.__min_uptime:
+                delay = self.__delays[slot]
+                self.__delays[slot] = min(delay * 2, self.__max_restart_delay)
+            else:
+                delay = self.__delays[slot] = self.__restart_delay
+            LOGGER.warning('Worker %s exited with %s, restarting it in %ss', slot, process.exitcode, delay)
+            self.__restart_at[slot] = now + delay
+
+    def __next_timeout(self, now: float) -> Optional[float]:
+        if not self.__restart_at:
+            return None
+        return max(min(self.__restart_at.values()) - now, 0)
+
+    def run(self) -> None:
+        """Starts the workers and supervises them until all exited with code
+        0 or stop() was called. SIGTERM calls stop()."""
+        previous_handler = signal.signal(signal.SIGTERM, lambda signum, frame: self.stop())
+        try:
+            for slot in range(self.__workers):
+                self.__start(slot)
+            while self.__processes or self.__restart_at:
+                multiprocessing.connection.wait([process.sentinel for process, _ in self.__processes.values()],
+                                                self.__next_timeout(time.monotonic()))
+                now = time.monotonic()
+                self.__reap(now)
+                if self.__stopping:
+                    self.__restart_at.clear()
+                for slot, restart_at in list(self.__restart_at.items()):
+                    if restart_at <= now:
+                        del self.__restart_at[slot]
+                        self.restarts += 1
+                        self.__start(slot)
+        finally:
+            signal.signal(signal.SIGTERM, previous_handler)
+
+    def stop(self) -> None:
+        """Terminates the workers without restarting them."""
+        self.__stopping = True
+        for process, _ in list(self.__processes.values()):
+            if process.exitcode is None:
+                process.terminate()
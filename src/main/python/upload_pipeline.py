@@ -0,0 +1,209 @@
+"""Uploads finished result files in the background over long-lived FTPS sessions."""
+import ftplib
+import logging
+import os
+import queue
+import shutil
+import threading
+import time
+from typing import Callable, Optional
+
+from crawler_metrics import BYTES_BUCKETS, REGISTRY, MetricsRegistry
+
+DEFAULT_TARGET_DIR = 'ftp/raq/results'
+PARTIAL_SUFFIX = '.part'
+
+LOGGER = logging.getLogger(__name__)
+
+
+class FtpsUploader:
+    """Keeps one logged in FTPS session with protected data channel open and
+    stores files through it. The session is opened on first use and after
+    any failure, so a dropped connection only costs the failing upload.
+
+    Files are stored under a temporary name and renamed afterwards, so the
+    server never shows a partially uploaded file under its final name."""
+
+    def __init__(self, address: str, user: str, password: str, target_dir: str = DEFAULT_TARGET_DIR,
+                 timeout: float = 60, ftp_factory: Callable[[], ftplib.FTP] = ftplib.FTP_TLS):
+        host, _, port = address.partition(':')
+        self.__host = host
+        self.__port = int(port) if port else 0
+        self.__user = user
+        self.__password = password
+        self.__target_dir = target_dir.rstrip('/')
+        self.__timeout = timeout
+        self.__ftp_factory = ftp_factory
+        self.__ftp = None  # type: Optional[ftplib.FTP]
+        self.connects = 0
+
+    def __connection(self) -> ftplib.FTP:
+        if self.__ftp is None:
+            ftp = self.__ftp_factory()
+            ftp.connect(self.__host, self.__port, timeout=self.__timeout)
+            ftp.login(user=self.__user, passwd=self.__password)
+            if hasattr(ftp, 'prot_p'):
+                ftp.prot_p()
+            self.__ftp = ftp
+            self.connects += 1
+        return self.__ftp
+
+    def upload(self, file_path: str) -> str:
+        """Stores the file under its name in the target directory and returns the remote path."""
+        file_name = os.path.basename(file_path)
+        target_path = '{}/{}'.format(self.__target_dir, file_name)
+        try:
+            ftp = self.__connection()
+            with open(file_path, 'rb') as file_handle:
+                ftp.storbinary('STOR {}'.format(target_path + PARTIAL_SUFFIX), file_handle)
+            ftp.rename(target_path + PARTIAL_SUFFIX, target_path)
+        except ftplib.all_errors:
+            self.__disconnect()
+            raise
+        return target_path
+
+    def __disconnect(self) -> None:
+        if self.__ftp is not None:
+            try:
+                self.__ftp.close()
+            finally:
+                self.__ftp = None
+
+    def close(self) -> None:
+        """Ends the session politely, dropping it if the server does not answer."""
+        if self.__ftp is not None:
+            try:
+                self.__ftp.quit()
+            except ftplib.all_errors:
+                pass
+            self.__disconnect()
+
+
+class UploadPipeline:
+    """Spools finished result files below spool_path and uploads them from
+    worker threads, each owning an uploader created by uploader_factory.
+
+    Failed uploads are retried with exponential backoff. A file that still
+    fails after max_attempts stays in the spool, as do files left when the
+    pipeline is closed; they are picked up again by the next pipeline on the
+    same spool_path.
+
+    Callbacks passed to submit get the spooled path once the file is
+    uploaded or given up on, e.g. to acknowledge the task that produced it
+    only when its result arrived."""
+
+    def __init__(self, uploader_factory: Callable[[], FtpsUploader], spool_path: str, workers: int = 1,
+                 max_attempts: int = 5, backoff: float = 1, max_backoff: float = 60,
+                 metrics: Optional[MetricsRegistry] = None):
+        self.__uploader_factory = uploader_factory
+        self.__spool_path = spool_path
+        self.__max_attempts = max_attempts
+        self.__backoff = backoff
+        self.__max_backoff = max_backoff
+        self.__metrics = metrics if metrics is not None else REGISTRY
+        self.__pending = queue.Queue()
+        self.__stopping = threading.Event()
+        self.__lock = threading.Lock()
+        self.uploaded = 0
+        self.failed = 0
+        os.makedirs(spool_path, exist_ok=True)
+        for file_name in sorted(os.listdir(spool_path)):
+            if not file_name.endswith(PARTIAL_SUFFIX):
+                self.__pending.put((os.path.join(spool_path, file_name), None, None))
+        self.__workers = [threading.Thread(target=self.__work, name='raq_upload_{}'.format(number), daemon=True)
+                          for number in range(workers)]
+        for worker in self.__workers:
+            worker.start()
+
+    @property
+    def pending(self) -> int:
+        """Number of spooled files not uploaded yet, excluding those being uploaded."""
+        return self.__pending.qsize()
+
+    def submit(self, file_path: str, on_uploaded: Optional[Callable[[str], None]] = None,
+               on_failed: Optional[Callable[[str], None]] = None) -> str:
+        """Moves the finished file into the spool and queues it for upload.
+        on_uploaded is called once it is uploaded, on_failed if it is given
+        up on or still spooled when the pipeline is closed. Returns the
+        spooled path."""
+        spooled_path = os.path.join(self.__spool_path, os.path.basename(file_path))
+        if os.path.abspath(file_path) != os.path.abspath(spooled_path):
+            shutil.move(file_path, spooled_path)
+        self.__pending.put((spooled_path, on_uploaded, on_failed))
+        return spooled_path
+
+    def __work(self) -> None:
+        uploader = self.__uploader_factory()
+        try:
+            while True:
+                upload = self.__pending.get()
+                try:
+                    if upload is None:
+                        return
+                    file_path, on_uploaded, on_failed = upload
+                    callback = on_uploaded if self.__upload(uploader, file_path) else on_failed
+                    if callback is not None:
+                        self.__call_back(callback, file_path)
+                finally:
+                    self.__pending.task_done()
+        finally:
+            uploader.close()
+
+    @staticmethod
+    def __call_back(callback: Callable[[str], None], file_path: str) -> None:
+        try:
+            callback(file_path)
+        except Exception:
+            LOGGER.exception('Callback for the upload of %s failed', file_path)
+
+    def __upload(self, uploader: FtpsUploader, file_path: str) -> bool:
+        delay = self.__backoff
+        file_bytes = os.path.getsize(file_path)
+        for attempt in range(1, self.__max_attempts + 1):
+            start = time.perf_counter()
+            try:
+                uploader.upload(file_path)
+            except ftplib.all_errors as upload_error:
+                LOGGER.warning('Upload of %s failed (attempt %d/%d): %s',
+                               file_path, attempt, self.__max_attempts, upload_error)
+                if attempt == self.__max_attempts or self.__stopping.wait(delay):
+                    break
+                self.__metrics.inc('raq_uploads_total', labels={'outcome': 'retried'})
+                delay = min(delay * 2, self.__max_backoff)
+            else:
+                self.__metrics.observe('raq_upload_seconds', time.perf_counter() - start)
+                self.__metrics.observe('raq_upload_bytes', file_bytes, buckets=BYTES_BUCKETS)
+                self.__metrics.inc('raq_uploads_total', labels={'outcome': 'ok'})
+                os.remove(file_path)
+                with self.__lock:
+                    self.uploaded += 1
+                return True
+        LOGGER.error('Giving up on uploading %s, it stays spooled', file_path)
+        self.__metrics.inc('raq_uploads_total', labels={'outcome': 'failed'})
+        with self.__lock:
+            self.failed += 1
+        return False
+
+    def close(self, timeout: Optional[float] = None) -> None:
+        """Waits up to timeout seconds (forever if None) for the spooled files
+        to be uploaded, then stops the workers after their current upload."""
+        if timeout is None:
+            self.__pending.join()
+        else:
+            drained = threading.Thread(target=self.__pending.join, daemon=True)
+            drained.start()
+            drained.join(timeout)
+        self.__stopping.set()
+        # Files still queued stay in the spool for the next pipeline.
+        while True:
+            try:
+                file_path, _, on_failed = self.__pending.get_nowait()
+            except queue.Empty:
+                break
+            if on_failed is not None:
+                self.__call_back(on_failed, file_path)
+            self.__pending.task_done()
+        for _ in self.__workers:
+            self.__pending.put(None)
+        for worker in self.__workers:
+            worker.join()
@@ -0,0 +1,47 @@
+"""Remembers up to which commits every repository was crawled, so a
+re-crawl only has to walk the commits added since."""
+import datetime
+import json
+import os
+import sqlite3
+import threading
+from typing import Iterable, Optional
+
+
+class WatermarkStore:
+    """Keeps the HEAD SHAs of the latest completed crawl of every repo id,
+    together with the name of its result and when it was crawled, in SQLite."""
+
+    def __init__(self, path: str):
+        directory = os.path.dirname(os.path.abspath(path))
+        os.makedirs(directory, exist_ok=True)
+        self.__lock = threading.Lock()
+        self.__connection = sqlite3.connect(path, timeout=30, isolation_level=None, check_same_thread=False)
+        self.__connection.execute('PRAGMA journal_mode=WAL')
+        self.__connection.execute('CREATE TABLE IF NOT EXISTS watermarks ('
+                                  ' repo_id INTEGER PRIMARY KEY,'
+                                  ' head_shas TEXT NOT NULL,'
+                                  ' result_name TEXT,'
+                                  ' crawled_at TEXT NOT NULL)')
+
+    def get(self, repo_id: int) -> Optional[dict]:
+        """Returns the watermark of the repo as dict with head_shas,
+        result_name and crawled_at, None if it was not crawled yet."""
+        with self.__lock:
+            row = self.__connection.execute('SELECT head_shas, result_name, crawled_at FROM watermarks'
+                                            ' WHERE repo_id = ?', (repo_id,)).fetchone()
+        if row is None:
+            return None
+        return {'head_shas': json.loads(row[0]), 'result_name': row[1], 'crawled_at': row[2]}
+
+    def set(self, repo_id: int, head_shas: Iterable[str], result_name: Optional[str] = None) -> None:
+        """Replaces the watermark of the repo after a completed crawl."""
+        with self.__lock:
+            self.__connection.execute('INSERT OR REPLACE INTO watermarks (repo_id, head_shas, result_name, crawled_at)'
+                                      ' VALUES (?, ?, ?, ?)',
+                                      (repo_id, json.dumps(sorted(head_shas)), result_name,
+                                       datetime.datetime.utcnow().isoformat()))
+
+    def close(self) -> None:
+        with self.__lock:
+            self.__connection.close()
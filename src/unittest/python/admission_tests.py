@@ -0,0 +1,69 @@
+"""Unit tests concerning admission control and task budgets."""
+import os
+import tempfile
+import time
+import unittest
+
+from hamcrest import assert_that, is_, greater_than, less_than, calling, raises, has_properties
+
+from admission import (ADMIT, ROUTE_LARGE, SKIP, AdmissionPolicy, BudgetExceededException, ResourceBudget,
+                       process_tree_rss, run_within_budget)
+from message_queue import SqliteMessageQueue
+
+
+class AdmissionTest(unittest.TestCase):
+
+    def test_repos_are_admitted_routed_or_skipped_by_size(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        large_queue = SqliteMessageQueue(os.path.join(tmp.name, 'large.sqlite'))
+        self.addCleanup(large_queue.close)
+        policy = AdmissionPolicy(max_size_kb=1000, large_size_kb=100, large_queue=large_queue)
+
+        assert_that(policy.decide({'size': 100}), is_(ADMIT))
+        assert_that(policy.decide({'size': 101}), is_(ROUTE_LARGE))
+        assert_that(policy.decide({'size': 1001}), is_(SKIP))
+        assert_that(policy.decide({}), is_(ADMIT))
+
+    def test_large_repos_are_crawled_without_large_queue(self):
+        policy = AdmissionPolicy(max_size_kb=1000, large_size_kb=100)
+
+        assert_that(policy.decide({'size': 101}), is_(ADMIT))
+        assert_that(policy.skipped({'size': 1001}), is_({'reason': 'too large', 'size_kb': 1001, 'max_size_kb': 1000}))
+
+    def test_budget_enforces_deadline_disk_and_memory(self):
+        assert_that(calling(ResourceBudget(wall_seconds=0).check),
+                    raises(BudgetExceededException, 'wall-clock'))
+        assert_that(calling(ResourceBudget(disk_bytes=10).check).with_args(lambda: 11),
+                    raises(BudgetExceededException, 'disk'))
+        assert_that(calling(ResourceBudget(memory_bytes=1).check).with_args(pids=[os.getpid()]),
+                    raises(BudgetExceededException, 'memory'))
+        ResourceBudget(wall_seconds=60, disk_bytes=10, memory_bytes=1 << 40).check(lambda: 10, [os.getpid()])
+
+    def test_paused_time_does_not_count(self):
+        budget = ResourceBudget(wall_seconds=0.1)
+        budget.pause()
+        time.sleep(0.2)
+        budget.resume()
+        budget.check()
+
+        time.sleep(0.2)
+        assert_that(calling(budget.check), raises(BudgetExceededException, 'wall-clock'))
+
+    def test_own_process_has_resident_memory(self):
+        assert_that(process_tree_rss(os.getpid()), greater_than(0))
+
+    def test_command_is_killed_once_over_budget(self):
+        start = time.monotonic()
+        budget = ResourceBudget(wall_seconds=0.2)
+
+        try:
+            run_within_budget(['sleep', '30'], budget, poll_interval=0.05)
+            self.fail('The command was not killed')
+        except BudgetExceededException as exceeded:
+            assert_that(exceeded, has_properties(resource='wall-clock'))
+        assert_that(time.monotonic() - start, less_than(5))
+
+    def test_command_within_budget_returns_exit_code(self):
+        assert_that(run_within_budget(['sh', '-c', 'exit 3'], ResourceBudget(wall_seconds=60)), is_(3))
+        assert_that(run_within_budget(['true']), is_(0))
@@ -0,0 +1,151 @@
+"""Unit tests concerning the AsyncGithubSession against a local stub server."""
+import asyncio
+import json
+import threading
+import unittest
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+
+from hamcrest import assert_that, is_, less_than_or_equal_to, contains_exactly, not_none, instance_of
+
+from async_github_session import AsyncGithubSession, ConnectionClosedException, PipelinedConnection
+
+
+class StubGithubHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def setup(self):
+        super().setup()
+        with self.server.lock:
+            self.server.connections += 1
+
+    def do_GET(self):
+        with self.server.lock:
+            self.server.remaining -= 1
+            remaining = self.server.remaining
+            self.server.authorizations.append(self.headers.get('Authorization'))
+        body = json.dumps({'path': self.path}).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.send_header('X-RateLimit-Remaining', str(remaining))
+        self.send_header('X-RateLimit-Reset', '1900000000')
+        if self.path.startswith('/close'):
+            self.send_header('Connection', 'close')
+            self.close_connection = True
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class StubGithubServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+    def __init__(self):
+        super().__init__(('127.0.0.1', 0), StubGithubHandler)
+        self.lock = threading.Lock()
+        self.connections = 0
+        self.remaining = 5000
+        self.authorizations = []
+
+    @property
+    def url(self):
+        return 'http://127.0.0.1:{}'.format(self.server_address[1])
+
+
+def run(coroutine):
+    loop = asyncio.new_event_loop()
+    try:
+        return loop.run_until_complete(coroutine)
+    finally:
+        loop.close()
+
+
+class AsyncGithubSessionTest(unittest.TestCase):
+
+    def setUp(self):
+        self.server = StubGithubServer()
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_many_requests_share_bounded_connections(self):
+        async def crawl():
+            async with AsyncGithubSession(api_root=self.server.url, max_connections=2) as session:
+                results = await asyncio.gather(*[session.request_api('/repos/{}'.format(n)) for n in range(20)])
+                return results, session
+
+        results, session = run(crawl())
+
+        assert_that([body['path'] for body, _, _ in results],
+                    contains_exactly(*['/repos/{}'.format(n) for n in range(20)]))
+        assert_that(self.server.connections, is_(less_than_or_equal_to(2)))
+        assert_that(session.rate, is_(less_than_or_equal_to(4980)))
+        assert_that(session.rate_reset_time, is_(not_none()))
+
+    def test_requests_are_pipelined_on_a_single_connection(self):
+        async def crawl():
+            async with AsyncGithubSession(api_root=self.server.url, max_connections=1,
+                                          max_pipeline_depth=8) as session:
+                return await asyncio.gather(*[session.request_api('/p/{}'.format(n)) for n in range(8)])
+
+        results = run(crawl())
+
+        assert_that([body['path'] for body, _, _ in results], contains_exactly(*['/p/{}'.format(n) for n in range(8)]))
+        assert_that(self.server.connections, is_(1))
+
+    def test_reconnects_after_server_closed_connection(self):
+        async def crawl():
+            async with AsyncGithubSession(api_root=self.server.url, max_connections=1) as session:
+                first = await session.request_api('/close')
+                second = await session.request_api('/after')
+                return first, second, session.opened_connections
+
+        first, second, opened = run(crawl())
+
+        assert_that(first[0], is_({'path': '/close'}))
+        assert_that(second[0], is_({'path': '/after'}))
+        assert_that(opened, is_(2))
+
+    def test_credentials_are_sent(self):
+        async def crawl():
+            async with AsyncGithubSession(api_root=self.server.url) as session:
+                session.set_credentials(personal_access_token='secret')
+                await session.request_api('user')
+
+        run(crawl())
+
+        assert_that(self.server.authorizations, is_(['token secret']))
+
+
+class PipelinedConnectionTest(unittest.TestCase):
+
+    def test_failed_write_fails_all_queued_requests(self):
+        async def reset_without_reading(reader, writer):
+            await asyncio.sleep(0.2)
+            # Closing with unread data resets the connection.
+            writer.close()
+
+        async def crawl():
+            server = await asyncio.start_server(reset_without_reading, '127.0.0.1', 0)
+            connection = PipelinedConnection('127.0.0.1', server.sockets[0].getsockname()[1], use_ssl=False)
+            await connection.open()
+            try:
+                # The large body fills the socket buffers, so the second request waits in drain().
+                return await asyncio.gather(connection.request('GET', '/first', {}),
+                                            connection.request('POST', '/second', {}, b'x' * (16 << 20)),
+                                            return_exceptions=True), connection
+            finally:
+                await connection.close()
+                server.close()
+                await server.wait_closed()
+
+        results, connection = run(crawl())
+
+        assert_that(results, contains_exactly(instance_of(ConnectionClosedException),
+                                              instance_of(ConnectionClosedException)))
+        assert_that(connection.closed, is_(True))
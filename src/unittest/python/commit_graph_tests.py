@@ -0,0 +1,72 @@
+"""Unit tests concerning the array-backed CommitGraph."""
+import unittest
+
+from hamcrest import assert_that, is_, has_length, none, calling, raises, contains_exactly
+
+from commit_graph import CommitGraph
+
+SHA_A = 'a' * 40
+SHA_B = 'b' * 40
+SHA_C = 'c' * 40
+
+
+class CommitGraphTest(unittest.TestCase):
+
+    def test_interning_assigns_consecutive_indexes(self):
+        graph = CommitGraph()
+
+        assert_that(graph.intern(SHA_A), is_(0))
+        assert_that(graph.intern(SHA_B), is_(1))
+        assert_that(graph.intern(SHA_A), is_(0))
+        assert_that(graph.sha_at(1), is_(SHA_B))
+        assert_that(graph, has_length(2))
+
+    def test_parents_are_interned_but_not_visited(self):
+        graph = CommitGraph()
+        graph.add_commit(SHA_A, [SHA_B, SHA_C], 'merge')
+
+        assert_that(graph, has_length(3))
+        assert_that(graph.commit_count, is_(1))
+        assert_that(graph.is_visited(SHA_A), is_(True))
+        assert_that(graph.is_visited(SHA_B), is_(False))
+        assert_that(graph.parents(SHA_A), is_([SHA_B, SHA_C]))
+
+    def test_adding_a_visited_commit_is_ignored(self):
+        graph = CommitGraph()
+
+        assert_that(graph.add_commit(SHA_A, [], 'first'), is_(True))
+        assert_that(graph.add_commit(SHA_A, [SHA_B], 'again'), is_(False))
+        assert_that(graph.message(SHA_A), is_('first'))
+        assert_that(graph.parents(SHA_A), is_([]))
+
+    def test_messages_share_one_buffer(self):
+        graph = CommitGraph()
+        graph.add_commit(SHA_A, [SHA_B], 'ünïcode\n')
+        graph.add_commit(SHA_B, [], None)
+        graph.add_commit(SHA_C, [SHA_A], '')
+
+        assert_that(graph.message(SHA_A), is_('ünïcode\n'))
+        assert_that(graph.message(SHA_B), is_(none()))
+        assert_that(graph.message(SHA_C), is_(''))
+
+    def test_serializes_to_result_dict_shape(self):
+        graph = CommitGraph()
+        graph.add_commit(SHA_A, [SHA_B], 'second\n')
+        graph.add_commit(SHA_B, [], 'first\n')
+
+        assert_that(graph.to_commits_dict(), is_({
+            SHA_A: {'parents': [SHA_B], 'message': 'second\n'},
+            SHA_B: {'message': 'first\n'},
+        }))
+        assert_that([sha for sha, _, _ in graph.iter_commits()], contains_exactly(SHA_A, SHA_B))
+
+    def test_visited_bitmap_grows_past_a_byte(self):
+        graph = CommitGraph()
+        shas = ['{:040x}'.format(number) for number in range(20)]
+        for sha in shas[::2]:
+            graph.add_commit(sha, [], 'm')
+
+        assert_that([graph.is_visited(sha) for sha in shas], is_([number % 2 == 0 for number in range(20)]))
+
+    def test_rejects_non_sha1_values(self):
+        assert_that(calling(CommitGraph().intern).with_args('abcd'), raises(ValueError))
@@ -0,0 +1,75 @@
+"""Unit tests concerning the index of crawled commits."""
+import hashlib
+import os
+import tempfile
+import unittest
+
+from hamcrest import assert_that, is_, has_entries, less_than
+
+from commit_index import BloomFilter, CommitIndex
+
+
+def sha_of(number):
+    return hashlib.sha1(str(number).encode()).hexdigest()
+
+
+class BloomFilterTest(unittest.TestCase):
+
+    def test_added_keys_are_contained(self):
+        bloom = BloomFilter(1000)
+        keys = [bytes.fromhex(sha_of(number)) for number in range(1000)]
+        for key in keys:
+            bloom.add(key)
+
+        assert_that(all(key in bloom for key in keys), is_(True))
+
+    def test_false_positives_stay_near_error_rate(self):
+        bloom = BloomFilter(1000, error_rate=0.01)
+        for number in range(1000):
+            bloom.add(bytes.fromhex(sha_of(number)))
+
+        false_positives = sum(bytes.fromhex(sha_of(number)) in bloom for number in range(1000, 11000))
+
+        assert_that(false_positives, less_than(300))
+
+
+class CommitIndexTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+        self.path = os.path.join(self.tmp.name, 'index', 'commits.sqlite')
+
+    def open_index(self):
+        commit_index = CommitIndex(self.path, expected_commits=1000)
+        self.addCleanup(commit_index.close)
+        return commit_index
+
+    def test_first_repo_keeps_shared_commits(self):
+        commit_index = self.open_index()
+
+        assert_that(commit_index.add(1, [sha_of(0), sha_of(1)]), is_(2))
+        assert_that(commit_index.add(2, [sha_of(1), sha_of(2)]), is_(1))
+
+        assert_that(commit_index.repos_of([sha_of(0), sha_of(1), sha_of(2), sha_of(3)]),
+                    is_({sha_of(0): 1, sha_of(1): 1, sha_of(2): 2}))
+        assert_that(sha_of(3) in commit_index, is_(False))
+
+    def test_index_survives_reopening(self):
+        commit_index = self.open_index()
+        commit_index.add(7, [sha_of(number) for number in range(50)])
+        commit_index.close()
+
+        reopened = self.open_index()
+
+        assert_that(len(reopened), is_(50))
+        assert_that(reopened.repos_of([sha_of(49)]), has_entries({sha_of(49): 7}))
+
+    def test_unknown_commits_are_mostly_answered_by_the_bloom_filter(self):
+        commit_index = self.open_index()
+        commit_index.add(1, [sha_of(number) for number in range(500)])
+
+        for number in range(500, 1500):
+            commit_index.repo_of(sha_of(number))
+
+        assert_that(commit_index.lookups, less_than(100))
@@ -0,0 +1,95 @@
+"""Unit tests concerning the staged pipeline of the crawler."""
+import threading
+import time
+import unittest
+
+from hamcrest import assert_that, is_, contains_inanyorder, less_than_or_equal_to
+
+from crawl_pipeline import CrawlPipeline, PipelineStage
+from crawler_metrics import MetricsRegistry
+
+
+class CrawlPipelineTest(unittest.TestCase):
+
+    def setUp(self):
+        self.done = []
+        self.failed = []
+        self.lock = threading.Lock()
+
+    def on_done(self, item):
+        with self.lock:
+            self.done.append(item)
+
+    def on_failed(self, item, stage_error):
+        with self.lock:
+            self.failed.append((item, str(stage_error)))
+
+    def pipeline_of(self, *stages):
+        return CrawlPipeline(stages, self.on_done, self.on_failed, metrics=MetricsRegistry())
+
+    def test_items_pass_every_stage(self):
+        pipeline = self.pipeline_of(PipelineStage('double', lambda item: item * 2, concurrency=2),
+                                    PipelineStage('increment', lambda item: item + 1, concurrency=3))
+        for item in range(10):
+            pipeline.submit(item)
+        pipeline.close()
+
+        assert_that(self.done, contains_inanyorder(*[item * 2 + 1 for item in range(10)]))
+        assert_that(pipeline.in_flight, is_(0))
+
+    def test_failing_and_early_finished_items_leave_the_pipeline(self):
+        def check(item):
+            if item == 'bad':
+                raise ValueError('bad item')
+            return None if item == 'skip' else item
+
+        pipeline = self.pipeline_of(PipelineStage('check', check), PipelineStage('upper', str.upper))
+        for item in ('good', 'bad', 'skip'):
+            pipeline.submit(item)
+        pipeline.close()
+
+        assert_that(self.done, contains_inanyorder('GOOD', 'skip'))
+        assert_that(self.failed, is_([('bad', 'bad item')]))
+        assert_that((pipeline.done, pipeline.failed), is_((2, 1)))
+
+    def test_waiting_stage_does_not_stop_later_stages(self):
+        released = threading.Event()
+        walked = []
+
+        def resolve(item):
+            if item == 'waits_for_quota':
+                released.wait(5)
+            return item
+
+        pipeline = self.pipeline_of(PipelineStage('resolve', resolve, concurrency=2),
+                                    PipelineStage('walk', lambda item: walked.append(item) or item))
+        pipeline.submit('waits_for_quota')
+        pipeline.submit('resolved')
+        deadline = time.monotonic() + 5
+        while not walked and time.monotonic() < deadline:
+            time.sleep(0.01)
+
+        assert_that(walked, is_(['resolved']))
+        released.set()
+        pipeline.close()
+
+    def test_full_queues_hold_back_submit(self):
+        released = threading.Event()
+        submitted = []
+        pipeline = self.pipeline_of(PipelineStage('slow', lambda item: released.wait(5) and item, queue_size=2))
+
+        def submit_all():
+            for item in range(10):
+                pipeline.submit(item)
+                submitted.append(item)
+
+        submitter = threading.Thread(target=submit_all)
+        submitter.start()
+        time.sleep(0.2)
+
+        # One item is being worked on and two are queued.
+        assert_that(len(submitted), less_than_or_equal_to(3))
+        released.set()
+        submitter.join()
+        pipeline.close()
+        assert_that(len(self.done), is_(10))
@@ -0,0 +1,83 @@
+"""Unit tests concerning the structured logging of the crawler."""
+import io
+import json
+import logging
+import unittest
+
+from hamcrest import assert_that, is_, has_entries, contains_string, contains_exactly
+
+from crawler_logging import CONFIG_LEVEL, log_for_caller, start_logging
+
+
+class CountingArgument:
+
+    def __init__(self):
+        self.formatted = 0
+
+    def __str__(self):
+        self.formatted += 1
+        return 'argument'
+
+
+def log_from_helper(logger, level, msg, *args, **fields):
+    log_for_caller(logger, level, msg, args, fields)
+
+
+class CrawlerLoggingTest(unittest.TestCase):
+
+    def setUp(self):
+        root = logging.getLogger()
+        self.__saved = (list(root.handlers), root.level)
+        self.stream = io.StringIO()
+        self.listener = start_logging(logging.INFO, stream=self.stream)
+        self.logger = logging.getLogger('raq_crawler.test')
+
+    def tearDown(self):
+        if self.listener is not None:
+            self.listener.stop()
+        root = logging.getLogger()
+        for handler in list(root.handlers):
+            root.removeHandler(handler)
+        handlers, level = self.__saved
+        for handler in handlers:
+            root.addHandler(handler)
+        root.setLevel(level)
+
+    def records(self):
+        self.listener.stop()
+        self.listener = None
+        return [json.loads(line) for line in self.stream.getvalue().splitlines()]
+
+    def test_records_are_json_lines_naming_the_caller(self):
+        log_from_helper(self.logger, logging.WARNING, 'Working on repo with id %s', 42, repo_id=42)
+
+        assert_that(self.records(), contains_exactly(has_entries(
+            level='WARNING',
+            logger='raq_crawler.test',
+            caller='test_records_are_json_lines_naming_the_caller',
+            message='Working on repo with id 42',
+            repo_id=42,
+        )))
+
+    def test_disabled_levels_are_not_formatted(self):
+        argument = CountingArgument()
+        log_from_helper(self.logger, logging.DEBUG, 'Added %s', argument)
+        log_from_helper(self.logger, logging.INFO, 'Added %s', argument)
+
+        assert_that(len(self.records()), is_(1))
+        assert_that(argument.formatted, is_(1))
+
+    def test_config_level_is_named(self):
+        log_from_helper(self.logger, CONFIG_LEVEL, 'RANDOM_ID: %s', 'abc')
+
+        assert_that(self.records()[0]['level'], is_('CONFIG'))
+
+    def test_plain_loggers_include_exceptions(self):
+        try:
+            raise ValueError('broken')
+        except ValueError:
+            logging.getLogger('mirror_cache').exception('Fetch failed')
+
+        record = self.records()[0]
+        assert_that(record['message'], is_('Fetch failed'))
+        assert_that(record['exception'], contains_string('ValueError: broken'))
@@ -0,0 +1,88 @@
+"""Unit tests concerning the metrics registry and its exporters."""
+import os
+import socket
+import tempfile
+import unittest
+
+from hamcrest import assert_that, is_, contains_string, has_item, contains_inanyorder
+
+from crawler_metrics import MetricsRegistry, PrometheusTextfileExporter, StatsdSender
+
+
+class MetricsRegistryTest(unittest.TestCase):
+
+    def test_histogram_is_rendered_with_cumulative_buckets(self):
+        registry = MetricsRegistry()
+        for value in (0.5, 3, 3, 700):
+            registry.observe('raq_clone_seconds', value, buckets=(1, 5))
+
+        text = registry.prometheus_text()
+
+        assert_that(text, contains_string('# TYPE raq_clone_seconds histogram\n'))
+        assert_that(text, contains_string('raq_clone_seconds_bucket{le="1.0"} 1\n'))
+        assert_that(text, contains_string('raq_clone_seconds_bucket{le="5.0"} 3\n'))
+        assert_that(text, contains_string('raq_clone_seconds_bucket{le="+Inf"} 4\n'))
+        assert_that(text, contains_string('raq_clone_seconds_sum 706.5\n'))
+        assert_that(text, contains_string('raq_clone_seconds_count 4\n'))
+
+    def test_bucket_bounds_are_inclusive(self):
+        registry = MetricsRegistry()
+        registry.observe('raq_upload_seconds', 1, buckets=(1, 5))
+
+        assert_that(registry.prometheus_text(), contains_string('raq_upload_seconds_bucket{le="1.0"} 1\n'))
+
+    def test_counters_are_kept_per_label_set(self):
+        registry = MetricsRegistry()
+        registry.inc('raq_tasks_total', labels={'task_type': 'repo', 'outcome': 'ok'})
+        registry.inc('raq_tasks_total', labels={'outcome': 'ok', 'task_type': 'repo'})
+        registry.inc('raq_tasks_total', labels={'task_type': 'repo', 'outcome': 'failed'})
+
+        assert_that(registry.counter_value('raq_tasks_total', {'task_type': 'repo', 'outcome': 'ok'}), is_(2))
+        assert_that(registry.prometheus_text().splitlines(),
+                    has_item('raq_tasks_total{outcome="failed",task_type="repo"} 1.0'))
+
+    def test_timer_observes_failing_blocks(self):
+        registry = MetricsRegistry()
+        with self.assertRaises(ValueError):
+            with registry.timer('raq_task_seconds', {'task_type': 'repo'}):
+                raise ValueError()
+
+        assert_that(registry.histogram_count('raq_task_seconds', {'task_type': 'repo'}), is_(1))
+
+    def test_textfile_is_written_on_stop(self):
+        registry = MetricsRegistry()
+        registry.set('raq_github_rate_remaining', 4999, {'kind': 'rest'})
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'raq.prom')
+            exporter = PrometheusTextfileExporter(registry, path, interval=3600)
+            exporter.start()
+            exporter.stop()
+
+            with open(path) as textfile:
+                assert_that(textfile.read(), contains_string('raq_github_rate_remaining{kind="rest"} 4999.0'))
+
+
+class StatsdSenderTest(unittest.TestCase):
+
+    def setUp(self):
+        self.collector = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.collector.bind(('127.0.0.1', 0))
+        self.collector.settimeout(5)
+
+    def tearDown(self):
+        self.collector.close()
+
+    def test_updates_are_sent_as_packets(self):
+        sender = StatsdSender('127.0.0.1:{}'.format(self.collector.getsockname()[1]))
+        registry = MetricsRegistry()
+        registry.add_listener(sender)
+
+        registry.inc('raq_tasks_total', labels={'task_type': 'repo', 'outcome': 'ok'})
+        registry.set('raq_github_rate_remaining', 12)
+        registry.observe('raq_clone_seconds', 0.25)
+        packets = [self.collector.recv(512).decode() for _ in range(3)]
+        sender.close()
+
+        assert_that(packets, contains_inanyorder('raq.tasks_total.ok.repo:1|c',
+                                                 'raq.github_rate_remaining:12|g',
+                                                 'raq.clone:250.000|ms'))
@@ -0,0 +1,62 @@
+"""Unit tests concerning the clone strategies."""
+import os
+import tempfile
+import unittest
+from subprocess import run
+
+from hamcrest import assert_that, is_, has_length, calling, raises, has_item
+
+from git_clone import CLONE_STRATEGIES, clone_command, clone_repository, UnknownCloneStrategyException
+from git_commit_walker import walk_commits
+from git_commit_walker_tests import git
+from raq_matchers.FileMatchers import is_path_to_nothing
+
+
+class GitCloneTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.__tmp = tempfile.TemporaryDirectory()
+        cls.source_path = os.path.join(cls.__tmp.name, 'source')
+        os.makedirs(cls.source_path)
+        git(cls.source_path, 'init', '-q')
+        git(cls.source_path, 'config', 'uploadpack.allowFilter', 'true')
+        for index in range(3):
+            with open(os.path.join(cls.source_path, 'file.txt'), 'w') as file:
+                file.write('content {}\n'.format(index))
+            git(cls.source_path, 'add', 'file.txt')
+            git(cls.source_path, 'commit', '-q', '-m', 'commit {}'.format(index))
+        cls.source_url = 'file://' + cls.source_path
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.__tmp.cleanup()
+
+    def test_every_strategy_clones_the_whole_history(self):
+        for strategy in CLONE_STRATEGIES:
+            target_path = os.path.join(self.__tmp.name, strategy)
+            clone_repository(self.source_url, target_path, strategy=strategy)
+
+            assert_that(list(walk_commits(target_path)), has_length(3))
+
+    def test_strategies_without_checkout_write_no_working_tree(self):
+        target_path = os.path.join(self.__tmp.name, 'bare-no-tree')
+        clone_repository(self.source_url, target_path, strategy='treeless')
+
+        assert_that(os.path.join(target_path, 'file.txt'), is_path_to_nothing())
+
+    def test_depth_limits_history(self):
+        target_path = os.path.join(self.__tmp.name, 'shallow')
+        clone_repository(self.source_url, target_path, strategy='blobless', depth='1')
+
+        assert_that(list(walk_commits(target_path)), has_length(1))
+
+    def test_clone_command_arguments(self):
+        command = clone_command('url', 'path', strategy='blobless', depth=5)
+
+        assert_that(command, is_(['git', 'clone', '--bare', '--filter=blob:none', '--depth=5', 'url', 'path']))
+        assert_that(clone_command('url', 'path'), has_item('url'))
+
+    def test_unknown_strategy_is_rejected(self):
+        assert_that(calling(clone_command).with_args('url', 'path', strategy='sparse'),
+                    raises(UnknownCloneStrategyException))
@@ -0,0 +1,141 @@
+"""Unit tests concerning the streaming commit walker."""
+import os
+import tempfile
+import unittest
+from subprocess import PIPE, run
+
+from hamcrest import assert_that, is_, has_length, contains_inanyorder, empty, calling, raises
+
+import git_commit_walker
+from git_commit_walker import head_shas, walk_commits, walk_unknown_commits, GitLogFailedException
+
+GIT_ENV = dict(os.environ,
+               GIT_AUTHOR_NAME='Raq Test', GIT_AUTHOR_EMAIL='test@example.com',
+               GIT_COMMITTER_NAME='Raq Test', GIT_COMMITTER_EMAIL='test@example.com')
+
+
+def git(repo_path, *args):
+    return run(['git'] + list(args), cwd=repo_path, env=GIT_ENV, stdout=PIPE,
+               universal_newlines=True, check=True).stdout.strip()
+
+
+class GitCommitWalkerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.__tmp = tempfile.TemporaryDirectory()
+        self.repo_path = self.__tmp.name
+        git(self.repo_path, 'init', '-q')
+
+    def tearDown(self):
+        self.__tmp.cleanup()
+
+    def commit(self, message):
+        git(self.repo_path, 'commit', '-q', '--allow-empty', '-m', message)
+        return git(self.repo_path, 'rev-parse', 'HEAD')
+
+    def test_walk_on_empty_repository(self):
+        assert_that(list(walk_commits(self.repo_path)), is_(empty()))
+
+    def test_walk_linear_history(self):
+        first = self.commit('first\n\nwith body')
+        second = self.commit('second')
+
+        commits = {sha: (parents, message) for sha, parents, message in walk_commits(self.repo_path)}
+
+        assert_that(commits, has_length(2))
+        assert_that(commits[first], is_(([], 'first\n\nwith body\n')))
+        assert_that(commits[second], is_(([first], 'second\n')))
+
+    def test_walk_merge_commit_reports_both_parents(self):
+        base = self.commit('base')
+        git(self.repo_path, 'checkout', '-q', '-b', 'side')
+        side = self.commit('side')
+        git(self.repo_path, 'checkout', '-q', '-')
+        main = self.commit('main')
+        git(self.repo_path, 'merge', '-q', '--no-ff', '-m', 'merge', 'side')
+        merge = git(self.repo_path, 'rev-parse', 'HEAD')
+
+        commits = {sha: parents for sha, parents, _ in walk_commits(self.repo_path)}
+
+        assert_that(commits.keys(), contains_inanyorder(base, side, main, merge))
+        assert_that(commits[merge], is_([main, side]))
+
+    def test_walk_stops_git_when_consumer_stops_early(self):
+        for index in range(5):
+            self.commit('commit {}'.format(index))
+
+        running_pids = set()
+
+        walker = walk_commits(self.repo_path, chunk_size=16, running_pids=running_pids)
+        next(walker)
+        pid = next(iter(running_pids))
+        walker.close()
+
+        # The process was killed and reaped, it is gone from /proc.
+        assert_that(os.path.exists('/proc/{}'.format(pid)), is_(False))
+
+    def test_walk_reports_the_pid_of_git_log_while_it_runs(self):
+        for index in range(5):
+            self.commit('commit {}'.format(index))
+        running_pids = set()
+
+        walker = walk_commits(self.repo_path, chunk_size=16, running_pids=running_pids)
+        next(walker)
+        assert_that(running_pids, has_length(1))
+        assert_that(os.path.exists('/proc/{}'.format(next(iter(running_pids)))), is_(True))
+        list(walker)
+
+        assert_that(running_pids, is_(empty()))
+
+    def test_walk_failing_on_existing_history_raises(self):
+        self.commit('first')
+
+        assert_that(calling(list).with_args(walk_commits(self.repo_path, revisions=['HEAD', 'no-such-ref'])),
+                    raises(GitLogFailedException, 'no-such-ref'))
+
+    def test_walk_is_not_blocked_by_lots_of_stderr(self):
+        git_log_command = git_commit_walker.git_log_command
+        # More warnings than a pipe holds before the commit comes out.
+        git_commit_walker.git_log_command = lambda revisions: [
+            'sh', '-c', 'head -c 1000000 /dev/zero | tr "\\0" w >&2; printf "%s\\0\\0%s\\0" {} message'.format(
+                'a' * 40)]
+        self.addCleanup(setattr, git_commit_walker, 'git_log_command', git_log_command)
+
+        assert_that(list(walk_commits(self.repo_path)), is_([('a' * 40, [], 'message')]))
+
+    def test_unknown_walk_stops_at_known_commits(self):
+        base = self.commit('base')
+        known = self.commit('known')
+        git(self.repo_path, 'checkout', '-q', '-b', 'side', base)
+        side = self.commit('side')
+        git(self.repo_path, 'checkout', '-q', '-')
+        git(self.repo_path, 'merge', '-q', '--no-ff', '-m', 'merge', 'side')
+        merge = git(self.repo_path, 'rev-parse', 'HEAD')
+        boundary = set()
+
+        shas = [sha for sha, _, _ in walk_unknown_commits(self.repo_path, {base, known}, boundary)]
+
+        assert_that(shas, contains_inanyorder(merge, side))
+        assert_that(boundary, is_({known}))
+
+    def test_unknown_walk_skips_known_commits_without_restarts(self):
+        known = [self.commit('known {}'.format(index)) for index in range(3)]
+        new = self.commit('new')
+        boundary = set()
+
+        shas = [sha for sha, _, _ in walk_unknown_commits(self.repo_path, set(known), boundary, max_restarts=0)]
+
+        assert_that(shas, is_([new]))
+        assert_that(boundary, is_({known[-1]}))
+
+    def test_delta_walk_excludes_previous_head(self):
+        previous_head = self.commit('crawled before')
+        new = self.commit('new')
+
+        shas = [sha for sha, _, _ in walk_commits(self.repo_path, ['HEAD', '--not'] + [previous_head])]
+
+        assert_that(shas, is_([new]))
+        assert_that(head_shas(self.repo_path), is_([new]))
+
+    def test_empty_repository_has_no_head(self):
+        assert_that(head_shas(self.repo_path), is_(empty()))
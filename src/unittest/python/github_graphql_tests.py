@@ -0,0 +1,136 @@
+"""Unit tests concerning the batched GraphQL meta data fetch."""
+import unittest
+
+from hamcrest import assert_that, is_, has_entries, none, calling, raises, contains_string
+
+from github_graphql import (GraphQLRepoFetcher, GraphQLBatchFailedException, build_batch_query,
+                            rest_shaped_meta, rest_shaped_languages)
+
+
+def repository_node(owner, name, database_id):
+    return {
+        'id': 'MDEw{}'.format(database_id),
+        'databaseId': database_id,
+        'name': name,
+        'nameWithOwner': '{}/{}'.format(owner, name),
+        'owner': {'__typename': 'User', 'id': 'MDQ6VXNlcjc=', 'login': owner, 'url': 'https://github.com/' + owner,
+                  'avatarUrl': 'https://avatars.githubusercontent.com/u/7?v=4', 'databaseId': 7},
+        'isPrivate': False,
+        'visibility': 'PUBLIC',
+        'isTemplate': False,
+        'url': 'https://github.com/{}/{}'.format(owner, name),
+        'description': 'desc',
+        'isFork': False,
+        'createdAt': '2008-01-01T00:00:00Z',
+        'updatedAt': '2018-01-01T00:00:00Z',
+        'pushedAt': '2018-01-02T00:00:00Z',
+        'sshUrl': 'git@github.com:{}/{}.git'.format(owner, name),
+        'mirrorUrl': None,
+        'homepageUrl': None,
+        'diskUsage': 1234,
+        'stargazers': {'totalCount': 3},
+        'primaryLanguage': {'name': 'Ruby'},
+        'watchers': {'totalCount': 6},
+        'hasIssuesEnabled': True,
+        'hasProjectsEnabled': True,
+        'hasWikiEnabled': False,
+        'hasDiscussionsEnabled': False,
+        'forkingAllowed': True,
+        'webCommitSignoffRequired': False,
+        'forkCount': 2,
+        'isArchived': False,
+        'isDisabled': False,
+        'issues': {'totalCount': 4},
+        'pullRequests': {'totalCount': 1},
+        'licenseInfo': None,
+        'defaultBranchRef': {'name': 'master'},
+        'repositoryTopics': {'nodes': [{'topic': {'name': 'git'}}, {'topic': {'name': 'ruby'}}]},
+        'languages': {'edges': [{'size': 900, 'node': {'name': 'Ruby'}}, {'size': 20, 'node': {'name': 'Shell'}}]},
+    }
+
+
+class FakeGraphQLSession:
+
+    def __init__(self, nodes):
+        self.nodes = nodes
+        self.queries = []
+
+    def request_graphql(self, query, variables, url=None):
+        self.queries.append((query, variables))
+        data = {}
+        for key in variables:
+            if key.startswith('o'):
+                index = key[1:]
+                full_name = '{}/{}'.format(variables['o' + index], variables['n' + index])
+                data['r' + index] = self.nodes.get(full_name)
+        return {'data': data}, {}, ''
+
+
+class GithubGraphQLTest(unittest.TestCase):
+
+    def test_query_aliases_every_repository(self):
+        query, variables = build_batch_query(['a/b', 'c/d'])
+
+        assert_that(variables, is_({'o0': 'a', 'n0': 'b', 'o1': 'c', 'n1': 'd'}))
+        assert_that(query, contains_string('r1: repository(owner: $o1, name: $n1) { ...RepoFields }'))
+        assert_that(query, contains_string('fragment RepoFields on Repository'))
+
+    def test_node_is_mapped_to_rest_shape(self):
+        meta = rest_shaped_meta(repository_node('mojombo', 'grit', 1))
+
+        assert_that(meta, has_entries(
+            id=1,
+            full_name='mojombo/grit',
+            clone_url='https://github.com/mojombo/grit.git',
+            languages_url='https://api.github.com/repos/mojombo/grit/languages',
+            size=1234,
+            open_issues_count=5,
+            language='Ruby',
+            default_branch='master',
+            license=none(),
+            visibility='public',
+            topics=['git', 'ruby'],
+            stargazers_count=3,
+            subscribers_count=6,
+            has_projects=True,
+            allow_forking=True,
+            svn_url='https://github.com/mojombo/grit',
+            forks_url='https://api.github.com/repos/mojombo/grit/forks',
+            compare_url='https://api.github.com/repos/mojombo/grit/compare/{base}...{head}',
+        ))
+        assert_that(meta['owner'], has_entries(
+            login='mojombo', id=7, node_id='MDQ6VXNlcjc=', type='User',
+            avatar_url='https://avatars.githubusercontent.com/u/7?v=4',
+            repos_url='https://api.github.com/users/mojombo/repos'))
+        assert_that('organization' in meta, is_(False))
+
+    def test_organization_owner_is_the_organization(self):
+        node = repository_node('github', 'linguist', 2)
+        node['owner']['__typename'] = 'Organization'
+
+        meta = rest_shaped_meta(node)
+
+        assert_that(meta['organization'], is_(meta['owner']))
+
+    def test_languages_are_mapped_to_rest_shape(self):
+        assert_that(rest_shaped_languages(repository_node('a', 'b', 1)), is_({'Ruby': 900, 'Shell': 20}))
+
+    def test_fetch_many_batches_and_reports_missing_repositories(self):
+        session = FakeGraphQLSession({'a/one': repository_node('a', 'one', 1),
+                                      'a/three': repository_node('a', 'three', 3)})
+        fetcher = GraphQLRepoFetcher(session, batch_size=2)
+
+        results = fetcher.fetch_many(['a/one', 'a/two', 'a/three'])
+
+        assert_that(fetcher.queries, is_(2))
+        assert_that(results['a/one'][0]['id'], is_(1))
+        assert_that(results['a/two'], is_(none()))
+        assert_that(results['a/three'][1], is_({'Ruby': 900, 'Shell': 20}))
+
+    def test_batch_without_data_raises(self):
+        class FailingSession:
+            def request_graphql(self, query, variables, url=None):
+                return {'errors': [{'message': 'Bad credentials'}]}, {}, ''
+
+        assert_that(calling(GraphQLRepoFetcher(FailingSession()).fetch_many).with_args(['a/b']),
+                    raises(GraphQLBatchFailedException))
@@ -0,0 +1,136 @@
+"""Unit tests concerning the TokenPool of GithubSession."""
+import multiprocessing
+import os
+import signal
+import threading
+import unittest
+from datetime import datetime, timedelta
+
+from hamcrest import assert_that, is_, none, contains_inanyorder
+
+from github_session import ProcessLock, TokenPool, github_tokens_from_config, shared_token_pools
+
+
+class TokenPoolTest(unittest.TestCase):
+
+    def setUp(self):
+        self.reset_time = datetime.utcnow() + timedelta(minutes=30)
+
+    def test_unknown_quotas_are_spread_by_reservation(self):
+        pool = TokenPool(['a', 'b'])
+        pool.update('a', 100, self.reset_time)
+        pool.update('b', 100, self.reset_time)
+
+        assert_that([pool.select() for _ in range(4)], contains_inanyorder('a', 'a', 'b', 'b'))
+
+    def test_token_with_most_headroom_is_selected(self):
+        pool = TokenPool(['a', 'b', 'c'])
+        pool.update('a', 10, self.reset_time)
+        pool.update('b', 4000, self.reset_time)
+        pool.update('c', 200, self.reset_time)
+
+        assert_that(pool.select(), is_('b'))
+        assert_that(pool.rate, is_(10 + 4000 + 200))
+
+    def test_answered_request_releases_its_reservation(self):
+        pool = TokenPool(['a', 'b'])
+        pool.update('a', 100, self.reset_time)
+        pool.update('b', 100, self.reset_time)
+        for _ in range(3):
+            assert_that(pool.select(), is_('a'))
+            pool.update('a', 100, self.reset_time)
+
+    def test_token_without_known_quota_is_preferred(self):
+        pool = TokenPool(['a', 'b'])
+        pool.update('a', 4000, self.reset_time)
+
+        assert_that(pool.select(), is_('b'))
+
+    def test_reset_quota_counts_as_unlimited(self):
+        pool = TokenPool(['a', 'b'])
+        pool.update('a', 0, datetime.utcnow() - timedelta(seconds=1))
+        pool.update('b', 4000, self.reset_time)
+
+        assert_that(pool.select(), is_('a'))
+
+    def test_late_responses_do_not_raise_the_rate(self):
+        pool = TokenPool(['a'])
+        pool.update('a', 90, self.reset_time)
+        pool.update('a', 95, self.reset_time)
+
+        assert_that(pool.rate, is_(90))
+
+    def test_exhausted_only_if_all_tokens_are(self):
+        pool = TokenPool(['a', 'b'])
+        earlier_reset = self.reset_time - timedelta(minutes=10)
+        pool.update('a', 1, self.reset_time)
+        pool.update('b', 100, earlier_reset)
+        assert_that(pool.exhausted_until(5), is_(none()))
+
+        pool.update('b', 2, earlier_reset)
+        assert_that(pool.exhausted_until(5), is_(earlier_reset))
+        assert_that(pool.rate_reset_time, is_(earlier_reset))
+
+    def test_empty_pool_sends_unauthenticated(self):
+        pool = TokenPool()
+
+        assert_that(pool.select(), is_(none()))
+        assert_that(pool.rate, is_(none()))
+
+    def test_shared_pool_sees_quota_of_forked_processes(self):
+        pool, graphql_pool = shared_token_pools(['a', 'b'])
+        pool.update('b', 10, self.reset_time)
+
+        worker = multiprocessing.get_context('fork').Process(target=pool.update, args=('a', 4000, self.reset_time))
+        worker.start()
+        worker.join()
+
+        assert_that(pool.rate, is_(4010))
+        assert_that(pool.rate_reset_time, is_(self.reset_time))
+        assert_that(pool.select(), is_('a'))
+        assert_that(graphql_pool.rate, is_(none()))
+
+    def test_reservations_of_exited_workers_are_dropped(self):
+        pool, _ = shared_token_pools(['a', 'b'], workers=2)
+        pool.update('a', 100, self.reset_time)
+        pool.update('b', 98, self.reset_time)
+
+        def reserve_and_die():
+            pool.use_worker(1)
+            for _ in range(3):
+                pool.select()
+
+        worker = multiprocessing.get_context('fork').Process(target=reserve_and_die)
+        worker.start()
+        worker.join()
+
+        assert_that(pool.select(), is_('b'))
+        pool.release('b')
+        pool.drop_reservations(1)
+        assert_that(pool.select(), is_('a'))
+
+    def test_lock_of_killed_process_is_released(self):
+        lock = ProcessLock()
+
+        def die_holding_lock():
+            with lock:
+                os.kill(os.getpid(), signal.SIGKILL)
+
+        worker = multiprocessing.get_context('fork').Process(target=die_holding_lock)
+        worker.start()
+        worker.join()
+        acquired = threading.Event()
+
+        def acquire():
+            with lock:
+                acquired.set()
+
+        threading.Thread(target=acquire, daemon=True).start()
+
+        assert_that(acquired.wait(5), is_(True))
+
+    def test_tokens_from_config(self):
+        assert_that(github_tokens_from_config({'github_token': 'one'}), is_(['one']))
+        assert_that(github_tokens_from_config({'github_token': 'one', 'github_tokens': 'two, three'}),
+                    is_(['two', 'three']))
+        assert_that(github_tokens_from_config({}), is_([]))
@@ -0,0 +1,423 @@
+"""Unit tests concerning the task handling of main."""
+import json
+import os
+import tempfile
+import threading
+import time
+import unittest
+
+from hamcrest import assert_that, is_, calling, raises, contains_inanyorder, has_entries
+
+import git_commit_walker
+import main
+from commit_index import CommitIndex
+from git_commit_walker_tests import git
+from message_queue import MessageLeaseKeeper, SqliteMessageQueue
+from result_bundler import ResultBundler
+from upload_pipeline import FtpsUploader
+from upload_pipeline_tests import FakeFtpServer
+from watermark_store import WatermarkStore
+
+
+class MainTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+        self.repo_path = os.path.join(self.tmp.name, 'repo')
+        self.results_path = os.path.join(self.tmp.name, 'results')
+        os.makedirs(self.repo_path)
+        os.makedirs(self.results_path)
+        git(self.repo_path, 'init', '-q')
+        main.CONFIG = {}
+        main.GLOBAL = {'RANDOM_ID': 'test', 'START_TIMESTAMP': 'now', 'SHOULD_RUN': True}
+        self.result_names = []
+
+    def commit(self, message):
+        git(self.repo_path, 'commit', '-q', '--allow-empty', '-m', message)
+        return git(self.repo_path, 'rev-parse', 'HEAD')
+
+    def crawl(self, repo_id, **stores):
+        """Crawls the repo and records the crawl as if its result was uploaded.
+        Returns None if no result was written."""
+        result_path, record_crawl = main.write_repo_result(self.repo_path, self.results_path, {'id': repo_id}, {},
+                                                           **stores)
+        if result_path is None:
+            return None
+        if record_crawl is not None:
+            record_crawl(result_path)
+        self.result_names.append(os.path.basename(result_path))
+        with open(result_path) as result_file:
+            return json.load(result_file)
+
+
+class WriteRepoResultTest(MainTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.commit_index = CommitIndex(os.path.join(self.tmp.name, 'commits.sqlite'), expected_commits=1000)
+        self.addCleanup(self.commit_index.close)
+        self.watermark_store = WatermarkStore(os.path.join(self.tmp.name, 'watermarks.sqlite'))
+        self.addCleanup(self.watermark_store.close)
+
+    def crawl_with_stores(self, repo_id):
+        return self.crawl(repo_id, commit_index=self.commit_index, watermark_store=self.watermark_store)
+
+    def test_delta_walk_stops_at_commits_indexed_for_other_repos(self):
+        for index in range(3):
+            base = self.commit('base {}'.format(index))
+        self.crawl_with_stores(1)
+        self.crawl_with_stores(2)
+        git(self.repo_path, 'checkout', '-q', '-b', 'side')
+        side = self.commit('side')
+        self.crawl_with_stores(1)
+        git(self.repo_path, 'checkout', '-q', '-')
+        main_commit = self.commit('main')
+        git(self.repo_path, 'merge', '-q', '--no-ff', '-m', 'merge', 'side')
+        merge = git(self.repo_path, 'rev-parse', 'HEAD')
+
+        walks = []
+        walk_commits = git_commit_walker.walk_commits
+        git_commit_walker.walk_commits = lambda *args: walks.append(args[1]) or walk_commits(*args)
+        self.addCleanup(setattr, git_commit_walker, 'walk_commits', walk_commits)
+
+        result = self.crawl_with_stores(2)
+
+        # One walk running into the commit of repo 1, one restart excluding it.
+        assert_that(walks, is_([['HEAD', '^' + base], ['^' + side, 'HEAD', '^' + base]]))
+        assert_that(result['commits'].keys(), contains_inanyorder(merge, main_commit))
+        assert_that(result['known_commits'], is_({side: 1}))
+        assert_that(result['previous_crawl'], has_entries(head_shas=[base]))
+
+    def test_recrawl_walks_only_commits_added_since(self):
+        first = self.commit('first')
+        self.crawl_with_stores(1)
+        second = self.commit('second')
+        third = self.commit('third')
+
+        result = self.crawl_with_stores(1)
+
+        assert_that(result['commits'].keys(), contains_inanyorder(second, third))
+        assert_that(result['previous_crawl'], has_entries(head_shas=[first], result_name=self.result_names[0]))
+        assert_that(self.result_names[1], is_('1-delta-{}-{}-steak.json'.format(first[:12], third[:12])))
+        assert_that(self.watermark_store.get(1), has_entries(head_shas=[third], result_name=self.result_names[1]))
+
+    def test_unchanged_repo_writes_no_result(self):
+        self.commit('first')
+        self.crawl_with_stores(1)
+        second = self.commit('second')
+        self.crawl_with_stores(1)
+        delta = self.watermark_store.get(1)
+
+        assert_that(self.crawl_with_stores(1), is_(None))
+        assert_that(os.listdir(self.results_path), contains_inanyorder(*self.result_names))
+        assert_that(self.watermark_store.get(1), has_entries(head_shas=[second], result_name=delta['result_name']))
+
+    def test_force_pushed_history_is_walked_completely(self):
+        self.commit('lost')
+        self.crawl_with_stores(1)
+        branch = git(self.repo_path, 'rev-parse', '--abbrev-ref', 'HEAD')
+        git(self.repo_path, 'checkout', '-q', '--orphan', 'rewritten')
+        rewritten = self.commit('rewritten')
+        git(self.repo_path, 'branch', '-q', '-D', branch)
+        git(self.repo_path, 'reflog', 'expire', '--expire=now', '--all')
+        git(self.repo_path, 'gc', '-q', '--prune=now')
+
+        result = self.crawl_with_stores(1)
+
+        assert_that(list(result['commits']), is_([rewritten]))
+        assert_that('previous_crawl' in result, is_(False))
+        assert_that(self.result_names[1], is_('1-steak.json'))
+
+    def test_watermark_waits_for_the_upload(self):
+        self.commit('first')
+
+        result_path, record_crawl = main.write_repo_result(self.repo_path, self.results_path, {'id': 1}, {},
+                                                           watermark_store=self.watermark_store)
+
+        assert_that(self.watermark_store.get(1), is_(None))
+        record_crawl('/spool/1.json')
+        assert_that(self.watermark_store.get(1), has_entries(result_name='1.json'))
+
+    def test_commits_are_indexed_once_the_result_is_uploaded(self):
+        first = self.commit('first')
+
+        result_path, record_crawl = main.write_repo_result(self.repo_path, self.results_path, {'id': 1}, {},
+                                                           commit_index=self.commit_index)
+
+        assert_that(first in self.commit_index, is_(False))
+        record_crawl(result_path)
+        assert_that(self.commit_index.repos_of([first]), is_({first: 1}))
+
+    def test_empty_store_paths_configure_no_stores(self):
+        config = {'commit_index_path': '', 'watermark_store_path': ''}
+
+        assert_that(main.commit_index_from_config(config), is_(None))
+        assert_that(main.watermark_store_from_config(config), is_(None))
+
+    def test_workers_share_the_cache_limits(self):
+        config = main.worker_config({'mirror_cache_path': '/cache/mirrors', 'mirror_cache_max_bytes': '4000',
+                                     'mirror_cache_max_entries': '10', 'response_cache_max_bytes': '',
+                                     'metrics_textfile_path': '/metrics/raq.prom'}, 1, workers=4)
+
+        assert_that(config, has_entries(mirror_cache_path='/cache/mirrors-1', mirror_cache_max_bytes='1000',
+                                        mirror_cache_max_entries='2', response_cache_max_bytes='',
+                                        metrics_textfile_path='/metrics/raq-1.prom'))
+
+    def test_visibility_timeout_of_the_queue_is_configured(self):
+        msg_queue = main.msg_queue_from_config({'msg_queue_backend': 'sqlite', 'msg_visibility_timeout': '0',
+                                                'msg_queue_path': os.path.join(self.tmp.name, 'queue.sqlite')}, None)
+        self.addCleanup(msg_queue.close)
+        msg_queue.write_message({'task_type': 'repo', 'repo_task': {'id': 1}})
+
+        first = msg_queue.pop_next_message()
+
+        assert_that(msg_queue.pop_next_message().message_id, is_(first.message_id))
+
+    def test_bundled_delta_result_is_recorded_with_its_bundle(self):
+        self.commit('first')
+        self.crawl_with_stores(1)
+        second = self.commit('second')
+        closed = []
+        bundler = ResultBundler(os.path.join(self.tmp.name, 'bundles'), {}, main.GLOBAL,
+                                on_close=lambda *bundle: closed.append(bundle), compression='none')
+
+        entry_path, record_crawl = main.write_repo_result(self.repo_path, self.results_path, {'id': 1}, {},
+                                                          bundler, watermark_store=self.watermark_store)
+        bundler.append(entry_path, record_crawl)
+        bundler.close()
+        bundle_path, on_uploaded, _ = closed[0]
+        on_uploaded(bundle_path)
+
+        with open(bundle_path) as bundle:
+            end = [json.loads(line) for line in bundle][-1]
+        assert_that(end, has_entries(end=1, delta_head=second))
+        assert_that(self.watermark_store.get(1), has_entries(head_shas=[second],
+                                                             result_name=os.path.basename(bundle_path)))
+
+
+class RecordingUploadPipeline:
+    """Stands in for the UploadPipeline, keeping the submitted files with their callbacks."""
+
+    def __init__(self):
+        self.submitted = []
+
+    def submit(self, file_path, on_uploaded=None, on_failed=None):
+        self.submitted.append((file_path, on_uploaded, on_failed))
+        return file_path
+
+
+class HandOverRepoResultTest(MainTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.msg_queue = SqliteMessageQueue(os.path.join(self.tmp.name, 'queue.sqlite'), msg_visibility_timeout=60,
+                                            wait_time=0)
+        self.addCleanup(self.msg_queue.close)
+        self.lease_keeper = MessageLeaseKeeper(self.msg_queue, 60)
+        self.addCleanup(self.lease_keeper.close)
+        self.upload_pipeline = RecordingUploadPipeline()
+        self.msg_queue.write_message({'task_type': 'repo', 'repo_task': {'id': 1}})
+
+    def hand_over(self):
+        item = {'message': self.msg_queue.pop_next_message()}
+        main.hand_over_repo_result(self.lease_keeper, self.upload_pipeline, None, item, '1.json')
+        return item
+
+    def test_message_is_held_until_its_result_is_uploaded(self):
+        item = self.hand_over()
+
+        assert_that(item['uploading'], is_(True))
+        assert_that(self.lease_keeper.held, is_(1))
+        assert_that(len(self.msg_queue), is_(1))
+
+        file_path, on_uploaded, _ = self.upload_pipeline.submitted[0]
+        on_uploaded(file_path)
+
+        assert_that(self.lease_keeper.held, is_(0))
+        assert_that(len(self.msg_queue), is_(0))
+
+    def test_message_is_released_if_its_result_is_not_uploaded(self):
+        self.hand_over()
+
+        file_path, _, on_failed = self.upload_pipeline.submitted[0]
+        on_failed(file_path)
+
+        assert_that(self.lease_keeper.held, is_(0))
+        assert_that(len(self.msg_queue), is_(1))
+
+
+class SlowFailingApiStub:
+    """Stands in for the GithubSession, taking longer than the visibility
+    timeout to answer and failing then, after polling msg_queue."""
+
+    def __init__(self, msg_queue):
+        self.msg_queue = msg_queue
+        self.redelivered = None
+
+    def request_url(self, url):
+        time.sleep(1.5)
+        self.redelivered = self.msg_queue.pop_messages()
+        raise ConnectionError('Connection reset by peer')
+
+
+class RepoTaskLeaseTest(MainTestCase):
+
+    def test_message_is_held_while_the_task_runs_and_released_if_it_fails(self):
+        msg_queue = SqliteMessageQueue(os.path.join(self.tmp.name, 'queue.sqlite'), msg_visibility_timeout=1,
+                                       wait_time=0)
+        self.addCleanup(msg_queue.close)
+        lease_keeper = MessageLeaseKeeper(msg_queue, 1)
+        self.addCleanup(lease_keeper.close)
+        msg_queue.write_message({'task_type': 'repo', 'repo_task': {'id': 1, 'api_url': 'https://api.github.com/x'}})
+        github_session = SlowFailingApiStub(msg_queue)
+
+        assert_that(calling(main.handle_repo_task).with_args(github_session, msg_queue.pop_next_message(),
+                                                             self.tmp.name, self.results_path,
+                                                             lease_keeper=lease_keeper),
+                    raises(ConnectionError))
+        assert_that(github_session.redelivered, is_([]))
+        assert_that(lease_keeper.held, is_(0))
+
+
+class RepositoriesPageStub:
+    """Stands in for the GithubSession, answering every request with the same page of repositories."""
+
+    def __init__(self, page):
+        self.page = page
+        self.requested_urls = []
+
+    def request_url(self, url):
+        self.requested_urls.append(url)
+        return self.page, {}, json.dumps(self.page)
+
+
+class RefillTaskTest(MainTestCase):
+
+    def setUp(self):
+        super().setUp()
+        # Popped messages stay visible unless their visibility is extended.
+        self.msg_queue = SqliteMessageQueue(os.path.join(self.tmp.name, 'queue.sqlite'), msg_visibility_timeout=0,
+                                            wait_time=0)
+        self.addCleanup(self.msg_queue.close)
+        main.CONFIG = {'refill_backoff': '60'}
+
+    def pop_refill(self, refill_task):
+        self.msg_queue.write_message({'task_type': 'refill', 'refill_task': refill_task})
+        return [message for message in self.msg_queue.pop_messages()
+                if message.body_dict['task_type'] == 'refill'][0]
+
+    def test_refill_is_deferred_while_the_queue_is_full(self):
+        main.CONFIG['refill_max_queue_depth'] = '1'
+        self.msg_queue.write_message({'task_type': 'repo', 'repo_task': {'id': 1}})
+        github_session = RepositoriesPageStub([{'id': 2, 'full_name': 'raq/two'}])
+
+        assert_that(main.dispatch_message(github_session, self.msg_queue, self.pop_refill({'since_id': 1}),
+                                          self.tmp.name, self.results_path, None, None, None, None, None, None),
+                    is_('deferred'))
+        assert_that(github_session.requested_urls, is_([]))
+        # The refill is hidden for the backoff instead of delivered right again.
+        assert_that(len(self.msg_queue), is_(2))
+        assert_that(self.msg_queue.approximate_depth(), is_(1))
+
+    def test_open_refill_is_deferred_until_there_are_new_repositories(self):
+        github_session = RepositoriesPageStub([])
+
+        assert_that(main.dispatch_message(github_session, self.msg_queue, self.pop_refill({'since_id': 1}),
+                                          self.tmp.name, self.results_path, None, None, None, None, None, None),
+                    is_('deferred'))
+        assert_that(github_session.requested_urls, is_(['https://api.github.com/repositories?since=1']))
+        assert_that(len(self.msg_queue), is_(1))
+        assert_that(self.msg_queue.approximate_depth(), is_(0))
+
+    def test_bounded_refill_is_deferred_until_there_are_new_repositories(self):
+        github_session = RepositoriesPageStub([])
+
+        assert_that(main.dispatch_message(github_session, self.msg_queue,
+                                          self.pop_refill({'since_id': 1050, 'stop_id': 1100}),
+                                          self.tmp.name, self.results_path, None, None, None, None, None, None),
+                    is_('deferred'))
+        assert_that(len(self.msg_queue), is_(1))
+
+    def test_refill_enqueues_repo_tasks_and_is_deleted(self):
+        github_session = RepositoriesPageStub([{'id': 2, 'full_name': 'raq/two'}, {'id': 5, 'full_name': 'raq/five'}])
+
+        assert_that(main.dispatch_message(github_session, self.msg_queue,
+                                          self.pop_refill({'since_id': 1, 'stop_id': 3}),
+                                          self.tmp.name, self.results_path, None, None, None, None, None, None),
+                    is_('ok'))
+        tasks = [message.body_dict for message in self.msg_queue.pop_messages()]
+        assert_that(tasks, is_([{'task_type': 'repo', 'repo_task': {
+            'id': 2, 'full_name': 'raq/two', 'api_url': 'https://api.github.com/repos/raq/two'}}]))
+
+
+class FlakyRepoApiStub:
+    """Stands in for the GithubSession, answering requests from responses
+    after failing the first request of every URL in failing_urls."""
+
+    rate = None
+    response_cache = None
+
+    def __init__(self, responses, failing_urls=()):
+        self.responses = responses
+        self.failing_urls = set(failing_urls)
+        self.requested_urls = []
+        self.lock = threading.Lock()
+
+    def set_credentials(self, personal_access_tokens):
+        pass
+
+    def request_url(self, url):
+        with self.lock:
+            self.requested_urls.append(url)
+            if url in self.failing_urls:
+                self.failing_urls.discard(url)
+                raise ConnectionError('Connection reset by peer')
+        return self.responses[url], {}, json.dumps(self.responses[url])
+
+
+class RunCrawlerTest(MainTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.commit('first')
+        self.ftp_server = FakeFtpServer()
+        ftps_uploader_from_config = main.ftps_uploader_from_config
+        main.ftps_uploader_from_config = lambda config: FtpsUploader('127.0.0.1:2121', 'raq', 'secret',
+                                                                     ftp_factory=self.ftp_server.connection)
+        self.addCleanup(setattr, main, 'ftps_uploader_from_config', ftps_uploader_from_config)
+        self.queue_path = os.path.join(self.tmp.name, 'queue.sqlite')
+        main.CONFIG = {'msg_queue_backend': 'sqlite', 'msg_queue_path': self.queue_path,
+                       'msg_visibility_timeout': '1', 'msg_wait_time': '0.1', 'max_idle': '2',
+                       'metadata_batch_size': '0', 'working_path': os.path.join(self.tmp.name, 'work')}
+
+    def use_github_session(self, github_session):
+        github_session_class = main.GithubSession
+        main.GithubSession = lambda response_cache=None: github_session
+        self.addCleanup(setattr, main, 'GithubSession', github_session_class)
+
+    def test_concurrent_tasks_are_crawled_and_failed_ones_redelivered(self):
+        main.CONFIG['concurrency'] = '2'
+        responses = {}
+        msg_queue = SqliteMessageQueue(self.queue_path)
+        for repo_id in range(1, 5):
+            api_url = 'https://api.github.com/repos/raq/{}'.format(repo_id)
+            responses[api_url] = {'id': repo_id, 'full_name': 'raq/{}'.format(repo_id),
+                                  'clone_url': 'file://' + self.repo_path, 'languages_url': api_url + '/languages'}
+            responses[api_url + '/languages'] = {'Python': repo_id}
+            msg_queue.write_message({'task_type': 'repo', 'repo_task': {'id': repo_id, 'api_url': api_url}})
+        msg_queue.close()
+        github_session = FlakyRepoApiStub(responses, failing_urls=['https://api.github.com/repos/raq/2'])
+        self.use_github_session(github_session)
+
+        main.run_crawler_with_config(main.CONFIG, None)
+
+        assert_that(self.ftp_server.files.keys(), contains_inanyorder(
+            *['ftp/raq/results/{}-steak.json'.format(repo_id) for repo_id in range(1, 5)]))
+        assert_that(github_session.requested_urls.count('https://api.github.com/repos/raq/2'), is_(2))
+        msg_queue = SqliteMessageQueue(self.queue_path)
+        self.addCleanup(msg_queue.close)
+        assert_that(len(msg_queue), is_(0))
+        # The executor was shut down, none of its threads is left.
+        assert_that([thread.name for thread in threading.enumerate() if thread.name.startswith('raq_task')],
+                    is_([]))
@@ -0,0 +1,133 @@
+"""Unit tests concerning the local SQLite backend of the task queue."""
+import os
+import tempfile
+import threading
+import time
+import unittest
+
+from hamcrest import assert_that, is_, calling, raises, contains_exactly, contains_inanyorder
+
+from message_queue import (MessageLeaseKeeper, MessageQueue, SqliteMessageQueue, NoMessagesAfterLongPollingAvailableException,
+                           StaleReceiptHandleException)
+
+
+class SqliteMessageQueueTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+        self.path = os.path.join(self.tmp.name, 'queue', 'tasks.sqlite')
+
+    def queue_with(self, **kwargs):
+        kwargs.setdefault('wait_time', 0.2)
+        msg_queue = SqliteMessageQueue(self.path, poll_interval=0.01, **kwargs)
+        self.addCleanup(msg_queue.close)
+        return msg_queue
+
+    def test_backends_have_to_implement_the_queue(self):
+        assert_that(calling(MessageQueue), raises(TypeError))
+
+    def test_messages_are_popped_in_order(self):
+        msg_queue = self.queue_with()
+        msg_queue.write_messages([{'task_type': 'repo', 'number': number} for number in range(3)])
+        msg_queue.write_message({'task_type': 'refill'}, {'origin': {'StringValue': 'test', 'DataType': 'String'}})
+
+        numbers = [msg_queue.pop_next_message().body_dict.get('number') for _ in range(3)]
+        refill = msg_queue.pop_next_message()
+
+        assert_that(numbers, contains_exactly(0, 1, 2))
+        assert_that(refill.body_dict, is_({'task_type': 'refill'}))
+        assert_that(refill.message_attributes['origin']['StringValue'], is_('test'))
+
+    def test_empty_queue_raises_after_long_poll(self):
+        msg_queue = self.queue_with()
+
+        assert_that(calling(msg_queue.pop_next_message), raises(NoMessagesAfterLongPollingAvailableException))
+        assert_that(msg_queue.pop_messages(10), is_([]))
+
+    def test_popped_message_is_hidden_until_its_visibility_timeout(self):
+        msg_queue = self.queue_with(msg_visibility_timeout=0.3)
+        msg_queue.write_message({'task_type': 'repo'})
+        first = msg_queue.pop_next_message()
+
+        assert_that(msg_queue.approximate_depth(), is_(0))
+        assert_that(msg_queue.pop_messages(1), is_([]))
+        time.sleep(0.3)
+        assert_that(msg_queue.approximate_depth(), is_(1))
+        second = msg_queue.pop_next_message()
+
+        assert_that(second.message_id, is_(first.message_id))
+        assert_that(second.receive_count, is_(2))
+
+    def test_deleted_message_is_not_redelivered(self):
+        msg_queue = self.queue_with(msg_visibility_timeout=0.1)
+        msg_queue.write_message({'task_type': 'repo'})
+
+        msg_queue.pop_next_message().delete()
+        time.sleep(0.1)
+
+        assert_that(len(msg_queue), is_(0))
+        assert_that(msg_queue.pop_messages(1), is_([]))
+
+    def test_outdated_delivery_can_neither_delete_nor_extend(self):
+        msg_queue = self.queue_with(msg_visibility_timeout=0.1)
+        msg_queue.write_message({'task_type': 'repo'})
+        outdated = msg_queue.pop_next_message()
+        time.sleep(0.1)
+        msg_queue.pop_next_message()
+
+        outdated.delete()
+
+        assert_that(len(msg_queue), is_(1))
+        assert_that(calling(outdated.change_visibility).with_args(VisibilityTimeout=60),
+                    raises(StaleReceiptHandleException))
+
+    def test_extended_visibility_hides_message(self):
+        msg_queue = self.queue_with(msg_visibility_timeout=0.1)
+        msg_queue.write_message({'task_type': 'repo'})
+        message = msg_queue.pop_next_message()
+
+        msg_queue.extend_visibility(message, 60)
+        time.sleep(0.1)
+
+        assert_that(msg_queue.pop_messages(1), is_([]))
+
+    def test_concurrent_consumers_get_every_message_once(self):
+        self.queue_with().write_messages([{'number': number} for number in range(100)])
+        received = []
+        lock = threading.Lock()
+
+        def consume():
+            msg_queue = SqliteMessageQueue(self.path, wait_time=0.1, poll_interval=0.01)
+            while True:
+                messages = msg_queue.pop_messages(7)
+                if not messages:
+                    break
+                with lock:
+                    received.extend(message.body_dict['number'] for message in messages)
+                for message in messages:
+                    message.delete()
+            msg_queue.close()
+
+        consumers = [threading.Thread(target=consume) for _ in range(4)]
+        for consumer in consumers:
+            consumer.start()
+        for consumer in consumers:
+            consumer.join()
+
+        assert_that(received, contains_inanyorder(*range(100)))
+
+    def test_held_messages_stay_hidden(self):
+        msg_queue = self.queue_with(msg_visibility_timeout=0.2)
+        msg_queue.write_messages([{'number': 0}, {'number': 1}])
+        held, released = msg_queue.pop_messages(2)
+        lease_keeper = MessageLeaseKeeper(msg_queue, visibility_timeout=0.2, interval=0.05)
+        lease_keeper.hold(held)
+        lease_keeper.hold(released)
+        lease_keeper.release(released)
+
+        time.sleep(0.4)
+        redelivered = msg_queue.pop_messages(2)
+        lease_keeper.close()
+
+        assert_that([message.body_dict['number'] for message in redelivered], contains_exactly(1))
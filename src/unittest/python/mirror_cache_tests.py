@@ -0,0 +1,130 @@
+"""Unit tests concerning the MirrorCache."""
+import os
+import tempfile
+import threading
+import time
+import unittest
+
+from hamcrest import assert_that, is_, has_length, calling, raises
+
+from git_commit_walker import walk_commits
+from git_commit_walker_tests import git
+from mirror_cache import MirrorCache
+from raq_matchers.FileMatchers import is_path_to_dir, is_path_to_nothing
+
+
+class MirrorCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.__tmp = tempfile.TemporaryDirectory()
+        self.cache_path = os.path.join(self.__tmp.name, 'cache')
+        self.sources = {}
+
+    def tearDown(self):
+        self.__tmp.cleanup()
+
+    def source(self, name, commits=1):
+        path = self.sources.get(name)
+        if path is None:
+            path = os.path.join(self.__tmp.name, name)
+            os.makedirs(path)
+            git(path, 'init', '-q')
+            self.sources[name] = path
+        for index in range(commits):
+            git(path, 'commit', '-q', '--allow-empty', '-m', '{} {}'.format(name, index))
+        return 'file://' + path
+
+    def test_miss_clones_and_hit_fetches_incrementally(self):
+        cache = MirrorCache(self.cache_path)
+        url = self.source('a', commits=2)
+        with cache.checkout(1, url) as path:
+            assert_that(list(walk_commits(path)), has_length(2))
+
+        self.source('a', commits=1)
+        with cache.checkout(1, url) as path:
+            assert_that(list(walk_commits(path)), has_length(3))
+
+        assert_that(cache.misses, is_(1))
+        assert_that(cache.hits, is_(1))
+
+    def test_mirror_leaves_out_pull_request_refs(self):
+        cache = MirrorCache(self.cache_path)
+        url = self.source('a')
+        source_path = self.sources['a']
+        git(source_path, 'update-ref', 'refs/pull/1/head', git(source_path, 'commit-tree', '-m', 'pull',
+                                                              'HEAD^{tree}'))
+        with cache.checkout(1, url):
+            pass
+
+        git(source_path, 'update-ref', 'refs/pull/2/head', 'refs/pull/1/head')
+        self.source('a')
+        with cache.checkout(1, url) as path:
+            refs = git(path, 'for-each-ref', '--format=%(refname)').split()
+            assert_that(list(walk_commits(path)), has_length(2))
+
+        assert_that([ref for ref in refs if ref.startswith('refs/pull/')], is_([]))
+        assert_that(cache.hits, is_(1))
+
+    def test_least_recently_used_mirror_is_evicted(self):
+        cache = MirrorCache(self.cache_path, max_entries=2)
+        for repo_id in (1, 2, 3):
+            with cache.checkout(repo_id, self.source(str(repo_id))):
+                pass
+
+        assert_that(cache, has_length(2))
+        assert_that(1 in cache, is_(False))
+        assert_that(cache.mirror_path(1), is_path_to_nothing())
+        assert_that(cache.mirror_path(3), is_path_to_dir())
+
+    def test_mirror_in_use_is_not_evicted(self):
+        cache = MirrorCache(self.cache_path, max_bytes=1)
+        with cache.checkout(1, self.source('1')) as pinned_path:
+            with cache.checkout(2, self.source('2')):
+                pass
+            assert_that(pinned_path, is_path_to_dir())
+
+        assert_that(cache, has_length(0))
+
+    def test_checkouts_of_the_same_repo_take_turns(self):
+        cache = MirrorCache(self.cache_path)
+        url = self.source('a')
+        inside = []
+        overlaps = []
+
+        def check_out():
+            with cache.checkout(1, url):
+                if inside:
+                    overlaps.append(threading.current_thread().name)
+                inside.append(threading.current_thread().name)
+                time.sleep(0.01)
+                inside.remove(threading.current_thread().name)
+
+        for _ in range(2):
+            threads = [threading.Thread(target=check_out) for _ in range(4)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+
+        assert_that(overlaps, is_([]))
+        assert_that(cache.misses + cache.hits, is_(8))
+        assert_that(cache.misses, is_(1))
+
+    def test_index_survives_restart(self):
+        with MirrorCache(self.cache_path).checkout(7, self.source('seven')):
+            pass
+
+        restarted = MirrorCache(self.cache_path)
+
+        assert_that(7 in restarted, is_(True))
+        assert_that(restarted.total_bytes > 0, is_(True))
+
+    def test_failing_clone_leaves_no_entry(self):
+        cache = MirrorCache(self.cache_path)
+
+        def checkout_missing():
+            with cache.checkout(9, 'file://' + os.path.join(self.__tmp.name, 'missing')):
+                pass
+
+        assert_that(calling(checkout_missing), raises(Exception))
+        assert_that(9 in cache, is_(False))
@@ -0,0 +1,55 @@
+"""Unit tests concerning the range partitioned refill."""
+import unittest
+
+from hamcrest import assert_that, is_, calling, raises, contains_exactly, empty
+
+from refill_planner import follow_up_refills, ids_in_range, plan_ranges, refill_task_dict
+
+
+def ranges_of(refill_tasks):
+    return [(task['refill_task']['since_id'], task['refill_task'].get('stop_id'),
+             task['refill_task'].get('lookahead', 1)) for task in refill_tasks]
+
+
+class RefillPlannerTest(unittest.TestCase):
+
+    def test_plan_covers_the_id_space_without_gaps(self):
+        assert_that(ranges_of(plan_ranges(0, 1000, 3, lookahead=2)),
+                    contains_exactly((0, 333, 2), (333, 666, 2), (666, 1000, 2)))
+
+    def test_plan_has_no_empty_ranges(self):
+        assert_that(ranges_of(plan_ranges(10, 12, 5)), contains_exactly((10, 11, 1), (11, 12, 1)))
+        assert_that(calling(plan_ranges).with_args(10, 10, 5), raises(ValueError))
+
+    def test_open_range_continues_after_the_page(self):
+        refill_task = refill_task_dict(0)['refill_task']
+
+        assert_that(ranges_of(follow_up_refills(refill_task, [5, 9, 20])), contains_exactly((20, None, 1)))
+
+    def test_bounded_range_ends_at_its_stop(self):
+        refill_task = refill_task_dict(0, 100)['refill_task']
+
+        assert_that(ids_in_range(refill_task, [50, 100, 150]), contains_exactly(50, 100))
+        assert_that(follow_up_refills(refill_task, [50, 100, 150]), is_(empty()))
+        assert_that(follow_up_refills(refill_task, []), is_(empty()))
+
+    def test_lookahead_splits_the_rest_into_page_wide_ranges(self):
+        refill_task = refill_task_dict(0, 1000, lookahead=3)['refill_task']
+
+        follow_ups = follow_up_refills(refill_task, list(range(1, 101)))
+
+        assert_that(ranges_of(follow_ups), contains_exactly((100, 200, 1), (200, 300, 1), (300, 1000, 3)))
+
+    def test_lookahead_stops_at_the_newest_repository(self):
+        refill_task = refill_task_dict(1000, lookahead=3)['refill_task']
+
+        follow_ups = follow_up_refills(refill_task, list(range(1001, 1051)))
+
+        assert_that(ranges_of(follow_ups), contains_exactly((1050, None, 3)))
+
+    def test_lookahead_leaves_room_for_the_last_range(self):
+        refill_task = refill_task_dict(0, 250, lookahead=4)['refill_task']
+
+        follow_ups = follow_up_refills(refill_task, list(range(1, 101)))
+
+        assert_that(ranges_of(follow_ups), contains_exactly((100, 250, 4)))
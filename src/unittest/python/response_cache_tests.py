@@ -0,0 +1,130 @@
+"""Unit tests concerning the ResponseCache and conditional requests of GithubSession."""
+import json
+import tempfile
+import threading
+import unittest
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+
+from hamcrest import assert_that, is_, none, has_length, has_entries
+
+from github_session import GithubSession
+from response_cache import ResponseCache
+
+
+class EtagHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        server = self.server
+        etag = '"v{}"'.format(server.version)
+        if self.headers.get('If-None-Match') == etag:
+            self.send_response(304)
+            self.send_header('X-RateLimit-Remaining', str(server.remaining))
+        else:
+            server.remaining -= 1
+            body = json.dumps({'path': self.path, 'version': server.version}).encode()
+            self.send_response(200)
+            self.send_header('ETag', etag)
+            self.send_header('Content-Length', str(len(body)))
+            self.send_header('X-RateLimit-Remaining', str(server.remaining))
+        self.send_header('X-RateLimit-Reset', '1900000000')
+        self.end_headers()
+        if self.headers.get('If-None-Match') != etag:
+            self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class EtagServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+    def __init__(self):
+        super().__init__(('127.0.0.1', 0), EtagHandler)
+        self.version = 1
+        self.remaining = 5000
+
+    def url(self, path):
+        return 'http://127.0.0.1:{}{}'.format(self.server_address[1], path)
+
+
+class ResponseCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.__tmp = tempfile.TemporaryDirectory()
+        self.cache_path = self.__tmp.name
+
+    def tearDown(self):
+        self.__tmp.cleanup()
+
+    def test_lookup_returns_stored_entry(self):
+        cache = ResponseCache(self.cache_path)
+        cache.store('https://api.github.com/repos/a/b', '"abc"', None, '{"id": 1}')
+
+        entry = cache.lookup('https://api.github.com/repos/a/b')
+
+        assert_that(entry, has_entries(etag='"abc"', body='{"id": 1}'))
+        assert_that(ResponseCache.conditional_headers(entry), is_({'If-None-Match': '"abc"'}))
+        assert_that(cache.lookup('https://api.github.com/repos/a/c'), is_(none()))
+
+    def test_responses_without_validators_are_not_stored(self):
+        cache = ResponseCache(self.cache_path)
+        cache.store('url', None, None, '{}')
+
+        assert_that(cache, has_length(0))
+
+    def test_least_recently_used_entries_are_evicted(self):
+        cache = ResponseCache(self.cache_path, max_bytes=400)
+        for name in ('a', 'b', 'c'):
+            cache.store(name, '"e"', None, 'x' * 60)
+        cache.lookup('a')
+        cache.store('d', '"e"', None, 'x' * 60)
+
+        assert_that(cache.lookup('b'), is_(none()))
+        assert_that(cache.lookup('a'), has_entries(url='a'))
+        assert_that(cache.evicted, is_(1))
+
+    def test_entries_survive_restart(self):
+        ResponseCache(self.cache_path).store('url', None, 'Wed, 21 Oct 2015 07:28:00 GMT', '[]')
+
+        entry = ResponseCache(self.cache_path).lookup('url')
+
+        assert_that(ResponseCache.conditional_headers(entry),
+                    is_({'If-Modified-Since': 'Wed, 21 Oct 2015 07:28:00 GMT'}))
+
+
+class ConditionalRequestTest(unittest.TestCase):
+
+    def setUp(self):
+        self.__tmp = tempfile.TemporaryDirectory()
+        self.server = EtagServer()
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        self.__tmp.cleanup()
+
+    def test_not_modified_response_serves_cached_body_without_quota(self):
+        cache = ResponseCache(self.__tmp.name)
+        session = GithubSession(response_cache=cache)
+
+        first, _, _ = session.request_url(self.server.url('/repos/raq'))
+        rate_after_first = session.rate
+        second, headers, text = session.request_url(self.server.url('/repos/raq'))
+
+        assert_that(second, is_(first))
+        assert_that(json.loads(text), is_(first))
+        assert_that(session.rate, is_(rate_after_first))
+        assert_that(cache.saved_requests, is_(1))
+
+    def test_changed_resource_replaces_cached_body(self):
+        session = GithubSession(response_cache=ResponseCache(self.__tmp.name))
+        session.request_url(self.server.url('/repos/raq'))
+        self.server.version = 2
+
+        body, _, _ = session.request_url(self.server.url('/repos/raq'))
+
+        assert_that(body['version'], is_(2))
+        assert_that(session.response_cache.saved_requests, is_(0))
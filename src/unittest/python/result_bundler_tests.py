@@ -0,0 +1,112 @@
+"""Unit tests concerning the ResultBundler."""
+import gzip
+import json
+import os
+import tempfile
+import unittest
+
+from hamcrest import assert_that, is_, has_length, empty, ends_with
+
+from raq_matchers.FileMatchers import is_path_to_file, is_path_to_nothing
+from result_bundler import ResultBundler
+
+
+class ResultBundlerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.__tmp = tempfile.TemporaryDirectory()
+        self.results_path = os.path.join(self.__tmp.name, 'results')
+        self.bundles_path = os.path.join(self.__tmp.name, 'bundles')
+        os.makedirs(self.results_path)
+        self.closed = []
+        self.callbacks = []
+
+    def tearDown(self):
+        self.__tmp.cleanup()
+
+    def bundler(self, **kwargs):
+        return ResultBundler(self.bundles_path, {'result_bundling': 'true'}, {'RANDOM_ID': 'w1'},
+                             on_close=self.on_close, **kwargs)
+
+    def on_close(self, bundle_path, on_uploaded, on_failed):
+        self.closed.append(bundle_path)
+        self.callbacks.append((on_uploaded, on_failed))
+
+    def add_result(self, bundler, repo_id, commit_count=2, on_uploaded=None, on_failed=None):
+        with bundler.create_entry_writer(self.results_path, repo_id) as writer:
+            writer.begin({'id': repo_id}, {'Python': 1})
+            for number in range(commit_count):
+                writer.write_commit('{:040d}'.format(number), [], 'commit {}'.format(number))
+            writer.finish({'ignored': True}, {'ignored': True})
+        bundler.append(writer.path, on_uploaded, on_failed)
+        return writer.path
+
+    def read_bundle(self, path):
+        with gzip.open(path, 'rt', encoding='utf-8') as bundle:
+            return [json.loads(line) for line in bundle]
+
+    def test_results_share_one_header(self):
+        bundler = self.bundler()
+        entry_path = self.add_result(bundler, 1)
+        self.add_result(bundler, 2, commit_count=1)
+        bundler.close()
+
+        assert_that(self.closed, has_length(1))
+        assert_that(self.closed[0], ends_with('bundle-w1-000001.jsonl.gz'))
+        lines = self.read_bundle(self.closed[0])
+        assert_that(lines[0]['CONFIG'], is_({'result_bundling': 'true'}))
+        assert_that([line for line in lines if 'CONFIG' in line], has_length(1))
+        assert_that(lines[1:], is_([
+            {'meta': {'id': 1}, 'languages': {'Python': 1}},
+            {'sha': '0' * 40, 'message': 'commit 0'},
+            {'sha': '0' * 39 + '1', 'message': 'commit 1'},
+            {'end': 1, 'commit_count': 2},
+            {'meta': {'id': 2}, 'languages': {'Python': 1}},
+            {'sha': '0' * 40, 'message': 'commit 0'},
+            {'end': 2, 'commit_count': 1},
+        ]))
+        assert_that(entry_path, is_path_to_nothing())
+
+    def test_bundle_is_rotated_by_size(self):
+        bundler = self.bundler(max_bytes=1)
+        self.add_result(bundler, 1)
+        self.add_result(bundler, 2)
+
+        assert_that(self.closed, has_length(2))
+        assert_that(self.read_bundle(self.closed[1])[0]['bundle']['sequence'], is_(2))
+
+    def test_bundle_is_rotated_by_age(self):
+        bundler = self.bundler(max_age=3600)
+        self.add_result(bundler, 1)
+        bundler.rotate_if_due()
+        assert_that(self.closed, is_(empty()))
+
+        aged_bundler = self.bundler(max_age=0)
+        aged_bundler.rotate_if_due()
+        self.add_result(aged_bundler, 2)
+
+        assert_that(self.closed, has_length(1))
+        assert_that(self.closed[0], is_path_to_file())
+
+    def test_open_bundle_is_not_handed_out(self):
+        bundler = self.bundler()
+        self.add_result(bundler, 1)
+
+        assert_that(self.closed, is_(empty()))
+        assert_that(os.listdir(self.bundles_path), is_(['bundle-w1-000001.jsonl.gz.part']))
+
+    def test_callbacks_of_entries_get_the_bundle_path(self):
+        uploaded, failed = [], []
+        bundler = self.bundler(max_bytes=1024)
+        self.add_result(bundler, 1, on_uploaded=uploaded.append, on_failed=failed.append)
+        self.add_result(bundler, 2, on_uploaded=uploaded.append, on_failed=failed.append)
+        self.add_result(bundler, 3, commit_count=100, on_uploaded=uploaded.append)
+        bundler.close()
+
+        assert_that(self.closed, has_length(1))
+        assert_that(uploaded, is_([]))
+        on_uploaded, on_failed = self.callbacks[0]
+        on_uploaded(self.closed[0])
+        assert_that(uploaded, is_([self.closed[0]] * 3))
+        on_failed(self.closed[0])
+        assert_that(failed, is_([self.closed[0]] * 2))
@@ -0,0 +1,183 @@
+"""Unit tests concerning the incremental result writers."""
+import gzip
+import json
+import os
+import sqlite3
+import tempfile
+import unittest
+
+from hamcrest import assert_that, is_, calling, raises, contains_exactly
+
+from raq_matchers.FileMatchers import is_path_to_file, is_path_to_nothing
+from result_writer import ResultWriter, create_result_writer, result_file_name, UnsupportedResultOptionException
+
+try:
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+META = {'id': 42, 'full_name': 'raq/crawl'}
+LANGUAGES = {'Python': 1234}
+CONFIG = {'STAGE': 'test'}
+GLOBAL = {'RANDOM_ID': 'abc'}
+SHA_A = 'a' * 40
+SHA_B = 'b' * 40
+
+
+def write_example(writer):
+    with writer:
+        writer.begin(META, LANGUAGES)
+        writer.write_commit(SHA_A, [SHA_B], 'second\n')
+        writer.write_commit(SHA_B, [], 'first\n')
+        writer.finish(CONFIG, GLOBAL)
+    return writer.path
+
+
+class ResultWriterTest(unittest.TestCase):
+
+    def setUp(self):
+        self.__tmp = tempfile.TemporaryDirectory()
+        self.results_path = self.__tmp.name
+
+    def tearDown(self):
+        self.__tmp.cleanup()
+
+    def test_json_writer_matches_former_json_dumps(self):
+        path = write_example(create_result_writer(self.results_path, 42))
+        expected = json.dumps({
+            'meta': META,
+            'languages': LANGUAGES,
+            'commits': {SHA_A: {'parents': [SHA_B], 'message': 'second\n'}, SHA_B: {'message': 'first\n'}},
+            'CONFIG': CONFIG,
+            'GLOBAL': GLOBAL,
+        })
+
+        assert_that(path, is_(os.path.join(self.results_path, '42-steak.json')))
+        with open(path) as result_file:
+            assert_that(result_file.read(), is_(expected))
+
+    def test_json_writer_without_commits(self):
+        writer = create_result_writer(self.results_path, 42)
+        with writer:
+            writer.begin(META, LANGUAGES)
+            writer.finish(CONFIG, GLOBAL)
+
+        with open(writer.path) as result_file:
+            assert_that(json.load(result_file)['commits'], is_({}))
+
+    def test_json_writer_references_known_commits(self):
+        writer = create_result_writer(self.results_path, 42)
+        with writer:
+            writer.begin(META, LANGUAGES)
+            writer.write_commit(SHA_A, [SHA_B], 'fork\n')
+            writer.finish(CONFIG, GLOBAL, references={'known_commits': {SHA_B: 7}})
+
+        with open(writer.path) as result_file:
+            result = json.load(result_file)
+        assert_that(result['known_commits'], is_({SHA_B: 7}))
+        assert_that(result['CONFIG'], is_(CONFIG))
+
+    def test_gzipped_json_lines(self):
+        path = write_example(create_result_writer(self.results_path, 42, 'jsonl', 'gzip'))
+
+        with gzip.open(path, 'rt') as result_file:
+            lines = [json.loads(line) for line in result_file]
+
+        assert_that(path.endswith('42-steak.jsonl.gz'), is_(True))
+        assert_that(lines, contains_exactly(
+            {'meta': META, 'languages': LANGUAGES},
+            {'sha': SHA_A, 'parents': [SHA_B], 'message': 'second\n'},
+            {'sha': SHA_B, 'message': 'first\n'},
+            {'CONFIG': CONFIG, 'GLOBAL': GLOBAL},
+        ))
+
+    def test_unfinished_result_is_discarded(self):
+        writer = create_result_writer(self.results_path, 42)
+        with writer:
+            writer.begin(META, LANGUAGES)
+            writer.write_commit(SHA_A, [], 'lost')
+
+        assert_that(writer.path, is_path_to_nothing())
+        assert_that(os.listdir(self.results_path), is_([]))
+
+    def test_finished_result_exists_only_after_close(self):
+        writer = create_result_writer(self.results_path, 42)
+        writer.begin(META, LANGUAGES)
+        writer.finish(CONFIG, GLOBAL)
+
+        assert_that(writer.path, is_path_to_nothing())
+        writer.close()
+        assert_that(writer.path, is_path_to_file())
+
+    def test_unknown_options_are_rejected(self):
+        assert_that(calling(result_file_name).with_args(1, 'xml'), raises(UnsupportedResultOptionException))
+        assert_that(calling(result_file_name).with_args(1, 'json', 'rar'), raises(UnsupportedResultOptionException))
+
+    def test_writers_have_to_implement_the_result_format(self):
+        assert_that(calling(ResultWriter).with_args(os.path.join(self.results_path, '42.json')), raises(TypeError))
+
+    def test_delta_results_are_named_after_their_head(self):
+        assert_that(result_file_name(42, 'jsonl', 'gzip', delta_head=SHA_A),
+                    is_('42-delta-aaaaaaaaaaaa-steak.jsonl.gz'))
+        assert_that(result_file_name(42, 'jsonl', 'gzip', delta_head=SHA_A, delta_base=SHA_B),
+                    is_('42-delta-bbbbbbbbbbbb-aaaaaaaaaaaa-steak.jsonl.gz'))
+
+    def test_sqlite_writer_indexes_commits(self):
+        writer = create_result_writer(self.results_path, 42, 'sqlite')
+        with writer:
+            writer.begin(META, LANGUAGES)
+            writer.write_commit(SHA_A, [SHA_B], 'second\n')
+            writer.write_commit(SHA_B, [], 'first\n')
+            writer.finish(CONFIG, GLOBAL, references={'known_commits': {'c' * 40: 7}})
+
+        connection = sqlite3.connect(writer.path)
+        self.addCleanup(connection.close)
+        assert_that(writer.path.endswith('42-steak.sqlite'), is_(True))
+        assert_that(connection.execute('SELECT repo_id, lower(hex(sha)), lower(hex(parents)), message FROM commits'
+                                       ' ORDER BY sha').fetchall(),
+                    contains_exactly((42, SHA_A, SHA_B, 'second\n'), (42, SHA_B, '', 'first\n')))
+        assert_that(json.loads(connection.execute('SELECT refs FROM repos').fetchone()[0]),
+                    is_({'known_commits': {'c' * 40: 7}}))
+        assert_that(sorted(row[0] for row in connection.execute("SELECT name FROM sqlite_master WHERE type = 'index'")),
+                    is_(['commits_repo_id', 'commits_sha']))
+
+    def test_escaped_emoji_in_messages_are_stored(self):
+        # unicode-escape decodes an escaped emoji to its surrogates.
+        message = b'smile \\ud83d\\ude00, lone \\ud83d'.decode('unicode-escape')
+        formats = [('sqlite', 'none')] + ([('parquet', 'zstd')] if pyarrow is not None else [])
+        for result_format, compression in formats:
+            writer = create_result_writer(self.results_path, 42, result_format, compression)
+            with writer:
+                writer.begin(META, LANGUAGES)
+                writer.write_commit(SHA_A, [], message)
+                writer.finish(CONFIG, GLOBAL)
+
+            if result_format == 'sqlite':
+                with sqlite3.connect(writer.path) as connection:
+                    stored = connection.execute('SELECT message FROM commits').fetchone()[0]
+            else:
+                stored = pyarrow.parquet.read_table(writer.path).column('message').to_pylist()[0]
+            assert_that(stored, is_('smile \U0001F600, lone \uFFFD'))
+
+    def test_unfinished_sqlite_result_is_discarded(self):
+        writer = create_result_writer(self.results_path, 42, 'sqlite')
+        with writer:
+            writer.begin(META, LANGUAGES)
+
+        assert_that(writer.path, is_path_to_nothing())
+        assert_that(calling(create_result_writer).with_args(self.results_path, 42, 'sqlite', 'gzip'),
+                    raises(UnsupportedResultOptionException))
+
+    @unittest.skipIf(pyarrow is None, 'pyarrow is not installed')
+    def test_parquet_writer_links_parents_by_index(self):
+        path = write_example(create_result_writer(self.results_path, 42, 'parquet', 'zstd'))
+
+        table = pyarrow.parquet.read_table(path)
+        metadata = table.schema.metadata
+
+        assert_that(path.endswith('42-steak.parquet'), is_(True))
+        assert_that(table.column('sha').to_pylist(), is_([bytes.fromhex(SHA_A), bytes.fromhex(SHA_B)]))
+        assert_that(table.column('repo_id').to_pylist(), is_([42, 42]))
+        assert_that(table.column('index').to_pylist(), is_([0, 1]))
+        assert_that(table.column('parent_indexes').to_pylist(), is_([[1], []]))
+        assert_that(json.loads(metadata[b'meta']), is_(META))
@@ -0,0 +1,93 @@
+"""Unit tests concerning the batched writes of SqsMessageQueue."""
+import json
+import threading
+import unittest
+
+from hamcrest import assert_that, is_, calling, raises, only_contains, less_than_or_equal_to
+
+from sqs_queue_capsuling import (SqsMessageQueue, BatchWriteFailedException, batches_of_entries,
+                                 MAX_SEND_BATCH_BYTES)
+
+
+class FakeSqsClient:
+
+    def __init__(self, transient_failures=(), rejected=()):
+        self.transient_failures = set(transient_failures)
+        self.rejected = set(rejected)
+        self.calls = []
+        self.written = []
+        self.lock = threading.Lock()
+
+    def send_message_batch(self, QueueUrl, Entries):
+        failed = []
+        with self.lock:
+            self.calls.append([entry['Id'] for entry in Entries])
+            for entry in Entries:
+                if entry['Id'] in self.rejected:
+                    failed.append({'Id': entry['Id'], 'SenderFault': True, 'Code': 'InvalidMessageContents'})
+                elif entry['Id'] in self.transient_failures:
+                    self.transient_failures.remove(entry['Id'])
+                    failed.append({'Id': entry['Id'], 'SenderFault': False, 'Code': 'InternalError'})
+                else:
+                    self.written.append(json.loads(entry['MessageBody']))
+        return {'Successful': [], 'Failed': failed}
+
+
+class FakeQueueResource:
+
+    def __init__(self, client):
+        self.url = 'https://sqs.example/queue'
+        self.meta = self
+        self.client = client
+
+
+class FakeBotoSession:
+
+    def __init__(self, client):
+        self.client = client
+
+    def resource(self, name):
+        return self
+
+    def Queue(self, address):
+        return FakeQueueResource(self.client)
+
+
+class SqsBatchWriteTest(unittest.TestCase):
+
+    def test_messages_are_sent_in_batches_of_ten(self):
+        client = FakeSqsClient()
+        msg_queue = SqsMessageQueue(FakeBotoSession(client), 'queue')
+
+        written = msg_queue.write_messages([{'number': number} for number in range(25)])
+
+        assert_that(written, is_(25))
+        assert_that(sorted(len(call) for call in client.calls), is_([5, 10, 10]))
+        assert_that(sorted(message['number'] for message in client.written), is_(list(range(25))))
+
+    def test_failed_entries_are_resent(self):
+        client = FakeSqsClient(transient_failures=['3', '12'])
+        msg_queue = SqsMessageQueue(FakeBotoSession(client), 'queue')
+
+        msg_queue.write_messages([{'number': number} for number in range(20)])
+
+        assert_that(sorted(message['number'] for message in client.written), is_(list(range(20))))
+        assert_that(sorted(call for call in client.calls if len(call) == 1), is_([['12'], ['3']]))
+
+    def test_sender_faults_are_not_resent(self):
+        client = FakeSqsClient(rejected=['1'])
+        msg_queue = SqsMessageQueue(FakeBotoSession(client), 'queue')
+
+        assert_that(calling(msg_queue.write_messages).with_args([{'a': 1}, {'b': 2}]),
+                    raises(BatchWriteFailedException))
+        assert_that(client.calls, is_([['0', '1']]))
+
+    def test_batches_stay_below_the_size_limit(self):
+        body = 'x' * (MAX_SEND_BATCH_BYTES // 3)
+        entries = [{'Id': str(index), 'MessageBody': body, 'MessageAttributes': {}} for index in range(5)]
+
+        batches = list(batches_of_entries(entries))
+
+        assert_that([len(batch) for batch in batches], is_([2, 2, 1]))
+        assert_that([sum(len(entry['MessageBody']) for entry in batch) for batch in batches],
+                    only_contains(less_than_or_equal_to(MAX_SEND_BATCH_BYTES)))
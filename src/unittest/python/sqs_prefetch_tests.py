@@ -0,0 +1,152 @@
+"""Unit tests concerning the prefetch buffer of SqsMessageQueue."""
+import json
+import threading
+import time
+import unittest
+
+from botocore import exceptions
+from hamcrest import assert_that, is_, calling, raises, contains_exactly, greater_than, less_than_or_equal_to
+
+from sqs_queue_capsuling import SqsMessageQueue, NoMessagesAfterLongPollingAvailableException
+
+
+class FakeMessage:
+
+    def __init__(self, number, fake_queue):
+        self.body = json.dumps({'task_type': 'repo', 'number': number})
+        self.message_id = str(number)
+        self.receipt_handle = 'handle-{}'.format(number)
+        self.visibility_timeouts = []
+        self.__queue = fake_queue
+
+    def change_visibility(self, VisibilityTimeout):
+        if self.__queue.expired_handles and self.receipt_handle in self.__queue.expired_handles:
+            raise exceptions.ClientError({'Error': {'Code': 'InvalidParameterValue'}}, 'ChangeMessageVisibility')
+        self.visibility_timeouts.append(VisibilityTimeout)
+
+
+class FakeSqsQueue:
+
+    def __init__(self, message_count):
+        self.pending = [FakeMessage(number, self) for number in range(message_count)]
+        self.requested_batches = []
+        self.expired_handles = set()
+        self.lock = threading.Lock()
+
+    def receive_messages(self, MaxNumberOfMessages, WaitTimeSeconds, **kwargs):
+        with self.lock:
+            self.requested_batches.append(MaxNumberOfMessages)
+            batch = self.pending[:MaxNumberOfMessages]
+            del self.pending[:MaxNumberOfMessages]
+        if not batch:
+            time.sleep(min(WaitTimeSeconds, 0.05))
+        return batch
+
+
+class FakeBotoSession:
+
+    def __init__(self, fake_queue):
+        self.fake_queue = fake_queue
+
+    def resource(self, name):
+        return self
+
+    def Queue(self, address):
+        return self.fake_queue
+
+
+class SqsPrefetchTest(unittest.TestCase):
+
+    def queue_with(self, fake_queue, **kwargs):
+        msg_queue = SqsMessageQueue(FakeBotoSession(fake_queue), 'queue', wait_time=1, **kwargs)
+        self.addCleanup(msg_queue.close)
+        return msg_queue
+
+    def test_messages_are_received_in_batches(self):
+        fake_queue = FakeSqsQueue(25)
+        msg_queue = self.queue_with(fake_queue, prefetch_size=20)
+
+        numbers = [msg_queue.pop_next_message().body_dict['number'] for _ in range(25)]
+
+        assert_that(numbers, is_(list(range(25))))
+        assert_that(max(fake_queue.requested_batches), is_(10))
+        assert_that(msg_queue.buffered, less_than_or_equal_to(20))
+
+    def test_popped_message_gets_its_lease_renewed(self):
+        fake_queue = FakeSqsQueue(1)
+        msg_queue = self.queue_with(fake_queue, prefetch_size=5, msg_visibility_timeout=300)
+
+        message = msg_queue.pop_next_message()
+
+        assert_that(message.visibility_timeouts, contains_exactly(300))
+
+    def test_expired_leases_are_skipped(self):
+        fake_queue = FakeSqsQueue(2)
+        fake_queue.expired_handles.add('handle-0')
+        msg_queue = self.queue_with(fake_queue, prefetch_size=5)
+
+        assert_that(msg_queue.pop_next_message().body_dict['number'], is_(1))
+        assert_that(msg_queue.expired_leases, is_(1))
+
+    def test_buffered_messages_keep_their_lease(self):
+        fake_queue = FakeSqsQueue(1)
+        message = fake_queue.pending[0]
+        msg_queue = self.queue_with(fake_queue, prefetch_size=5, msg_visibility_timeout=1, lease_margin=0.8)
+        time.sleep(1.5)
+
+        assert_that(msg_queue.pop_next_message(), is_(message))
+        assert_that(len(message.visibility_timeouts), greater_than(5))
+        assert_that(msg_queue.expired_leases, is_(0))
+
+    def test_messages_whose_lease_can_not_be_renewed_are_dropped(self):
+        fake_queue = FakeSqsQueue(1)
+        msg_queue = self.queue_with(fake_queue, prefetch_size=5, msg_visibility_timeout=1, lease_margin=0.8)
+        while msg_queue.buffered < 1:
+            time.sleep(0.01)
+        fake_queue.expired_handles.add('handle-0')
+        time.sleep(0.3)
+
+        assert_that(calling(msg_queue.pop_next_message), raises(NoMessagesAfterLongPollingAvailableException))
+        assert_that(msg_queue.expired_leases, is_(1))
+
+    def test_empty_queue_raises_after_long_poll(self):
+        msg_queue = self.queue_with(FakeSqsQueue(0), prefetch_size=5)
+
+        assert_that(calling(msg_queue.pop_next_message), raises(NoMessagesAfterLongPollingAvailableException))
+
+    def test_close_releases_buffered_messages(self):
+        fake_queue = FakeSqsQueue(3)
+        messages = list(fake_queue.pending)
+        msg_queue = self.queue_with(fake_queue, prefetch_size=5)
+        msg_queue.pop_next_message()
+
+        msg_queue.close()
+
+        assert_that([message.visibility_timeouts for message in messages[1:]], is_([[0], [0]]))
+
+    def test_without_prefetch_one_message_is_received_per_pop(self):
+        fake_queue = FakeSqsQueue(2)
+        msg_queue = self.queue_with(fake_queue)
+
+        msg_queue.pop_next_message()
+
+        assert_that(fake_queue.requested_batches, is_([1]))
+
+    def test_batch_pop_takes_buffered_messages(self):
+        fake_queue = FakeSqsQueue(8)
+        msg_queue = self.queue_with(fake_queue, prefetch_size=8)
+        while msg_queue.buffered < 8:
+            time.sleep(0.01)
+
+        messages = msg_queue.pop_messages(5)
+
+        assert_that([message.body_dict['number'] for message in messages], is_([0, 1, 2, 3, 4]))
+
+    def test_batch_pop_without_prefetch_receives_at_most_ten(self):
+        fake_queue = FakeSqsQueue(12)
+        msg_queue = self.queue_with(fake_queue)
+
+        messages = msg_queue.pop_messages(50)
+
+        assert_that(len(messages), is_(10))
+        assert_that(fake_queue.requested_batches, is_([10]))
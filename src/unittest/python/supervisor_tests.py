@@ -0,0 +1,66 @@
+"""Unit tests concerning the WorkerSupervisor."""
+import os
+import tempfile
+import threading
+import time
+import unittest
+
+from hamcrest import assert_that, is_, less_than, contains_inanyorder
+
+from supervisor import WorkerSupervisor
+
+
+class WorkerSupervisorTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+
+    def record(self, slot):
+        with open(os.path.join(self.tmp.name, 'run-{}-{}'.format(slot, os.getpid())), 'w'):
+            pass
+
+    def runs(self):
+        return sorted(file_name.split('-')[1] for file_name in os.listdir(self.tmp.name)
+                      if file_name.startswith('run-'))
+
+    def test_finished_workers_are_not_restarted(self):
+        supervisor = WorkerSupervisor(self.record, workers=3)
+
+        supervisor.run()
+
+        assert_that(self.runs(), contains_inanyorder('0', '1', '2'))
+        assert_that(supervisor.restarts, is_(0))
+
+    def test_crashed_workers_are_forked_again(self):
+        def crash_once(slot):
+            self.record(slot)
+            marker = os.path.join(self.tmp.name, 'crashed-{}'.format(slot))
+            if not os.path.exists(marker):
+                open(marker, 'w').close()
+                raise RuntimeError('worker {} crashed'.format(slot))
+
+        supervisor = WorkerSupervisor(crash_once, workers=2, restart_delay=0.01)
+
+        supervisor.run()
+
+        assert_that(self.runs(), contains_inanyorder('0', '0', '1', '1'))
+        assert_that(supervisor.restarts, is_(2))
+
+    def test_exited_workers_are_cleaned_up_after(self):
+        exited = []
+        supervisor = WorkerSupervisor(self.record, workers=2, on_exit=exited.append)
+
+        supervisor.run()
+
+        assert_that(exited, contains_inanyorder(0, 1))
+
+    def test_stop_terminates_workers(self):
+        supervisor = WorkerSupervisor(lambda slot: time.sleep(30), workers=2)
+        threading.Timer(0.5, supervisor.stop).start()
+        start = time.monotonic()
+
+        supervisor.run()
+
+        assert_that(time.monotonic() - start, less_than(10))
+        assert_that(supervisor.restarts, is_(0))
@@ -0,0 +1,167 @@
+"""Unit tests concerning the FtpsUploader and the UploadPipeline."""
+import ftplib
+import os
+import tempfile
+import threading
+import unittest
+
+from hamcrest import assert_that, is_, calling, raises, empty
+
+from crawler_metrics import MetricsRegistry
+from raq_matchers.FileMatchers import is_path_to_file, is_path_to_nothing
+from upload_pipeline import FtpsUploader, UploadPipeline
+
+
+class FakeFtpServer:
+    """Stands in for the FTP server, handing out connections that store into a dict."""
+
+    def __init__(self):
+        self.files = {}
+        self.logins = 0
+        self.quits = 0
+        self.failing_stores = 0
+        self.lock = threading.Lock()
+
+    def connection(self):
+        return FakeFtpConnection(self)
+
+
+class FakeFtpConnection:
+
+    def __init__(self, server):
+        self.server = server
+        self.protected = False
+        self.open = False
+
+    def connect(self, host, port, timeout):
+        self.open = True
+
+    def login(self, user, passwd):
+        if passwd != 'secret':
+            raise ftplib.error_perm('530 Login incorrect.')
+        with self.server.lock:
+            self.server.logins += 1
+
+    def prot_p(self):
+        self.protected = True
+
+    def storbinary(self, command, file_handle):
+        assert self.open and self.protected
+        with self.server.lock:
+            if self.server.failing_stores:
+                self.server.failing_stores -= 1
+                raise ftplib.error_temp('421 Service not available, closing control connection.')
+            self.server.files[command[len('STOR '):]] = file_handle.read()
+
+    def rename(self, from_name, to_name):
+        with self.server.lock:
+            self.server.files[to_name] = self.server.files.pop(from_name)
+
+    def quit(self):
+        with self.server.lock:
+            self.server.quits += 1
+        self.open = False
+
+    def close(self):
+        self.open = False
+
+
+class UploadPipelineTest(unittest.TestCase):
+
+    def setUp(self):
+        self.__tmp = tempfile.TemporaryDirectory()
+        self.server = FakeFtpServer()
+        self.spool_path = os.path.join(self.__tmp.name, 'spool')
+
+    def tearDown(self):
+        self.__tmp.cleanup()
+
+    def uploader(self, password='secret'):
+        return FtpsUploader('127.0.0.1:2121', 'raq', password, ftp_factory=self.server.connection)
+
+    def result_file(self, name, content=b'{}'):
+        path = os.path.join(self.__tmp.name, name)
+        with open(path, 'wb') as result_file:
+            result_file.write(content)
+        return path
+
+    def test_uploader_reuses_its_session(self):
+        uploader = self.uploader()
+        uploader.upload(self.result_file('1-steak.json', b'one'))
+        uploader.upload(self.result_file('2-steak.json', b'two'))
+        uploader.close()
+
+        assert_that(self.server.files, is_({'ftp/raq/results/1-steak.json': b'one',
+                                            'ftp/raq/results/2-steak.json': b'two'}))
+        assert_that(self.server.logins, is_(1))
+        assert_that(self.server.quits, is_(1))
+
+    def test_uploader_reconnects_after_failure(self):
+        uploader = self.uploader()
+        self.server.failing_stores = 1
+        path = self.result_file('1-steak.json')
+
+        assert_that(calling(uploader.upload).with_args(path), raises(ftplib.error_temp))
+        uploader.upload(path)
+
+        assert_that(uploader.connects, is_(2))
+
+    def test_pipeline_uploads_and_removes_spooled_files(self):
+        pipeline = UploadPipeline(self.uploader, self.spool_path, workers=2, backoff=0.01)
+        paths = [self.result_file('{}-steak.json'.format(number)) for number in range(6)]
+        for path in paths:
+            pipeline.submit(path)
+        pipeline.close()
+
+        assert_that(len(self.server.files), is_(6))
+        assert_that(pipeline.uploaded, is_(6))
+        assert_that(os.listdir(self.spool_path), is_(empty()))
+        assert_that(paths[0], is_path_to_nothing())
+
+    def test_pipeline_retries_failed_uploads(self):
+        self.server.failing_stores = 2
+        pipeline = UploadPipeline(self.uploader, self.spool_path, backoff=0.01)
+        pipeline.submit(self.result_file('1-steak.json'))
+        pipeline.close()
+
+        assert_that(list(self.server.files), is_(['ftp/raq/results/1-steak.json']))
+        assert_that(pipeline.failed, is_(0))
+
+    def test_only_attempts_followed_by_another_count_as_retried(self):
+        metrics = MetricsRegistry()
+        pipeline = UploadPipeline(lambda: self.uploader(password='wrong'), self.spool_path,
+                                  max_attempts=3, backoff=0.01, metrics=metrics)
+        pipeline.submit(self.result_file('1-steak.json'))
+        pipeline.close()
+
+        assert_that(metrics.counter_value('raq_uploads_total', {'outcome': 'retried'}), is_(2))
+        assert_that(metrics.counter_value('raq_uploads_total', {'outcome': 'failed'}), is_(1))
+
+    def test_undeliverable_files_stay_spooled_for_the_next_pipeline(self):
+        pipeline = UploadPipeline(lambda: self.uploader(password='wrong'), self.spool_path,
+                                  max_attempts=2, backoff=0.01)
+        spooled_path = pipeline.submit(self.result_file('1-steak.json'))
+        pipeline.close()
+
+        assert_that(pipeline.failed, is_(1))
+        assert_that(spooled_path, is_path_to_file())
+
+        next_pipeline = UploadPipeline(self.uploader, self.spool_path)
+        next_pipeline.close()
+
+        assert_that(next_pipeline.uploaded, is_(1))
+        assert_that(spooled_path, is_path_to_nothing())
+
+    def test_pipeline_calls_back_once_files_are_uploaded_or_given_up(self):
+        uploaded, failed = [], []
+        pipeline = UploadPipeline(self.uploader, self.spool_path, backoff=0.01)
+        spooled_path = pipeline.submit(self.result_file('1-steak.json'), uploaded.append, failed.append)
+        pipeline.close()
+
+        failing_pipeline = UploadPipeline(lambda: self.uploader(password='wrong'), self.spool_path,
+                                          max_attempts=1, backoff=0.01)
+        failed_path = failing_pipeline.submit(self.result_file('2-steak.json'), uploaded.append, failed.append)
+        failing_pipeline.close()
+
+        assert_that(uploaded, is_([spooled_path]))
+        assert_that(failed, is_([failed_path]))
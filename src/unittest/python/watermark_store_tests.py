@@ -0,0 +1,42 @@
+"""Unit tests concerning the store of crawled HEADs."""
+import os
+import tempfile
+import unittest
+
+from hamcrest import assert_that, is_, none, has_entries
+
+from watermark_store import WatermarkStore
+
+SHA_A = 'a' * 40
+SHA_B = 'b' * 40
+
+
+class WatermarkStoreTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+        self.path = os.path.join(self.tmp.name, 'state', 'watermarks.sqlite')
+
+    def open_store(self):
+        store = WatermarkStore(self.path)
+        self.addCleanup(store.close)
+        return store
+
+    def test_unknown_repo_has_no_watermark(self):
+        assert_that(self.open_store().get(42), is_(none()))
+
+    def test_latest_crawl_replaces_watermark(self):
+        store = self.open_store()
+        store.set(42, [SHA_A], '42-steak.json')
+        store.set(42, [SHA_B], '42-delta-bbbbbbbbbbbb-steak.json')
+
+        assert_that(store.get(42), has_entries({'head_shas': [SHA_B],
+                                                'result_name': '42-delta-bbbbbbbbbbbb-steak.json'}))
+
+    def test_watermark_survives_reopening(self):
+        store = self.open_store()
+        store.set(42, [SHA_A], '42-steak.json')
+        store.close()
+
+        assert_that(self.open_store().get(42)['head_shas'], is_([SHA_A]))